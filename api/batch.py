@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Batch geocoding
+-------------------------------------------------------------------------------
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from api.geocache import normalize
+from api.registry import KINDS
+from api.server import device_record
+
+# Most addresses one batch may hold
+MAX_ADDRESSES = 1000
+
+
+def unique(addresses):
+    '''
+    Addresses without blanks or repeats, in the order first seen
+
+    Two addresses are the same if they normalize to the same geocode cache key, so
+    "10220 104 Ave" and "10220  104 ave," are only looked up once
+    '''
+    seen = set()
+    for address in addresses:
+        address = address.strip()
+        key = normalize(address)
+        if key and key not in seen:
+            seen.add(key)
+            yield address
+
+
+def geocode_all(addresses, geocode, workers:int=4, logger=logging.getLogger(__name__)):
+    '''
+    Resolve addresses concurrently, yielding each one as soon as it is done
+
+    Cached addresses come back straight away; the rest wait their turn for Nominatim
+    (see client.geocode()), with up to `workers` requests in flight
+
+    :param addresses    list        Addresses to resolve (already deduplicated)
+    :param geocode      function    address -> (lat, lon) or None, e.g. cli.address_to_coords
+    :param workers      int         Lookups running at once
+    :param logger       logger      Logging object
+    :return             generator   (address, coords or None) tuples, in completion order
+    '''
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="driftkit-geocode")
+    try:
+        futures = {pool.submit(geocode, address): address for address in addresses}
+        for future in as_completed(futures):
+            address = futures[future]
+            try:
+                coords = future.result()
+            except Exception as e:
+                logger.error(f"batch.geocode_all(): couldn't geocode {address} ({e})")
+                coords = None
+            yield address, coords
+    finally:
+        # If the caller stops early (a client hung up), don't keep spending Nominatim requests
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def locate_all(addresses, geocode, registry, radius=None, k:int=None, kinds=KINDS, workers:int=4,
+               logger=logging.getLogger(__name__)):
+    '''
+    Geocode a batch of addresses and find the devices around each one
+
+    :param addresses    list            Addresses as given (blanks and repeats are dropped)
+    :param geocode      function        address -> (lat, lon) or None
+    :param registry     DeviceRegistry  Loaded registry to search
+    :param radius       float           Search radius (in metres, None = no limit)
+    :param k            int             Devices per address (None = every device in the radius)
+    :param kinds        tuple           Any of "camera", "trap"
+    :param workers      int             Lookups running at once
+    :param logger       logger          Logging object
+    :return             generator       One JSON-ready dict per address, in completion order
+    '''
+    for address, coords in geocode_all(list(unique(addresses)), geocode, workers=workers, logger=logger):
+        if not coords:
+            yield {"address": address, "error": "couldn't find that location"}
+            continue
+
+        matches = registry.search(coords, radius=radius, kinds=kinds, k=k)
+        yield {
+            "address": address,
+            "lat": coords[0],
+            "lon": coords[1],
+            "count": len(matches),
+            "devices": [device_record(devices[i], kind, d) for d, kind, devices, i in matches],
+        }
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Response cache
+-------------------------------------------------------------------------------
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from api import geohash
+
+
+def quantize(coords, precision:int=7):
+    '''
+    Snap coordinates to the centre of their geohash cell, so nearby searches share a cache entry
+
+    :param coords       tuple   GPS coordinates (lat:float, lon:float)
+    :param precision    int     Geohash length (7 is about 150 x 90 m in Edmonton)
+    :return             tuple   (geohash, centre of the cell as (lat, lon))
+    '''
+    cell = geohash.encode(coords[0], coords[1], precision)
+    return cell, geohash.decode(cell)
+
+
+class ResponseCache:
+    '''
+    Bounded LRU of rendered responses for one device snapshot
+
+    Keys are built by the caller from the quantized origin and the search parameters.
+    Every entry belongs to a snapshot generation; the first lookup made with a newer
+    generation drops them all, so a dataset refresh invalidates the whole cache.
+    '''
+
+    def __init__(self, size:int=512):
+        """
+        :param size     int     Max number of responses kept
+        """
+        self.size = size
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def etag(key, generation:int):
+        '''
+        Strong validator for a response: the same key and generation always render the same body
+        '''
+        return hashlib.blake2b(repr((key, generation)).encode(), digest_size=12).hexdigest()
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation:int):
+        '''
+        :return     bytes   Cached body, or None on a miss
+        '''
+        with self._lock:
+            self._check_generation(generation)
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, generation:int, body:bytes):
+        with self._lock:
+            # A request that started on an older snapshot doesn't get to refill the cache
+            if self.generation is not None and generation < self.generation:
+                return
+            self._check_generation(generation)
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "entries": len(self._entries),
+        }
@@ -27,23 +27,30 @@ __email__ = "temtamre@gmail.com"
 
 import os
 import sys
+import json
 import time
-import requests
-import certifi
-import ssl
+import heapq
 import logging
-import geopy.geocoders
+import argparse
+import threading
 
-from api.device import Camera, Trap
+from api import client, distance
+from api.batch import MAX_ADDRESSES, locate_all
+from api.geocache import GeocodeCache
+from api.registry import DeviceRegistry, KINDS
+from api.track import parse_fix, track as track_fixes
+from api.socrata import CAMERA_URL, TRAP_URL, CAMERA_COLUMNS, TRAP_COLUMNS, camera_from_row, trap_from_row, fetch_devices
 
 
-# Environment variables
-APP_TOKEN = os.environ['DRIFTKIT_APP_TOKEN']
-SECRET_TOKEN = os.environ['DRIFTKIT_SECRET_TOKEN']
+# Environment variables (DRIFTKIT_APP_TOKEN is read by api.client when the first request is made)
 
-# API endpoints
-CAMERA_URL = f"https://data.edmonton.ca/resource/7fnd-72gr.json"
-TRAP_URL = f"https://data.edmonton.ca/resource/akzz-54k3.json"
+# Geocoded addresses are cached in memory and in this SQLite file ("" to keep them in memory only)
+GEOCODE_CACHE = os.environ.get('DRIFTKIT_GEOCODE_CACHE',
+                               os.path.join(os.path.expanduser("~"), ".cache", "driftkit", "geocode.sqlite3"))
+geocode_cache = GeocodeCache(path=GEOCODE_CACHE or None)
+
+# The last camera and trap data fetched by the CLI or the webserver is kept here ("" to disable)
+SNAPSHOT_DIR = os.environ.get('DRIFTKIT_SNAPSHOT_DIR', os.path.join(os.path.expanduser("~"), ".cache", "driftkit"))
 
 # Defining our logger here and initializing it later when file is ran
 # to avoid wasting memory on imports
@@ -68,108 +75,199 @@ def menu():
  """)
     print("-" * 70)
 
-    # Load all cameras and traps
-    cameras = load_all_cameras()
-    traps = load_all_traps()
+    index = load_registry()
+    cameras, traps = current_devices(index)
 
 
-    # Get the user's address and max distance
+    # Get the user's address, max distance and max number of results
     coords = None
     while not coords:
         coords = address_to_coords(location=input("Location > "))
 
-    refresh_devices(cameras, coords)
-
     limit = float(input("Max radius (0 for no limit) > "))
-    print_cameras(cameras, limit=limit)
+    count = int(input("Max results (0 for no limit) > ") or 0)
+    shown = closest_devices(cameras, index, coords, kind="camera", limit=limit, count=count)
+    print_cameras(shown, limit=limit, count=count)
 
     while True:
         print("Options: refresh, lite, traps, quit")
         end_ui = input("> ")
 
-        # Refresh user location and max distance
+        # Refresh user location, max distance and max number of results
         if end_ui.startswith("r"):
             coords = None
             while not coords:
                 coords = address_to_coords(input("Location > "))
 
-            refresh_devices(cameras, coords)
-
             limit = float(input("Max radius (0 for no limit) > "))
-            print_cameras(cameras, limit=limit)
+            count = int(input("Max results (0 for no limit) > ") or 0)
+
+            # Pick up the background update if it has finished
+            cameras, traps = current_devices(index)
+            shown = closest_devices(cameras, index, coords, kind="camera", limit=limit, count=count)
+            print_cameras(shown, limit=limit, count=count)
 
         # Lite mode (condensed output)
         elif end_ui.startswith("l"):
-            print_cameras(cameras, lite=True, limit=limit)
+            print_cameras(shown, lite=True, limit=limit, count=count)
 
         # Display speed traps
         elif end_ui.startswith("t"):
-            refresh_devices(traps, coords)
-            print_traps(traps)
+            print_traps(closest_devices(traps, index, coords, kind="trap", count=count), count=count)
 
         # Quit the program
         elif end_ui.startswith("q"):
             sys.exit()
     
 
-def load_all_cameras(logger=cli_logger):
+def load_registry():
     '''
-    Fetch the intersection cameras from the City of Edmonton API and return a list of Camera() objects
+    Registry of every camera and trap, exiting if there's no data at all
+
+    Starts from the cameras and traps saved by the last run and fetches new ones in the background,
+    only waiting for data.edmonton.ca when nothing has been saved yet
     '''
+    logger = cli_logger or logging.getLogger(__name__)
+    index = DeviceRegistry()
+    if SNAPSHOT_DIR and index.persist(SNAPSHOT_DIR, logger=logger):
+        print(f"Using data from {time.ctime(index.snapshot.loaded_at)}, checking for updates in the background",
+              file=sys.stderr)
+        threading.Thread(target=index.load, kwargs={"logger": logger}, daemon=True).start()
+    elif not index.load(logger=logger):
+        print("Couldn't load cameras and traps from data.edmonton.ca", file=sys.stderr)
+        sys.exit(1)
+    return index
+
+
+def batch(argv:list, output=sys.stdout):
+    '''
+    `cli.py batch`: devices around every address in a file (or stdin), one JSON line per address
 
-    cameras = []
-    response = requests.get(CAMERA_URL)
+    Lines are written as addresses are resolved, so they don't come out in input order
 
-    if response.status_code == 200:
-        for camera in response.json():
-            cameras.append(
-                Camera(
-                    site_id   = camera['site_id'],
-                    speed     = int(camera['posted_speed'].split(" ")[0]),
-                    direction = camera['travel_direction'],
-                    location  = "{} {}".format(camera['approach'], camera['cross_street']),
-                    coords    = (float(camera['latitude']), float(camera['longitude']))
-                ))
+    :param argv     list    Command line arguments after "batch"
+    :param output   file    Where to write the JSON lines
+    '''
+    parser = argparse.ArgumentParser(prog="cli.py batch", description="Find cameras and traps near many addresses")
+    parser.add_argument("file", nargs="?", default="-", help="one address per line (default: stdin)")
+    parser.add_argument("--radius", type=float, default=1.0, help="search radius in km (0 for no limit, default 1)")
+    parser.add_argument("--count", type=int, default=0, help="max devices per address (0 for no limit)")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="camera, trap or camera,trap")
+    parser.add_argument("--workers", type=int, default=4, help="addresses looked up at once")
+    args = parser.parse_args(argv)
+
+    kinds = tuple(kind for kind in args.kinds.split(",") if kind)
+    if not kinds or any(kind not in KINDS for kind in kinds):
+        parser.error(f"--kinds must be one or more of {', '.join(KINDS)}")
+
+    if args.file == "-":
+        addresses = sys.stdin.read().splitlines()
     else:
-        logger.error(f"cli.load_all_cameras(): got {response.status_code} from data.edmonton.ca")
-        logger.error(response.text)
+        with open(args.file) as f:
+            addresses = f.read().splitlines()
+    if len(addresses) > MAX_ADDRESSES:
+        parser.error(f"at most {MAX_ADDRESSES} addresses per batch")
+
+    logger = cli_logger or logging.getLogger(__name__)
+    index = load_registry()
+    geocode = lambda address: address_to_coords(address, logger=logger)
+    for result in locate_all(addresses, geocode, index, radius=args.radius * 1000 or None, k=args.count or None,
+                             kinds=kinds, workers=args.workers, logger=logger):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+
+def track(argv:list, output=sys.stdout):
+    '''
+    `cli.py track`: alerts for the cameras and traps ahead of a live GPS track, one JSON line per alert
+
+    Fixes are read a line at a time from a file (or stdin, e.g. piped from gpspipe), as JSON
+    objects or "lat,lon[,heading[,time]]". With --realtime, a recorded track is replayed at the
+    speed it was driven, using the time of each fix.
+
+    :param argv     list    Command line arguments after "track"
+    :param output   file    Where to write the JSON lines
+    '''
+    parser = argparse.ArgumentParser(prog="cli.py track", description="Alert on cameras and traps ahead of a GPS track")
+    parser.add_argument("file", nargs="?", default="-", help="one fix per line (default: stdin)")
+    parser.add_argument("--distance", type=float, default=0.5, help="alert distance in km (default 0.5)")
+    parser.add_argument("--cone", type=float, default=30.0, help="degrees either side of the heading (default 30)")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="camera, trap or camera,trap")
+    parser.add_argument("--realtime", action="store_true", help="replay the track at the speed it was recorded")
+    args = parser.parse_args(argv)
+
+    kinds = tuple(kind for kind in args.kinds.split(",") if kind)
+    if not kinds or any(kind not in KINDS for kind in kinds):
+        parser.error(f"--kinds must be one or more of {', '.join(KINDS)}")
+
+    logger = cli_logger or logging.getLogger(__name__)
+    index = load_registry()
+
+    def fixes(lines):
+        started = first = None
+        for line in lines:
+            try:
+                fix = parse_fix(line)
+            except ValueError as e:
+                logger.warning(f"cli.track(): skipping {e}")
+                continue
+            if fix is None:
+                continue
+            if args.realtime and fix["time"] is not None:
+                if started is None:
+                    started, first = time.monotonic(), fix["time"]
+                time.sleep(max(0.0, fix["time"] - first - (time.monotonic() - started)))
+            yield fix
+
+    lines = sys.stdin if args.file == "-" else open(args.file)
+    try:
+        for alert in track_fixes(fixes(lines), index, alert_distance=args.distance, cone=args.cone, kinds=kinds):
+            output.write(json.dumps(alert, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def current_devices(index):
+    '''
+    Lists of the cameras and traps in the registry's current snapshot
 
-    return cameras
+    :param index    DeviceRegistry  Loaded registry
+    :return         tuple           (cameras, traps)
+    '''
+    snapshot = index.snapshot
+    return list(snapshot.cameras), list(snapshot.traps)
+
+
+def load_all_cameras(logger=cli_logger):
+    '''
+    Fetch the intersection cameras from the City of Edmonton API and return a list of Camera() objects
+    '''
+    return fetch_devices(CAMERA_URL, camera_from_row, CAMERA_COLUMNS, logger=logger or logging.getLogger(__name__))
 
 
 def load_all_traps(logger=cli_logger):
     '''
     Fetch the speed trap zones from the City of Edmonton API and return a list of Trap() objects
     '''
-    traps = []
-    response = requests.get(TRAP_URL)
-    if response.status_code == 200:
-        traps = []
-        for trap in response.json():
-            traps.append(
-                Trap(
-                    site_id   = trap['site_id'],
-                    speed     = int(trap['speed_limit']),
-                    direction = trap['location_description'][0:2],
-                    location  = trap['location_description'][3:],
-                    coords    = (float(trap['latitude']), float(trap['longitude']))
-                ))
-    else:
-        logger.error(f"cli.load_all_traps(): got {response.status_code} from data.edmonton.ca")
-        logger.error(response.text)
-    
-    return traps
+    return fetch_devices(TRAP_URL, trap_from_row, TRAP_COLUMNS, logger=logger or logging.getLogger(__name__))
 
 
-def print_cameras(cameras:list, lite:bool=False, limit:int=0):
+def print_cameras(cameras:list, lite:bool=False, limit:int=0, count:int=0):
     '''
     Print a list of all the cameras, in order of closest to farthest from the user
 
     :param  cameras     list of Camera() objects
     :param  lite        true = condensed output, false = verbose output
     :param  limit       Max distance from the user to display cameras for
+    :param  count       Max number of cameras to display (0 for no limit)
     '''
-    cameras.sort()
+    if count > 0:
+        # Only the closest few are shown, so keep a bounded heap instead of sorting everything
+        cameras = heapq.nsmallest(count, cameras)
+    else:
+        cameras.sort()
     print("-" * 70)
     if lite:
         for i in range(len(cameras)):
@@ -186,26 +284,49 @@ def print_cameras(cameras:list, lite:bool=False, limit:int=0):
     print("-" * 70)
 
 
-def print_traps(traps:list):
+def print_traps(traps:list, count:int=0):
     '''
     Print a list of all the traps, in order of closest to farthest from the user
 
     :param  traps  list of Trap() objects
+    :param  count  Max number of traps to display (0 for no limit)
     '''
-    traps.sort()
+    if count > 0:
+        traps = heapq.nsmallest(count, traps)
+    else:
+        traps.sort()
     print("-" * 70)
     for trap in traps:
         print(trap)
     print("-" * 70)
 
 
+def closest_devices(devices:list, index, coords, kind:str, limit:float=0, count:int=0):
+    '''
+    Devices of one kind with their distances set, asking the index for only the closest
+    ones when there's a result limit instead of refreshing every device
+
+    :param devices  list            List of Device() objects of one kind
+    :param index    DeviceRegistry  Registry holding the same devices
+    :param coords   tuple           GPS coordinates of the user (latitude, longitude)
+    :param kind     str             "camera" or "trap"
+    :param limit    float           Max distance from the user (kilometres, 0 for no limit)
+    :param count    int             Max number of devices (0 for no limit)
+    '''
+    if count > 0:
+        return index.nearest(coords, k=count, radius=limit * 1000 or None, kinds=(kind,))
+
+    refresh_devices(devices, coords)
+    return devices
+
+
 def refresh_devices(devices, coords):
     '''
-    Refresh the distance of all devices in the list
+    Refresh the distance of all devices in the list (in one batch, see distance.refresh())
     :param devices  list    List of Device() objects
     :param coords   tuple   GPS coordinates of the user (latitude, longitude)
     '''
-    list(map(lambda device: device.refresh(coords), devices))
+    distance.refresh(devices, coords)
 
 
 def address_to_coords(location:str, logger=cli_logger):
@@ -233,18 +354,25 @@ def address_to_coords(location:str, logger=cli_logger):
             logger.error(f"cli.address_to_coords(): invalid coordinates ({location})")
             return None
 
-    context = ssl.create_default_context(cafile=certifi.where())
-    geopy.geocoders.options.default_ssl_context = context
+    # Addresses we've resolved before don't need to go back to Nominatim
+    coords = geocode_cache.get(location)
+    if coords:
+        return coords
 
-    geolocator = geopy.geocoders.Nominatim(user_agent="driftkit")
-    coords = geolocator.geocode(f"{location}, Edmonton, Alberta, Canada")
+    coords = client.geocode(f"{location}, Edmonton, Alberta, Canada")
 
     if not coords:
         logger.error(f"cli.address_to_coords(): geopy couldn't find coordinates for {location}")
         return None
 
+    geocode_cache.put(location, (coords.latitude, coords.longitude))
     return coords.latitude, coords.longitude
 
 if __name__ == "__main__":
     cli_logger = logging.getLogger(__name__)
-    menu()
\ No newline at end of file
+    if sys.argv[1:2] == ["batch"]:
+        batch(sys.argv[2:])
+    elif sys.argv[1:2] == ["track"]:
+        track(sys.argv[2:])
+    else:
+        menu()
\ No newline at end of file
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Shared HTTP clients
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import fcntl
+import functools
+import threading
+from urllib.parse import urlsplit
+
+from api.metrics import metrics, UPSTREAM
+
+# requests, urllib3, geopy, certifi and ssl are imported on first use, so importing the CLI
+# or the webserver doesn't pay for an HTTP stack until something goes over the network
+
+
+# One pooled connection per request thread (gunicorn's `threads` setting)
+POOL_SIZE = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# Seconds to wait for a connection / for each read
+TIMEOUT = (float(os.environ.get('DRIFTKIT_CONNECT_TIMEOUT', '3.05')),
+           float(os.environ.get('DRIFTKIT_READ_TIMEOUT', '10')))
+
+# Retry connection errors and overloaded responses, waiting 0.5s, 1s, 2s between attempts (urllib3 Retry settings)
+RETRIES = dict(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+               allowed_methods=("GET",), raise_on_status=False)
+
+# Nominatim's usage policy allows at most one request per second from an application
+NOMINATIM_RATE = float(os.environ.get('DRIFTKIT_NOMINATIM_RATE', '1'))
+
+# Where addresses are looked up (a self-hosted Nominatim, or benchmarks/standin.py)
+NOMINATIM_URL = os.environ.get('DRIFTKIT_NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+
+_lock = threading.Lock()
+_session = None
+_geolocator = None
+
+
+def session():
+    '''
+    The requests.Session every Socrata call goes through, created on first use
+
+    Keeping one session means TCP and TLS connections to data.edmonton.ca are reused
+    across requests instead of being set up again for every fetch
+    '''
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import requests
+                from urllib3.util.retry import Retry
+
+                s = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=Retry(**RETRIES))
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+
+                # Requests with an app token get a much higher rate limit from Socrata
+                if os.environ.get('DRIFTKIT_APP_TOKEN'):
+                    s.headers["X-App-Token"] = os.environ['DRIFTKIT_APP_TOKEN']
+                _session = s
+    return _session
+
+
+def get(url:str, **kwargs):
+    '''
+    requests.get() through the shared session, with the default timeout
+
+    :param url      str     URL to fetch
+    :param kwargs   dict    Passed on to requests.Session.get()
+    '''
+    kwargs.setdefault("timeout", TIMEOUT)
+    host = urlsplit(url).hostname
+    try:
+        response = session().get(url, **kwargs)
+    except Exception:
+        metrics.inc(UPSTREAM, host=host, status="error")
+        raise
+    metrics.inc(UPSTREAM, host=host, status=response.status_code)
+    return response
+
+
+def geolocator():
+    '''
+    The Nominatim geocoder, created on first use and shared by every caller
+    '''
+    global _geolocator
+    if _geolocator is None:
+        with _lock:
+            if _geolocator is None:
+                import ssl
+                import certifi
+                import geopy.adapters
+                import geopy.geocoders
+                from urllib3.util.retry import Retry
+
+                url = urlsplit(NOMINATIM_URL)
+                _geolocator = geopy.geocoders.Nominatim(
+                    user_agent="driftkit",
+                    domain=url.netloc,
+                    scheme=url.scheme,
+                    timeout=TIMEOUT[1],
+                    ssl_context=ssl.create_default_context(cafile=certifi.where()),
+                    adapter_factory=functools.partial(geopy.adapters.RequestsAdapter,
+                                                      pool_maxsize=POOL_SIZE, max_retries=Retry(**RETRIES)))
+    return _geolocator
+
+
+class RateLimiter:
+    '''
+    Spaces calls out so no more than `rate` start per second, whichever thread makes them
+
+    With a path, the next free slot is kept in that file instead, under an exclusive flock,
+    so every process pointed at the same file (e.g. gunicorn's workers) shares the one rate.
+    '''
+
+    def __init__(self, rate:float, path:str=None):
+        """
+        :param rate     float   Calls per second
+        :param path     str     File shared by the processes that keep to the rate together (None = this process only)
+        """
+        self.interval = 1.0 / rate
+        self.path = path
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Block until the caller is allowed to go
+        '''
+        with self._lock:
+            if self.path:
+                now, start = self._reserve()
+            else:
+                now = time.monotonic()
+                start = max(now, self._next)
+                self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _reserve(self):
+        # Wall clock time, since the file outlives processes. A slot more than an hour away
+        # means the clock was set back, not that there's an hour's queue.
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                slot = float(f.read() or 0)
+            except ValueError:
+                slot = 0.0
+            now = time.time()
+            start = max(now, slot if slot <= now + 3600 else now)
+            f.truncate(0)
+            f.write(repr(start + self.interval))
+        return now, start
+
+
+nominatim_limit = RateLimiter(NOMINATIM_RATE)
+
+
+def geocode(query:str):
+    '''
+    geolocator().geocode(), waiting for a turn under NOMINATIM_RATE first
+
+    :param query    str         Address to look up
+    :return         Location    geopy Location, or None if nothing was found
+    '''
+    nominatim_limit.wait()
+    try:
+        location = geolocator().geocode(query)
+    except Exception:
+        metrics.inc(UPSTREAM, host=urlsplit(NOMINATIM_URL).hostname, status="error")
+        raise
+    metrics.inc(UPSTREAM, host=urlsplit(NOMINATIM_URL).hostname, status=200)
+    return location
@@ -22,10 +22,31 @@ Class definitions
 -------------------------------------------------------------------------------
 """
 
-from haversine import haversine
+import sys
+
+from api import distance
 
 MAPPINGS = {"NB": "Northbound", "EB": "Eastbound", "SB": "Southbound", "WB": "Westbound"}
 
+# Travel directions as small integers, so the spatial index can keep them in a byte column (0 = unknown)
+DIRECTIONS = ("", "Northbound", "Eastbound", "Southbound", "Westbound")
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+
+
+def direction_code(direction:str):
+    '''
+    Code of a travel direction ("Northbound" or "NB"), 0 if it isn't one of DIRECTIONS
+    '''
+    direction = direction.strip()
+    return DIRECTION_CODES.get(MAPPINGS.get(direction.upper(), direction.capitalize()), 0)
+
+
+def heading_direction(heading:float):
+    '''
+    Code of the travel direction closest to a compass heading (0 = north, 90 = east)
+    '''
+    return 1 + int((heading % 360 + 45) // 90) % 4
+
 """
 Parent class for speed camera and speed trap classes
 In order to be calculable and comparable, we need a common base class with the following
@@ -36,8 +57,14 @@ In order to be calculable and comparable, we need a common base class with the f
         __lt__():       function    defines less than + greater than
         __le__():       function    defines less than or equal + greater than or equal
         __eq__():       function    defines equal or not equal
+
+Devices use __slots__ and store coordinates as two floats rather than a tuple, since every
+process holds the whole city's worth of them; the handful of distinct direction strings
+are interned so all devices share one copy of each
 """
 class Device:
+    __slots__ = ("site_id", "speed", "direction", "location", "lat", "lon", "distance", "icon")
+
     def __init__(self, site_id, speed, direction, location, coords, distance=0.0, icon=""):
         """
         :param site_id      str     Site ID of the speed trap
@@ -49,12 +76,27 @@ class Device:
         """
         self.site_id = site_id
         self.speed = speed
-        self.direction = direction
+        self.direction = sys.intern(direction)
         self.location = location
-        self.coords = coords
+        self.lat, self.lon = coords
         self.distance = distance
         self.icon = icon
 
+    @property
+    def coords(self):
+        return (self.lat, self.lon)
+
+    @coords.setter
+    def coords(self, coords):
+        self.lat, self.lon = coords
+
+    def __copy__(self):
+        # Quicker than the generic __reduce_ex__ path copy.copy() takes for slotted classes
+        device = object.__new__(type(self))
+        for name in Device.__slots__:
+            setattr(device, name, getattr(self, name))
+        return device
+
     # Getters
     def get_site_id(self):
         return self.site_id
@@ -85,7 +127,7 @@ class Device:
         
         :param position     tuple   lat/lon of the user as floats
         '''
-        self.distance = haversine(position, self.coords)
+        self.distance = distance.between(position, self.coords)
 
     # Comparison methods
     def __lt__(self, other):
@@ -99,6 +141,7 @@ class Device:
 
 
 class Camera(Device):
+    __slots__ = ()
 
     def __init__(self, site_id, speed, direction, location, coords, distance=0.0, icon="📷"):
         """
@@ -133,6 +176,7 @@ class Camera(Device):
         )
 
 class Trap(Device):
+    __slots__ = ()
 
     def __init__(self, site_id, speed, direction, location, coords, distance=0.0, icon="🪤"):
         """
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Batch distance engine
+-------------------------------------------------------------------------------
+"""
+
+from math import radians, degrees, sin, cos, asin, atan2, sqrt
+from array import array
+
+# NumPy is optional and only imported the first time a column is built (see load_numpy()),
+# everything here falls back to plain Python without it
+_UNLOADED = object()
+numpy = _UNLOADED
+
+# Same mean earth radius as the haversine package, so results match Device.refresh()
+EARTH_RADIUS = 6371.0088
+
+
+def load_numpy():
+    '''
+    The numpy module, imported on first use
+
+    :return     module  numpy, or None if it isn't installed
+    '''
+    global numpy
+    if numpy is _UNLOADED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def between(a, b):
+    '''
+    Haversine distance between two points (same result as haversine.haversine())
+
+    :param a    tuple   GPS coordinates (lat:float, lon:float)
+    :param b    tuple   GPS coordinates (lat:float, lon:float)
+    :return     float   Distance in kilometres
+    '''
+    lat1, lon1, lat2, lon2 = radians(a[0]), radians(a[1]), radians(b[0]), radians(b[1])
+    d = sin((lat2 - lat1) * 0.5) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) * 0.5) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(d))
+
+
+def bearing(a, b):
+    '''
+    Initial compass bearing from one point to another
+
+    :param a    tuple   GPS coordinates of the start (lat:float, lon:float)
+    :param b    tuple   GPS coordinates of the destination
+    :return     float   Degrees clockwise from north, 0 to 360
+    '''
+    lat1, lat2 = radians(a[0]), radians(b[0])
+    dlon = radians(b[1] - a[1])
+    x = sin(dlon) * cos(lat2)
+    y = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
+    return degrees(atan2(x, y)) % 360
+
+
+def columns(points):
+    '''
+    Split coordinates into contiguous latitude and longitude arrays
+
+    :param points   iterable    GPS coordinates (lat:float, lon:float)
+    :return         tuple       (lats, lons) as numpy arrays if NumPy is installed, else array('d')
+    '''
+    lats, lons = array("d"), array("d")
+    for lat, lon in points:
+        lats.append(lat)
+        lons.append(lon)
+
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.frombuffer(lats, dtype=numpy.float64), numpy.frombuffer(lons, dtype=numpy.float64)
+    return lats, lons
+
+
+def take(column, positions):
+    '''
+    Values of a column at the given positions, as the same kind of column
+
+    :param column       array       A column from columns()
+    :param positions    list        Positions to read
+    '''
+    numpy = load_numpy()
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column[numpy.asarray(positions, dtype=numpy.intp)]
+    return array("d", (column[i] for i in positions))
+
+
+def distances(origin, lats, lons):
+    '''
+    Haversine distance from one point to every point in a pair of columns, in one pass
+
+    :param origin   tuple   GPS coordinates of the user (lat:float, lon:float)
+    :param lats     array   Latitudes (from columns() or take())
+    :param lons     array   Longitudes
+    :return         array   Distances in kilometres (numpy array or list, matching the input)
+    '''
+    lat1, lon1 = radians(origin[0]), radians(origin[1])
+
+    numpy = load_numpy()
+    if numpy is not None and isinstance(lats, numpy.ndarray):
+        lat2, lon2 = numpy.radians(lats), numpy.radians(lons)
+        d = numpy.sin((lat2 - lat1) * 0.5) ** 2 + cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) * 0.5) ** 2
+        return EARTH_RADIUS * (2 * numpy.arcsin(numpy.sqrt(d)))
+
+    cos_lat1 = cos(lat1)
+    found = []
+    for lat, lon in zip(lats, lons):
+        lat2 = radians(lat)
+        d = sin((lat2 - lat1) * 0.5) ** 2 + cos_lat1 * cos(lat2) * sin((radians(lon) - lon1) * 0.5) ** 2
+        found.append(EARTH_RADIUS * (2 * asin(sqrt(d))))
+    return found
+
+
+def paired(lats1, lons1, lats2, lons2):
+    '''
+    Haversine distance between the points at the same position in two pairs of columns
+
+    :param lats1    array   Latitudes of the first points
+    :param lons1    array   Longitudes of the first points
+    :param lats2    array   Latitudes of the second points (same length)
+    :param lons2    array   Longitudes of the second points
+    :return         array   Distances in kilometres (numpy array or list, matching the input)
+    '''
+    numpy = load_numpy()
+    if numpy is not None and isinstance(lats2, numpy.ndarray):
+        lat1, lon1 = numpy.radians(lats1), numpy.radians(lons1)
+        lat2, lon2 = numpy.radians(lats2), numpy.radians(lons2)
+        d = numpy.sin((lat2 - lat1) * 0.5) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) * 0.5) ** 2
+        return EARTH_RADIUS * (2 * numpy.arcsin(numpy.sqrt(d)))
+    return [between(a, b) for a, b in zip(zip(lats1, lons1), zip(lats2, lons2))]
+
+
+def to_segment(a, b, lats, lons):
+    '''
+    Distance from every point in a pair of columns to the segment a-b, and where along the
+    segment the closest point is (0 at a, 1 at b)
+
+    Measured on an equirectangular projection around the segment, which for segments of a few
+    kilometres is well within a metre of the great-circle distance
+
+    :param a        tuple   GPS coordinates of the start of the segment (lat:float, lon:float)
+    :param b        tuple   GPS coordinates of the end of the segment
+    :param lats     array   Latitudes (from columns() or take())
+    :param lons     array   Longitudes
+    :return         tuple   (distances in kilometres, positions along the segment), numpy arrays or lists
+    '''
+    kx = EARTH_RADIUS * radians(1) * cos(radians((a[0] + b[0]) / 2))
+    ky = EARTH_RADIUS * radians(1)
+    bx, by = (b[1] - a[1]) * kx, (b[0] - a[0]) * ky
+    length2 = bx * bx + by * by
+
+    numpy = load_numpy()
+    if numpy is not None and isinstance(lats, numpy.ndarray):
+        px, py = (lons - a[1]) * kx, (lats - a[0]) * ky
+        t = numpy.zeros(len(px)) if length2 == 0 else numpy.clip((px * bx + py * by) / length2, 0.0, 1.0)
+        return numpy.hypot(px - t * bx, py - t * by), t
+
+    offsets, ts = [], []
+    for lat, lon in zip(lats, lons):
+        px, py = (lon - a[1]) * kx, (lat - a[0]) * ky
+        t = 0.0 if length2 == 0 else min(max((px * bx + py * by) / length2, 0.0), 1.0)
+        offsets.append(sqrt((px - t * bx) ** 2 + (py - t * by) ** 2))
+        ts.append(t)
+    return offsets, ts
+
+
+def refresh(devices, coords):
+    '''
+    Batch equivalent of calling Device.refresh() on every device
+
+    :param devices  list    List of Device() objects
+    :param coords   tuple   GPS coordinates of the user (lat:float, lon:float)
+    '''
+    lats, lons = columns(device.coords for device in devices)
+    for device, distance in zip(devices, distances(coords, lats, lons)):
+        device.distance = float(distance)
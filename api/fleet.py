@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Proximity alerts for a whole fleet
+-------------------------------------------------------------------------------
+"""
+
+import bisect
+
+from api import distance
+from api.registry import KINDS
+from api.server import device_record
+from api.track import Tracker, area_of, gather, angle
+
+
+class Fleet:
+    '''
+    Proximity alerts for many vehicles at once, fed batches of GPS fixes
+
+    Each vehicle keeps its own position, heading and alerted devices (a Tracker). The candidate
+    devices are gathered once per index cell and shared by every vehicle in it, and the
+    distances from every vehicle in a batch to its cell's candidates are worked out in one
+    vectorized pass, so only the few devices actually in range are looked at in Python.
+    Alerts follow the same rules as Tracker.update().
+
+    Fleets don't share any state, so a bigger fleet can be split by vehicle over processes.
+    '''
+
+    def __init__(self, registry, alert_distance:float=0.5, cone:float=30.0, kinds=KINDS, max_areas:int=4096):
+        """
+        :param registry         DeviceRegistry  Loaded registry
+        :param alert_distance   float           Alert when a device gets this close (in kilometres)
+        :param cone             float           Max degrees between the heading and a device ahead
+        :param kinds            tuple           Any of "camera", "trap"
+        :param max_areas        int             Cells whose candidates are kept between batches
+        """
+        self.registry = registry
+        self.alert_distance = alert_distance
+        self.cone = cone
+        self.kinds = kinds
+        self.max_areas = max_areas
+
+        self.vehicles = {}
+        self._areas = {}            # area -> (candidates, lats, lons, column of each device key)
+        self._levels = {}           # whole degree of latitude -> index level (cell sizes only change with latitude)
+        self._generation = None
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def _area(self, snapshot, area):
+        found = self._areas.get(area)
+        if found is None:
+            if len(self._areas) >= self.max_areas:
+                self._areas.clear()
+            candidates = gather(snapshot, area, self.alert_distance, self.kinds)
+            lats, lons = distance.columns((lat, lon) for _, _, _, lat, lon in candidates)
+            columns = {(kind, lat, lon): j for j, (kind, _, _, lat, lon) in enumerate(candidates)}
+            found = self._areas[area] = (candidates, lats, lons, columns)
+        return found
+
+    def update(self, fixes):
+        '''
+        Move every vehicle in a batch and return the alerts they trigger
+
+        A vehicle can appear more than once in a batch; its fixes are applied in order.
+
+        :param fixes    iterable    Dicts from track.parse_fix() (vehicle, lat, lon, heading, time)
+        :return         list        Alert dicts with the vehicle they are for
+        '''
+        snapshot = self.registry.snapshot
+        if snapshot is None:
+            return []
+        if snapshot.generation != self._generation:
+            self._areas.clear()
+            self._levels.clear()
+            self._generation = snapshot.generation
+
+        alerts = []
+        groups = {}
+        pending = set()
+        for fix in fixes:
+            vehicle = fix.get("vehicle")
+            tracker = self.vehicles.get(vehicle)
+            if tracker is None:
+                tracker = self.vehicles[vehicle] = Tracker(self.registry, self.alert_distance, self.cone, self.kinds)
+            elif vehicle in pending:
+                # The vehicle's earlier fix has to be measured before this one moves it
+                alerts += self._measure(snapshot, groups)
+                groups, pending = {}, set()
+            pending.add(vehicle)
+
+            lat, lon = fix["lat"], fix["lon"]
+            tracker.move(lat, lon, fix.get("heading"))
+            band = int(lat)
+            level = self._levels.get(band)
+            if level is None:
+                level = self._levels[band] = snapshot.camera_index.level_for((band + (1 if lat >= 0 else -1), lon),
+                                                                             self.alert_distance)
+            area = area_of(snapshot, lat, lon, self.alert_distance, level)
+            if area != tracker.area:
+                tracker.enter(area, self._area(snapshot, area)[3])
+            groups.setdefault(area, []).append((vehicle, tracker, lat, lon, tracker.heading, fix.get("time")))
+
+        return alerts + self._measure(snapshot, groups)
+
+    def _measure(self, snapshot, groups):
+        # Every vehicle against every candidate of its area, all in one flat vectorized pass
+        members, areas = [], []
+        for area, group in groups.items():
+            found = self._area(snapshot, area)
+            if found[0]:
+                members += group
+                areas += [found] * len(group)
+        if not members:
+            return []
+
+        sizes = [len(candidates) for candidates, _, _, _ in areas]
+        offsets = [0]
+        for size in sizes:
+            offsets.append(offsets[-1] + size)
+
+        numpy = distance.load_numpy()
+        if numpy is not None and isinstance(areas[0][1], numpy.ndarray):
+            lats1 = numpy.repeat([lat for _, _, lat, _, _, _ in members], sizes)
+            lons1 = numpy.repeat([lon for _, _, _, lon, _, _ in members], sizes)
+            lats2 = numpy.concatenate([lats for _, lats, _, _ in areas])
+            lons2 = numpy.concatenate([lons for _, _, lons, _ in areas])
+            flat = distance.paired(lats1, lons1, lats2, lons2)
+            hits = numpy.flatnonzero(flat <= self.alert_distance).tolist()
+            flat = flat.tolist()
+        else:
+            lats1 = [lat for (_, _, lat, _, _, _), size in zip(members, sizes) for _ in range(size)]
+            lons1 = [lon for (_, _, _, lon, _, _), size in zip(members, sizes) for _ in range(size)]
+            lats2 = [lat for _, lats, _, _ in areas for lat in lats]
+            lons2 = [lon for _, _, lons, _ in areas for lon in lons]
+            flat = distance.paired(lats1, lons1, lats2, lons2)
+            hits = [k for k, d in enumerate(flat) if d <= self.alert_distance]
+
+        near = {}
+        for k in hits:
+            near.setdefault(bisect.bisect_right(offsets, k) - 1, []).append(k)
+
+        alerts = []
+        rearm = 1.5 * self.alert_distance
+        for m, (vehicle, tracker, lat, lon, heading, time) in enumerate(members):
+            candidates, _, _, columns = areas[m]
+            tracker.rearm(lambda key: flat[offsets[m] + columns[key]] > rearm)
+
+            found = []
+            for k in near.get(m, ()):
+                kind, devices, i, dlat, dlon = candidates[k - offsets[m]]
+                key = (kind, dlat, dlon)
+                if tracker.has_alerted(key):
+                    continue
+                bearing = distance.bearing((lat, lon), (dlat, dlon))
+                if heading is not None and angle(bearing, heading) > self.cone:
+                    continue
+                tracker.mark_alerted(key)
+                found.append(dict(device_record(devices[i], kind, flat[k]), bearing=round(bearing, 1),
+                                  time=time, vehicle=vehicle))
+            alerts += sorted(found, key=lambda alert: alert["distance"])
+        return alerts
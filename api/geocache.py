@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Geocode cache
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+
+def normalize(address:str):
+    '''
+    Cache key for an address: case, commas and runs of whitespace don't matter
+    '''
+    return " ".join(address.lower().replace(",", " ").split())
+
+
+class GeocodeCache:
+    '''
+    Two-tier cache of address -> coordinates lookups
+
+    The first tier is an in-process LRU with a TTL; misses fall through to a SQLite file shared
+    by every process on the machine (CLI runs and gunicorn workers alike), and only misses in
+    both tiers need a Nominatim request. Only successful lookups are cached.
+    '''
+
+    def __init__(self, path:str=None, size:int=1024, ttl:float=30 * 24 * 3600, logger=logging.getLogger(__name__)):
+        """
+        :param path     str     SQLite file for the on-disk tier (None = memory only)
+        :param size     int     Max number of addresses kept in memory
+        :param ttl      float   Seconds a lookup stays valid in either tier
+        :param logger   logger  Logging object
+        """
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.logger = logger
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()   # key -> (coords, stored_at)
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        # Opened on first use; if the file can't be opened we carry on with the memory tier
+        if self._db is None and self.path:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS geocode "
+                           "(address TEXT PRIMARY KEY, lat REAL, lon REAL, stored_at REAL)")
+                db.commit()
+                self._db = db
+            except (OSError, sqlite3.Error) as e:
+                self.logger.error(f"geocache: can't use {self.path} ({e}), caching in memory only")
+                self.path = None
+        return self._db
+
+    def get(self, address:str):
+        '''
+        :param address  str     Address as typed by the user
+        :return         tuple   GPS coordinates (latitude, longitude), or None on a miss
+        '''
+        key = normalize(address)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            db = self._connect()
+            if db is not None:
+                try:
+                    row = db.execute("SELECT lat, lon, stored_at FROM geocode WHERE address = ?", (key,)).fetchone()
+                except sqlite3.Error as e:
+                    self.logger.error(f"geocache.get(): {e}")
+                    row = None
+                if row and now - row[2] < self.ttl:
+                    self._remember(key, (row[0], row[1]), row[2])
+                    self.disk_hits += 1
+                    return (row[0], row[1])
+
+            self.misses += 1
+            return None
+
+    def put(self, address:str, coords):
+        '''
+        :param address  str     Address as typed by the user
+        :param coords   tuple   GPS coordinates (latitude, longitude)
+        '''
+        key = normalize(address)
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, coords, now)
+            db = self._connect()
+            if db is not None:
+                try:
+                    db.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)", (key, coords[0], coords[1], now))
+                    db.commit()
+                except sqlite3.Error as e:
+                    self.logger.error(f"geocache.put(): {e}")
+
+    def _remember(self, key, coords, stored_at):
+        self._entries[key] = (coords, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        '''
+        Hit and miss counters for this process
+
+        :return     dict
+        '''
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+            "entries": len(self._entries),
+        }
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Geohash cells
+-------------------------------------------------------------------------------
+"""
+
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+DECODE = {char: value for value, char in enumerate(BASE32)}
+
+# Kilometres per degree of latitude (same earth radius the haversine package uses)
+KM_PER_DEGREE = 6371.0088 * math.pi / 180
+
+
+def cell_size(precision:int):
+    '''
+    Size of a geohash cell in degrees
+
+    :param precision    int     Number of geohash characters
+    :return             tuple   (degrees of latitude, degrees of longitude)
+    '''
+    bits = precision * 5
+    return 180.0 / (1 << (bits // 2)), 360.0 / (1 << ((bits + 1) // 2))
+
+
+def cell_of(lat:float, lon:float, precision:int):
+    '''
+    Row and column of the geohash cell containing a point
+
+    :param lat          float   Latitude
+    :param lon          float   Longitude
+    :param precision    int     Number of geohash characters
+    :return             tuple   (row, col) counted from the south-west corner of the globe
+    '''
+    bits = precision * 5
+    rows, cols = 1 << (bits // 2), 1 << ((bits + 1) // 2)
+    row = int((lat + 90.0) * rows / 180.0)
+    col = int((lon + 180.0) * cols / 360.0)
+    return min(max(row, 0), rows - 1), min(max(col, 0), cols - 1)
+
+
+def _spread(x:int):
+    '''
+    Bits of x moved to the even bit positions (bit k goes to bit 2k)
+    '''
+    return (_SPREAD[x & 0xff] | (_SPREAD[(x >> 8) & 0xff] << 16)
+            | (_SPREAD[(x >> 16) & 0xff] << 32) | (_SPREAD[(x >> 24) & 0xff] << 48))
+
+
+# Each byte with a zero bit inserted above every bit
+_SPREAD = [sum(((x >> k) & 1) << (2 * k) for k in range(8)) for x in range(256)]
+
+
+def encode_cell(row:int, col:int, precision:int):
+    '''
+    Geohash string of the cell at (row, col)
+
+    :param row          int     Latitude index of the cell
+    :param col          int     Longitude index of the cell
+    :param precision    int     Number of geohash characters (up to 12)
+    :return             str     Geohash
+    '''
+    # Bits alternate longitude, latitude from the top, and longitude gets the extra bit if there's an odd number
+    if precision * 5 % 2:
+        value = _spread(col) | (_spread(row) << 1)
+    else:
+        value = (_spread(col) << 1) | _spread(row)
+    return "".join([BASE32[(value >> shift) & 31] for shift in range(5 * precision - 5, -1, -5)])
+
+
+def encode(lat:float, lon:float, precision:int=7):
+    '''
+    Geohash string of the cell containing a point
+
+    :param lat          float   Latitude
+    :param lon          float   Longitude
+    :param precision    int     Number of geohash characters
+    :return             str     Geohash
+    '''
+    return encode_cell(*cell_of(lat, lon, precision), precision)
+
+
+def decode_cell(geohash:str):
+    '''
+    Row and column of a geohash string (inverse of encode_cell())
+
+    :param geohash      str     Geohash
+    :return             tuple   (row, col)
+    '''
+    value = 0
+    for char in geohash:
+        value = (value << 5) | DECODE[char]
+
+    row = col = 0
+    bits = len(geohash) * 5
+    for k in range(bits):
+        bit = (value >> (bits - 1 - k)) & 1
+        if k % 2 == 0:
+            col = (col << 1) | bit
+        else:
+            row = (row << 1) | bit
+    return row, col
+
+
+def decode(geohash:str):
+    '''
+    Centre point of a geohash cell
+
+    :param geohash      str     Geohash
+    :return             tuple   GPS coordinates of the cell centre (latitude, longitude)
+    '''
+    row, col = decode_cell(geohash)
+    dlat, dlon = cell_size(len(geohash))
+    return -90.0 + (row + 0.5) * dlat, -180.0 + (col + 0.5) * dlon
+
+
+def covering(lat:float, lon:float, radius:float, precision:int):
+    '''
+    Geohash cells covering the bounding box of a circle
+
+    :param lat          float   Latitude of the centre
+    :param lon          float   Longitude of the centre
+    :param radius       float   Radius of the circle (in kilometres)
+    :param precision    int     Number of geohash characters
+    :return             list    Geohash strings
+    '''
+    return [encode_cell(row, col, precision) for row, col in covering_cells(lat, lon, radius, precision)]
+
+
+def covering_cells(lat:float, lon:float, radius:float, precision:int):
+    '''
+    (row, col) of every cell covering the bounding box of a circle
+
+    :param lat          float   Latitude of the centre
+    :param lon          float   Longitude of the centre
+    :param radius       float   Radius of the circle (in kilometres)
+    :param precision    int     Number of geohash characters
+    :return             list    (row, col) tuples
+    '''
+    dlat = radius / KM_PER_DEGREE
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+
+    # Longitude degrees shrink towards the poles, so widen by the cosine of the worst latitude
+    cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+    dlon = 180.0 if cos_lat < 1e-9 else min(radius / (KM_PER_DEGREE * cos_lat), 180.0)
+
+    row_min, col_min = cell_of(south, lon - dlon, precision)
+    row_max, col_max = cell_of(north, lon + dlon, precision)
+    return [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
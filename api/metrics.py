@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Prometheus metrics
+-------------------------------------------------------------------------------
+"""
+
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# One file per process in the metrics directory
+FILE_PATTERN = "metrics-{pid}.json"
+
+STAGE_SECONDS = "driftkit_stage_seconds"
+REQUEST_SECONDS = "driftkit_request_seconds"
+REQUESTS = "driftkit_requests_total"
+UPSTREAM = "driftkit_upstream_responses_total"
+
+
+def _labels(labels:dict):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value:str):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(name:str, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return f"{name} {value}"
+
+
+def _alive(pid:int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear(directory:str):
+    '''
+    Remove every process's metrics file, so a restarted server starts counting from zero
+
+    :param directory    str     Metrics directory (nothing happens if it doesn't exist)
+    '''
+    for path in glob.glob(os.path.join(directory, FILE_PATTERN.format(pid="*"))):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Metrics:
+    '''
+    Counters, gauges and latency histograms in Prometheus' text format
+
+    Every gunicorn worker counts its own requests. With a directory, each process writes what
+    it has counted to its own file there, and render() adds those files up, so whichever worker
+    answers /metrics reports the whole server:
+        counters and histograms are summed over every file, including workers that have since
+        exited, so totals never go backwards while the server is running
+        gauges are the largest value among the workers that are still alive
+
+    Values that already live elsewhere (cache counters, dataset size) aren't copied on every
+    change; collectors registered with collect() are read whenever a snapshot is taken.
+    '''
+
+    def __init__(self, directory:str=None, buckets=BUCKETS):
+        """
+        :param directory    str     Where each process writes its metrics file (None for this process only)
+        :param buckets      tuple   Upper bounds of the histogram buckets (in seconds)
+        """
+        self.directory = directory
+        self.buckets = tuple(buckets)
+
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.describe(STAGE_SECONDS, "histogram", "Time spent in each stage of a request")
+        self.describe(REQUEST_SECONDS, "histogram", "Time to handle a request, until the response starts")
+        self.describe(REQUESTS, "counter", "Requests handled, by endpoint and status code")
+        self.describe(UPSTREAM, "counter", "Responses from data.edmonton.ca and Nominatim, by status code")
+
+    def describe(self, name:str, kind:str, help:str):
+        '''
+        :param name     str     Metric name
+        :param kind     str     "counter", "gauge" or "histogram"
+        :param help     str     One line description
+        '''
+        self._types[name] = (kind, help)
+
+    def inc(self, name:str, value:float=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name:str, value:float, **labels):
+        key = (name, _labels(labels))
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][slot] += 1
+            histogram[1] += value
+
+    @contextmanager
+    def timer(self, stage:str):
+        '''
+        Time the body of a with statement as one stage of a request
+
+        :param stage    str     Label for driftkit_stage_seconds (e.g. "geocode", "render")
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage)
+
+    def collect(self, callback):
+        '''
+        Register a function read whenever a snapshot is taken
+
+        :param callback     function    Returns an iterable of (name, labels:dict, value) for described metrics
+        '''
+        self._collectors.append(callback)
+
+    def snapshot(self):
+        '''
+        Everything this process has counted, in the form written to its metrics file
+
+        :return     dict
+        '''
+        counters, gauges = [], []
+        for callback in self._collectors:
+            for name, labels, value in callback():
+                kind = self._types[name][0]
+                (gauges if kind == "gauge" else counters).append([name, _labels(labels), value])
+
+        with self._lock:
+            counters += [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, list(counts), total]
+                          for (name, labels), (counts, total) in self._histograms.items()]
+
+        return {"pid": os.getpid(), "buckets": self.buckets, "counters": counters,
+                "gauges": gauges, "histograms": histograms}
+
+    def flush(self):
+        '''
+        Write this process's snapshot to the metrics directory
+
+        The file is replaced in one rename, so a worker rendering /metrics never reads half of it.
+        '''
+        if not self.directory:
+            return
+        snapshot = self.snapshot()
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(tmp, os.path.join(self.directory, FILE_PATTERN.format(pid=snapshot["pid"])))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def start(self, interval:float=5.0, logger=logging.getLogger(__name__)):
+        '''
+        Flush every `interval` seconds in a background thread, and once more when the process exits
+
+        Another worker's numbers in /metrics are at most `interval` seconds old.
+
+        :param interval     float       Seconds between flushes
+        :param logger       logger      Logging object
+        '''
+        if not self.directory or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval, logger), name="driftkit-metrics", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.flush()
+
+    def _run(self, interval, logger):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"metrics.flush(): {e}")
+
+    def _snapshots(self):
+        '''
+        This process's live snapshot and the last one written by every other process
+        '''
+        own = self.snapshot()
+        snapshots = [own]
+        if not self.directory:
+            return snapshots
+
+        for path in glob.glob(os.path.join(self.directory, FILE_PATTERN.format(pid="*"))):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get("pid") != own["pid"]:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        '''
+        Metrics from every process, added up, in Prometheus' text exposition format
+
+        :return     str
+        '''
+        own = os.getpid()
+        counters, gauges, histograms = {}, {}, {}
+
+        for snapshot in self._snapshots():
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+
+            # A worker that has exited no longer holds any data
+            if snapshot["pid"] == own or _alive(snapshot["pid"]):
+                for name, labels, value in snapshot["gauges"]:
+                    key = (name, tuple(map(tuple, labels)))
+                    gauges[key] = max(gauges.get(key, value), value)
+
+            # Files written with different buckets can't be added up
+            if tuple(snapshot["buckets"]) != self.buckets:
+                continue
+            for name, labels, counts, total in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+
+        # Lines are grouped by metric, and each series keeps its lines (e.g. buckets) in order
+        series = {}
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            series.setdefault(name, []).append((labels, [_format(name, labels, value)]))
+        for (name, labels), (counts, total) in histograms.items():
+            lines, cumulative = [], 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(_format(f"{name}_bucket", labels + (("le", str(bound)),), cumulative))
+            lines.append(_format(f"{name}_sum", labels, total))
+            lines.append(_format(f"{name}_count", labels, cumulative))
+            series.setdefault(name, []).append((labels, lines))
+
+        out = []
+        for name in sorted(series):
+            kind, help = self._types.get(name, ("untyped", ""))
+            out += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for _, lines in sorted(series[name]):
+                out += lines
+        return "\n".join(out) + "\n"
+
+
+# Shared by the webserver, the HTTP clients and the registry
+metrics = Metrics()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Sampling profiler
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+
+# Seconds between samples (100 a second by default)
+INTERVAL = float(os.environ.get('DRIFTKIT_PROFILE_INTERVAL', '0.01'))
+
+# Longest profile anyone can ask for
+MAX_SECONDS = float(os.environ.get('DRIFTKIT_PROFILE_MAX_SECONDS', '300'))
+
+# Written by whoever starts a profile, watched by every worker
+CONTROL_FILE = "profile.json"
+
+
+class Sampler:
+    '''
+    Periodically records the Python stack of every thread (or of a chosen few)
+
+    Nothing is hooked into the interpreter: a background thread reads sys._current_frames()
+    every `interval` seconds, so the profiled code runs at full speed between samples.
+    Stacks are kept as counts of identical stacks in the collapsed format flamegraph.pl,
+    speedscope and inferno read, one "root;...;leaf count" line per distinct stack.
+    '''
+
+    def __init__(self, interval:float=INTERVAL, threads:set=None):
+        """
+        :param interval     float   Seconds between samples
+        :param threads      set     Thread ids to sample (None for every thread)
+        """
+        self.interval = interval
+        self.threads = threads
+        self.stacks = Counter()
+        self.samples = 0
+
+        self._labels = {}
+        self._stop = threading.Event()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+        return label
+
+    def sample(self, ignore:int=None):
+        '''
+        Record the current stack of each sampled thread
+
+        :param ignore   int     Thread id to leave out (the sampling thread itself)
+        '''
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        threads = self.threads
+        for ident, frame in sys._current_frames().items():
+            if ident == ignore or (threads is not None and ident not in threads):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds:float):
+        '''
+        Sample from the calling thread for `seconds` (or until stop() is called)
+        '''
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample(ignore=me)
+            if self._stop.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop.set()
+
+    def write(self, path:str):
+        '''
+        Save the stacks in collapsed format
+
+        :param path     str     Output file, replaced in one rename
+        '''
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".profile-")
+        with os.fdopen(fd, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp, path)
+
+
+class Profiler:
+    '''
+    Profiles every worker pointed at the same directory, on request
+
+    start() writes a control file; each worker's watch() thread picks it up within a second and
+    samples for the time that is left, writing its own <id>-<pid>.collapsed file next to it.
+    With a fraction, only that share of the requests wrapped in enter()/leave() are sampled,
+    and only while they run; without one, every thread of the worker is.
+    '''
+
+    def __init__(self, directory:str=None, interval:float=INTERVAL):
+        """
+        :param directory    str     Where the control file and the profiles go (None to disable)
+        :param interval     float   Seconds between samples
+        """
+        self.directory = directory
+        self.interval = interval
+        self.sampler = None
+        self.fraction = None
+
+        self._thread = None
+
+    def start(self, seconds:float, fraction:float=None):
+        '''
+        Ask every worker to profile for `seconds`
+
+        :param seconds      float   How long to sample for (at most MAX_SECONDS)
+        :param fraction     float   Share of requests to sample (None to sample the whole worker)
+        :return             dict    The profile's id, end time and fraction
+        :raises             ValueError if the settings are out of range
+                            RuntimeError if a profile is already running
+        '''
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {MAX_SECONDS:g}")
+        if fraction is not None and not 0 < fraction <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+
+        current = self.control()
+        if current and current["until"] > time.time():
+            raise RuntimeError(f"profile {current['id']} is running until {current['until']:.0f}")
+
+        control = {"id": time.strftime("%Y%m%d-%H%M%S"), "until": time.time() + seconds, "fraction": fraction}
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".profile-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(control, f)
+        os.replace(tmp, os.path.join(self.directory, CONTROL_FILE))
+        return control
+
+    def control(self):
+        '''
+        :return     dict    The last profile asked for, or None
+        '''
+        try:
+            with open(os.path.join(self.directory, CONTROL_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def watch(self, poll:float=1.0, logger=logging.getLogger(__name__)):
+        '''
+        Check for new profiles every `poll` seconds in a background thread
+
+        :param poll     float       Seconds between checks of the control file
+        :param logger   logger      Logging object
+        '''
+        if not self.directory or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, args=(poll, logger), name="driftkit-profiler", daemon=True)
+        self._thread.start()
+
+    def _watch(self, poll, logger):
+        done = None
+        while True:
+            control = self.control()
+            if control and control["id"] != done and control["until"] > time.time():
+                done = control["id"]
+                try:
+                    self.run(control, logger=logger)
+                except Exception as e:
+                    logger.error(f"profiler.run(): {e}")
+            time.sleep(poll)
+
+    def run(self, control:dict, logger=logging.getLogger(__name__)):
+        '''
+        Sample this worker until the profile ends and write its file
+
+        :param control  dict        As returned by start()
+        :param logger   logger      Logging object
+        :return         str         Path of the collapsed stacks
+        '''
+        fraction = control.get("fraction")
+        sampler = Sampler(self.interval, threads=set() if fraction else None)
+        self.fraction, self.sampler = fraction, sampler
+        try:
+            sampler.run(control["until"] - time.time())
+        finally:
+            self.sampler = None
+
+        path = os.path.join(self.directory, f"{control['id']}-{os.getpid()}.collapsed")
+        sampler.write(path)
+        logger.info(f"profiler.run(): {sampler.samples} samples of {len(sampler.stacks)} stacks in {path}")
+        return path
+
+    def enter(self):
+        '''
+        Called as a request starts: while a per-request profile runs, sample this thread
+        for a `fraction` share of requests
+
+        :return     bool    True if this request is being sampled
+        '''
+        sampler = self.sampler
+        if sampler is None or sampler.threads is None or random.random() >= self.fraction:
+            return False
+        sampler.threads.add(threading.get_ident())
+        return True
+
+    def leave(self):
+        '''
+        Called as a request ends
+        '''
+        sampler = self.sampler
+        if sampler is not None and sampler.threads is not None:
+            sampler.threads.discard(threading.get_ident())
+
+
+# Shared by the webserver's workers
+profiler = Profiler()
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+In-process device registry
+-------------------------------------------------------------------------------
+"""
+
+import os
+import copy
+import time
+import fcntl
+import heapq
+import logging
+import operator
+import threading
+
+from api.metrics import metrics
+from api.device import direction_code, heading_direction
+from api.socrata import CAMERA_URL, TRAP_URL, CAMERA_COLUMNS, TRAP_COLUMNS, DatasetFeed, camera_from_row, trap_from_row
+from api.spatial import GeohashIndex
+from api.table import DeviceTable, write_table
+
+TABLE_FILE = "devices.table"
+INDEX_FILE = "devices.{kind}.index"
+KINDS = ("camera", "trap")
+LEADER_FILE = "leader.lock"
+WRITE_LOCK = "write.lock"
+
+
+class Snapshot:
+    '''
+    The camera and trap datasets and their indexes as of one fetch
+
+    A snapshot is built completely before it is published and never modified afterwards,
+    so a request holding one always sees a consistent set of devices
+    '''
+
+    def __init__(self, cameras, traps, precision:int=5, generation:int=0, loaded_at:float=None, indexes=None):
+        """
+        :param cameras      list    List of Camera() objects, or a TableView of them
+        :param traps        list    List of Trap() objects, or a TableView of them
+        :param precision    int     Geohash length of the spatial index buckets
+        :param generation   int     Number of snapshots published before this one
+        :param loaded_at    float   When the data was fetched (defaults to now)
+        :param indexes      dict    Prebuilt GeohashIndex for "camera" and/or "trap" (the rest are built)
+        """
+        indexes = indexes or {}
+        self.cameras = cameras if hasattr(cameras, "points") else tuple(cameras)
+        self.traps = traps if hasattr(traps, "points") else tuple(traps)
+        self.camera_index = indexes["camera"] if "camera" in indexes else \
+            GeohashIndex(_points(self.cameras), precision, directions=_directions(self.cameras))
+        self.trap_index = indexes["trap"] if "trap" in indexes else \
+            GeohashIndex(_points(self.traps), precision, directions=_directions(self.traps))
+        self.generation = generation
+        self.loaded_at = loaded_at or time.time()
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+    def datasets(self):
+        return (("camera", self.cameras, self.camera_index), ("trap", self.traps, self.trap_index))
+
+    def save_indexes(self, directory:str):
+        '''
+        Write both spatial indexes to INDEX_FILE in directory, for load_indexes() in other processes
+        '''
+        for kind, _, index in self.datasets():
+            index.save(os.path.join(directory, INDEX_FILE.format(kind=kind)), generation=self.generation)
+
+
+def load_indexes(directory:str, generation:int, precision:int=5, logger=logging.getLogger(__name__)):
+    '''
+    Spatial indexes saved by Snapshot.save_indexes() for a generation
+
+    :return     dict    kind -> GeohashIndex for every index that could be read (missing ones get rebuilt)
+    '''
+    indexes = {}
+    for kind in KINDS:
+        path = os.path.join(directory, INDEX_FILE.format(kind=kind))
+        try:
+            indexes[kind] = GeohashIndex.load(path, precision=precision, generation=generation)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"registry.load_indexes(): {e}")
+    return indexes
+
+
+def _points(devices):
+    # Table views read coordinates from their columns without building every device
+    if hasattr(devices, "points"):
+        return devices.points()
+    return [device.coords for device in devices]
+
+
+def _directions(devices):
+    if hasattr(devices, "directions"):
+        return devices.directions()
+    return [direction_code(device.direction) for device in devices]
+
+
+class DeviceRegistry:
+    '''
+    Holds the full camera and trap datasets in memory and answers radius queries locally,
+    so a web search doesn't have to ask data.edmonton.ca for within_circle() every time
+
+    A background thread (start()) re-fetches the datasets and swaps in a new Snapshot;
+    if a fetch fails the previous snapshot keeps serving. Fetches go through DatasetFeeds,
+    so a refresh where nothing changed upstream is a pair of 304s and no rebuild.
+
+    Given a shared directory, start() elects one process per directory as the leader (an
+    flock on LEADER_FILE). Only the leader fetches; it writes each new snapshot to a
+    memory-mapped DeviceTable that the other processes pick up along with its spatial
+    indexes, so gunicorn workers share one copy of the data and one fetch schedule.
+    '''
+
+    def __init__(self, precision:int=5):
+        """
+        :param precision    int     Geohash length of the spatial index buckets
+        """
+        self.precision = precision
+        self.snapshot = None
+
+        self.camera_feed = DatasetFeed(CAMERA_URL, camera_from_row, columns=CAMERA_COLUMNS)
+        self.trap_feed = DatasetFeed(TRAP_URL, trap_from_row, columns=TRAP_COLUMNS)
+
+        # Outcome of the most recent fetch, for status()
+        self.last_refresh = None
+        self.last_result = None
+        self.failures = 0
+
+        self.leader = False
+        self.snapshot_dir = None
+        self._followed = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ready(self):
+        return self.snapshot is not None
+
+    def load(self, logger=logging.getLogger(__name__)):
+        '''
+        Sync cameras and traps with the City of Edmonton API and publish a new snapshot if they changed
+
+        :param logger   logger      Logging object
+        :return         bool        True if the registry is up to date
+        '''
+        self.last_refresh = time.time()
+        try:
+            # Both feeds are synced even if the first one changed
+            with metrics.timer("sync"):
+                changed = [self.camera_feed.sync(logger=logger), self.trap_feed.sync(logger=logger)]
+        except Exception as e:
+            return self._failed(f"registry.load(): {e}", logger)
+
+        self.failures = 0
+        if not any(changed) and self.ready():
+            self.last_result = "not modified"
+            return True
+
+        cameras, traps = self.camera_feed.devices(), self.trap_feed.devices()
+        if not cameras and not traps:
+            return self._failed("registry.load(): got no devices from data.edmonton.ca", logger)
+
+        self.set_devices(cameras, traps)
+        self.last_result = "ok"
+        logger.info(f"registry.load(): indexed {len(cameras)} cameras and {len(traps)} traps")
+
+        if self.snapshot_dir:
+            self.save(self.snapshot_dir, logger=logger)
+        return True
+
+    def _failed(self, message, logger):
+        self.last_result = message
+        self.failures += 1
+        logger.error(message)
+        return False
+
+    def ensure_loaded(self, logger=logging.getLogger(__name__)):
+        '''
+        Load the datasets on first use; concurrent callers wait for the one doing the fetch
+
+        :param logger   logger      Logging object
+        :return         bool        True if the registry can answer queries
+        '''
+        if not self.ready():
+            with self._lock:
+                if not self.ready():
+                    self.load(logger=logger)
+        return self.ready()
+
+    def set_devices(self, cameras, traps):
+        '''
+        Publish a snapshot of already-built devices (used by load() and tests)
+
+        :param cameras  list    List of Camera() objects
+        :param traps    list    List of Trap() objects
+        '''
+        generation = self.snapshot.generation + 1 if self.snapshot else 0
+
+        # Build everything first, then publish with a single assignment
+        self.snapshot = Snapshot(cameras, traps, precision=self.precision, generation=generation)
+
+    def start(self, interval:float, logger=logging.getLogger(__name__), directory:str=None):
+        '''
+        Start refreshing the datasets in a background thread (does nothing if already running)
+
+        :param interval     float       Seconds between fetches (0 disables refreshing)
+        :param logger       logger      Logging object
+        :param directory    str         Directory shared with other processes (None = fetch alone)
+        '''
+        with self._lock:
+            if interval <= 0 or (self._thread and self._thread.is_alive()):
+                return
+            self._stop.clear()
+            if directory:
+                target, args = self._run_shared, (interval, logger, directory)
+            else:
+                target, args = self._run, (interval, logger)
+            self._thread = threading.Thread(target=target, args=args, name="driftkit-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, interval, logger):
+        while not self._stop.is_set():
+            self.load(logger=logger)
+
+            # Retry sooner while we have nothing to serve
+            self._stop.wait(interval if self.ready() else min(interval, 30))
+
+    def _run_shared(self, interval, logger, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, TABLE_FILE)
+        next_load = 0
+
+        with open(os.path.join(directory, LEADER_FILE), "a") as lock:
+            while not self._stop.is_set():
+                # Whoever holds the lock keeps it until it exits, then another process takes over
+                if not self.leader:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self.leader = True
+                        logger.info(f"registry: pid {os.getpid()} is fetching for {directory}")
+
+                        # Carry on from the last leader's table so generations keep increasing
+                        self.follow(path, logger=logger)
+                    except BlockingIOError:
+                        pass
+
+                if self.leader and time.time() >= next_load:
+                    written = self.snapshot.generation if self.snapshot else None
+                    self.load(logger=logger)
+                    if self.snapshot and self.snapshot.generation != written:
+                        self.save(directory, logger=logger)
+                    next_load = time.time() + (interval if self.ready() else min(interval, 30))
+                elif not self.leader:
+                    self.follow(path, logger=logger)
+
+                self._stop.wait(min(interval, 5))
+
+    def save(self, directory:str, logger=logging.getLogger(__name__)):
+        '''
+        Write the current snapshot's table and spatial indexes to directory, for follow()
+
+        :param directory    str         Destination directory (created if needed)
+        :param logger       logger      Logging object
+        :return             bool        True if the snapshot was written
+        '''
+        snapshot = self.snapshot
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, WRITE_LOCK), "a") as lock:
+                # Readers hold a shared lock, so they never pair a table with another snapshot's indexes
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshot.save_indexes(directory)
+                write_table(os.path.join(directory, TABLE_FILE), snapshot.cameras, snapshot.traps,
+                            generation=snapshot.generation, created=snapshot.loaded_at)
+        except OSError as e:
+            logger.error(f"registry.save(): can't write to {directory} ({e})")
+            return False
+        return True
+
+    def persist(self, directory:str, logger=logging.getLogger(__name__)):
+        '''
+        Keep snapshots in directory across restarts: publish the one saved there, if any, and
+        save every snapshot load() publishes from now on
+
+        Lets the CLI and new workers answer straight away (or with no network at all) from the
+        last data they saw while a fresh copy is fetched in the background
+
+        :param directory    str         Snapshot directory
+        :param logger       logger      Logging object
+        :return             bool        True if a saved snapshot was published
+        '''
+        self.snapshot_dir = directory
+        if not self.follow(os.path.join(directory, TABLE_FILE), logger=logger):
+            return False
+        self.last_result = f"restored from {directory}"
+        logger.info(f"registry: restored generation {self.snapshot.generation} from {directory}")
+        return True
+
+    def follow(self, path:str, logger=logging.getLogger(__name__)):
+        '''
+        Publish the table at path if it was replaced since we last read it
+
+        :param path     str         Table file written by save()
+        :param logger   logger      Logging object
+        :return         bool        True if a new snapshot was published
+        '''
+        directory = os.path.dirname(path)
+        try:
+            stat = os.stat(path)
+            if (stat.st_ino, stat.st_mtime_ns) == self._followed:
+                return False
+            with open(os.path.join(directory, WRITE_LOCK), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                stat = os.stat(path)
+                table = DeviceTable(path)
+                indexes = load_indexes(directory, table.generation, precision=self.precision, logger=logger)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.error(f"registry.follow(): {e}")
+            return False
+
+        # Tables are replaced atomically, so a new inode is always a new table. Older generations
+        # (a shared table left over from before a restart) are skipped so we never go backwards.
+        self._followed = (stat.st_ino, stat.st_mtime_ns)
+        if self.snapshot and table.generation < self.snapshot.generation:
+            return False
+        self.snapshot = Snapshot(table.cameras, table.traps, precision=self.precision,
+                                 generation=table.generation, loaded_at=table.created, indexes=indexes)
+        self.last_refresh = time.time()
+        self.last_result = "ok"
+        return True
+
+    def status(self):
+        '''
+        Age and size of the current snapshot and the outcome of the last fetch
+
+        :return     dict
+        '''
+        snapshot = self.snapshot
+        return {
+            "ready": snapshot is not None,
+            "generation": snapshot.generation if snapshot else None,
+            "age": round(snapshot.age(), 1) if snapshot else None,
+            "cameras": len(snapshot.cameras) if snapshot else 0,
+            "traps": len(snapshot.traps) if snapshot else 0,
+            "last_refresh": self.last_refresh,
+            "last_result": self.last_result,
+            "failures": self.failures,
+            "skipped_rows": self.camera_feed.skipped + self.trap_feed.skipped,
+            "leader": self.leader,
+        }
+
+    def load_cameras(self, coords, radius):
+        '''
+        Local equivalent of server.load_cameras()
+
+        :param coords       tuple       GPS coordinates of the user (lat:float, lon:float)
+        :param radius       str/int     Search radius (in metres)
+        :return             list        Camera() objects with their distance already set
+        '''
+        snapshot = self.snapshot
+        return self._within(snapshot.cameras, snapshot.camera_index, coords, radius)
+
+    def load_traps(self, coords, radius):
+        '''
+        Local equivalent of server.load_traps()
+
+        :param coords       tuple       GPS coordinates of the user (lat:float, lon:float)
+        :param radius       str/int     Search radius (in metres)
+        :return             list        Trap() objects with their distance already set
+        '''
+        snapshot = self.snapshot
+        return self._within(snapshot.traps, snapshot.trap_index, coords, radius)
+
+    def nearest(self, coords, k:int, radius=None, kinds=KINDS, heading:float=None):
+        '''
+        The k cameras and/or traps closest to coords, without a distance for every device
+
+        :param coords       tuple       GPS coordinates of the user (lat:float, lon:float)
+        :param k            int         Number of devices to return
+        :param radius       str/int     Search radius (in metres, None = no limit)
+        :param kinds        tuple       Any of "camera", "trap"
+        :param heading      float       Only devices facing traffic on this compass heading (None = all)
+        :return             list        Camera() and Trap() objects with their distance set, closest first
+        '''
+        nearest = []
+        for d, _, devices, i in self.search(coords, radius=radius, kinds=kinds, k=k, heading=heading):
+            device = copy.copy(devices[i])
+            device.distance = d
+            nearest.append(device)
+        return nearest
+
+    def search(self, coords, radius=None, kinds=KINDS, k:int=None, snapshot:Snapshot=None, heading:float=None):
+        '''
+        Devices around coords, closest first, as positions in the snapshot (nothing is copied)
+
+        With a heading, only devices that enforce traffic travelling in the direction closest to
+        it (or that don't say which way they face) are returned
+
+        :param coords       tuple       GPS coordinates of the user (lat:float, lon:float)
+        :param radius       str/int     Search radius (in metres, None = no limit)
+        :param kinds        tuple       Any of "camera", "trap"
+        :param k            int         Only the k closest (None = every device in the radius)
+        :param snapshot     Snapshot    Snapshot to search (defaults to the current one)
+        :param heading      float       Compass heading of the user in degrees (None = any direction)
+        :return             list        (distance in km, kind, device sequence, position) tuples
+        '''
+        snapshot = snapshot or self.snapshot
+        radius = float(radius) / 1000 if radius else None
+        direction = heading_direction(heading) if heading is not None else 0
+
+        found = []
+        for kind, devices, index in snapshot.datasets():
+            if kind not in kinds:
+                continue
+            if k is not None or radius is None:
+                matches = index.nearest(coords, len(devices) if k is None else k, radius=radius, direction=direction)
+            else:
+                matches = index.within(coords, radius, direction=direction)
+            found.extend((d, kind, devices, i) for i, d in matches)
+
+        by_distance = operator.itemgetter(0)
+        return heapq.nsmallest(k, found, key=by_distance) if k is not None else sorted(found, key=by_distance)
+
+    def corridor(self, route, buffer, kinds=KINDS, snapshot:Snapshot=None):
+        '''
+        Devices within a buffer of a route, in the order a driver reaches them
+
+        :param route        list        GPS coordinates of the route's vertices (lat:float, lon:float)
+        :param buffer       str/int     Max distance from the route (in metres)
+        :param kinds        tuple       Any of "camera", "trap"
+        :param snapshot     Snapshot    Snapshot to search (defaults to the current one)
+        :return             list        (km along the route, km from the route, kind, device sequence, position) tuples
+        '''
+        snapshot = snapshot or self.snapshot
+        found = []
+        for kind, devices, index in snapshot.datasets():
+            if kind in kinds:
+                found.extend((along, offset, kind, devices, i) for i, along, offset in index.corridor(route, float(buffer) / 1000))
+        found.sort(key=operator.itemgetter(0, 1))
+        return found
+
+    def _within(self, devices, index, coords, radius):
+        # Devices are shared between threads, so hand out copies that each request can refresh
+        found = []
+        for i, distance in index.within(coords, float(radius) / 1000):
+            device = copy.copy(devices[i])
+            device.distance = distance
+            found.append(device)
+        return found
+
+
+# Shared by every request handled by this process
+registry = DeviceRegistry()
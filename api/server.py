@@ -22,12 +22,31 @@ API functionality
 -------------------------------------------------------------------------------
 """
 
-import requests
+import os
+import json
+import base64
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from api.device import Camera, Trap
-from api.cli import CAMERA_URL, TRAP_URL
+# orjson is optional, the standard library encoder is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from api import client
+from api.socrata import CAMERA_URL, TRAP_URL, CAMERA_COLUMNS, TRAP_COLUMNS, camera_from_row, trap_from_row, fetch_devices
+
+
+# Seconds a web request waits for data.edmonton.ca before answering with what it has
+FETCH_DEADLINE = float(os.environ.get('DRIFTKIT_FETCH_DEADLINE', '5'))
+
+# Compact separators, and leave the 📷/🪤 icons as UTF-8
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+# Two fetches (cameras and traps) per request thread
+_fetch_pool = ThreadPoolExecutor(max_workers=2 * client.POOL_SIZE, thread_name_prefix="driftkit-fetch")
 
 
 def load_cameras(coords, radius, logger=logging.getLogger(__name__)):
@@ -38,27 +57,8 @@ def load_cameras(coords, radius, logger=logging.getLogger(__name__)):
     :param radius       str/int     Search radius (in metres)
     :param logger       logger      Logging object
     '''
-
-    cameras = []
-
-    url = f"{CAMERA_URL}?$where=within_circle(geo_location, {coords[0]}, {coords[1]}, {radius})"
-    response = requests.get(url)
-
-    if response.status_code == 200:        
-        for camera in response.json():
-            cameras.append(
-                Camera(
-                    site_id   = camera['site_id'],
-                    speed     = int(camera['posted_speed'].split(" ")[0]),
-                    direction = camera['travel_direction'],
-                    location  = "{} {}".format(camera['approach'], camera['cross_street']),
-                    coords    = (float(camera['latitude']), float(camera['longitude'])),
-                ))
-    else:
-        logger.error(f"server.load_cameras(): got {response.status_code} from data.edmonton.ca")
-        logger.error(response.text)
-
-    return cameras
+    where = {"$where": f"within_circle(geo_location, {coords[0]}, {coords[1]}, {radius})"}
+    return fetch_devices(CAMERA_URL, camera_from_row, CAMERA_COLUMNS, params=where, logger=logger)
 
 
 def load_traps(coords, radius, logger=logging.getLogger(__name__)):
@@ -69,25 +69,107 @@ def load_traps(coords, radius, logger=logging.getLogger(__name__)):
     :param radius       str/int     Search radius (in metres)
     :param logger       logger      Logging object
     '''
+    where = {"$where": f"within_circle(geo_location, {coords[0]}, {coords[1]}, {radius})"}
+    return fetch_devices(TRAP_URL, trap_from_row, TRAP_COLUMNS, params=where, logger=logger)
+
+
+def load_devices(coords, radius, deadline=FETCH_DEADLINE, logger=logging.getLogger(__name__)):
+    '''
+    Fetch cameras and traps at the same time, so a request costs the slower of the two
+    instead of both. Whatever hasn't arrived by the deadline is left out.
+
+    :param coords       tuple       GPS coordinates of the user (lat:float, lon:float)
+    :param radius       str/int     Search radius (in metres)
+    :param deadline     float       Seconds to wait for both fetches
+    :param logger       logger      Logging object
+    :return             list        Camera() and Trap() objects (unsorted)
+    '''
+    futures = {
+        _fetch_pool.submit(load_cameras, coords, radius, logger): "cameras",
+        _fetch_pool.submit(load_traps, coords, radius, logger): "traps",
+    }
+    done, late = wait(futures, timeout=deadline)
+
+    devices = []
+    for future in done:
+        try:
+            devices += future.result()
+        except Exception as e:
+            logger.error(f"server.load_devices(): couldn't load {futures[future]} ({e})")
+
+    # Late fetches finish in the background (bounded by the client timeout) and are dropped
+    for future in late:
+        future.cancel()
+        logger.warning(f"server.load_devices(): no {futures[future]} after {deadline}s, returning partial results")
+
+    return devices
+
+
+
+def dumps(obj):
+    '''
+    Serialize to JSON bytes with the fastest encoder available
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _encoder.encode(obj).encode("utf-8")
+
+
+def device_record(device, kind:str, distance:float):
+    '''
+    JSON-ready dict for one device
 
-    traps = []
+    :param device       Device      Camera() or Trap() object
+    :param kind         str         "camera" or "trap"
+    :param distance     float       Distance from the user (in kilometres)
+    '''
+    lat, lon = device.coords
+    return {
+        "kind": kind,
+        "site_id": device.site_id,
+        "speed": device.speed,
+        "direction": device.direction,
+        "location": device.location,
+        "lat": lat,
+        "lon": lon,
+        "distance": round(distance, 4),
+    }
+
+
+def encode_cursor(generation:int, offset:int):
+    '''
+    Opaque pagination cursor: where the next page starts, and in which dataset snapshot
+    '''
+    return base64.urlsafe_b64encode(f"{generation}:{offset}".encode()).decode().rstrip("=")
 
-    url = f"{TRAP_URL}?$where=within_circle(geo_location, {coords[0]}, {coords[1]}, {radius})"
-    response = requests.get(url)
 
-    if response.status_code == 200:
+def decode_cursor(cursor:str):
+    '''
+    :return     tuple   (generation, offset)
+    :raises     ValueError if the cursor wasn't made by encode_cursor()
+    '''
+    try:
+        generation, offset = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        generation, offset = int(generation), int(offset)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid cursor {cursor!r}") from e
+    if offset < 0:
+        raise ValueError(f"invalid cursor {cursor!r}")
+    return generation, offset
+
 
-        for trap in response.json():
-            traps.append(
-                Trap(
-                    site_id   = trap['site_id'],
-                    speed     = int(trap['speed_limit']),
-                    direction = trap['location_description'][0:2],
-                    location  = trap['location_description'][3:],
-                    coords    = (float(trap['latitude']), float(trap['longitude'])),
-                ))
-    else:
-        logger.error(f"server.load_traps(): got {response.status_code} from data.edmonton.ca")
-        logger.error(response.text)
+def stream_devices(matches, generation:int, batch:int=500):
+    '''
+    Yield a JSON document of matches a batch of devices at a time, so a city-wide response is
+    sent chunked instead of being built as one string
 
-    return traps
\ No newline at end of file
+    :param matches      list    (distance, kind, devices, position) tuples from DeviceRegistry.search()
+    :param generation   int     Snapshot generation the matches came from
+    :param batch        int     Devices per chunk
+    '''
+    yield f'{{"generation":{generation},"count":{len(matches)},"devices":['.encode()
+    for start in range(0, len(matches), batch):
+        records = [device_record(devices[i], kind, d) for d, kind, devices, i in matches[start:start + batch]]
+        chunk = dumps(records)[1:-1]
+        yield chunk if start == 0 else b"," + chunk
+    yield b"]}"
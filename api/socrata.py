@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Edmonton Open Data Portal (Socrata) datasets
+-------------------------------------------------------------------------------
+"""
+
+import os
+import re
+import json
+import codecs
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from api import client
+from api.device import Camera, Trap
+
+
+# API endpoints (DRIFTKIT_SOCRATA_URL points them at a mirror, e.g. benchmarks/standin.py)
+SOCRATA_URL = os.environ.get('DRIFTKIT_SOCRATA_URL', 'https://data.edmonton.ca').rstrip('/')
+CAMERA_URL = f"{SOCRATA_URL}/resource/7fnd-72gr.json"
+TRAP_URL = f"{SOCRATA_URL}/resource/akzz-54k3.json"
+
+# The only columns camera_from_row() and trap_from_row() read, so nothing else is downloaded
+CAMERA_COLUMNS = ("site_id", "posted_speed", "travel_direction", "approach", "cross_street", "latitude", "longitude")
+TRAP_COLUMNS = ("site_id", "speed_limit", "location_description", "latitude", "longitude")
+
+# Rows per request (Socrata stops at 1000 rows when a query doesn't give a $limit)
+PAGE_SIZE = int(os.environ.get('DRIFTKIT_PAGE_SIZE', '1000'))
+
+# Pages requested at once after the first one
+PAGE_WORKERS = int(os.environ.get('DRIFTKIT_PAGE_WORKERS', '4'))
+
+# Bytes read from the socket at a time, and the most characters one row may take
+READ_SIZE = 16 * 1024
+MAX_ROW = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER = re.compile(r"[-+0-9.eE]*")
+
+
+def camera_from_row(camera:dict):
+    '''
+    Build a Camera() from one row of the intersection camera dataset
+    '''
+    return Camera(
+        site_id   = camera['site_id'],
+        speed     = int(camera['posted_speed'].split(" ")[0]),
+        direction = camera['travel_direction'],
+        location  = "{} {}".format(camera['approach'], camera['cross_street']),
+        coords    = (float(camera['latitude']), float(camera['longitude'])),
+    )
+
+
+def trap_from_row(trap:dict):
+    '''
+    Build a Trap() from one row of the speed trap zone dataset
+    '''
+    return Trap(
+        site_id   = trap['site_id'],
+        speed     = int(trap['speed_limit']),
+        direction = trap['location_description'][0:2],
+        location  = trap['location_description'][3:],
+        coords    = (float(trap['latitude']), float(trap['longitude'])),
+    )
+
+
+def iter_rows(chunks):
+    '''
+    Parse a JSON array incrementally, yielding each element as soon as it has arrived
+
+    Only the element being parsed and the unread rest of the current chunk are held,
+    so a whole dataset never has to be in memory as text or as one list
+
+    :param chunks   iterable    Bytes of the body as they arrive (response.iter_content())
+    :return         generator   Elements of the array, usually row dicts
+    :raises         ValueError if the body isn't a JSON array, or an element is bigger than MAX_ROW
+    '''
+    chunks = iter(chunks)
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos = "", 0
+    expect = "["            # "[", then "value or ]" after it, then ", or ]" after each value
+
+    def more():
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer, pos = buffer[pos:] + text.decode(chunk), 0
+        return True
+
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if not more():
+                raise ValueError("JSON array ended early")
+            continue
+
+        char = buffer[pos]
+        if expect == "[":
+            if char != "[":
+                raise ValueError(f"expected a JSON array, got {buffer[pos:pos + 20]!r}")
+            pos, expect = pos + 1, "value or ]"
+        elif char == "]" and expect != "value":
+            return
+        elif expect == ", or ]":
+            if char != ",":
+                raise ValueError(f"expected , or ] in JSON array, got {buffer[pos:pos + 20]!r}")
+            pos, expect = pos + 1, "value"
+        else:
+            # A number running to the end of the chunk may go on in the next one ("1." then "5e10"),
+            # so it's only parsed once something follows it, or the body has ended
+            if char in "-0123456789" and _NUMBER.match(buffer, pos).end() == len(buffer) and more():
+                continue
+            try:
+                row, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # Most likely the row goes on in the next chunk
+                if len(buffer) - pos > MAX_ROW or not more():
+                    raise ValueError(f"invalid JSON in array ({e})") from e
+                continue
+            pos, expect = end, ", or ]"
+            yield row
+
+
+class RowDecoder:
+    '''
+    Turns rows into devices (or anything else) as they are parsed, skipping rows that can't be
+
+    A row that is missing a column or has a value of the wrong kind is counted in `skipped`
+    and left out, so one bad row doesn't lose the rest of the dataset. The same decoder can
+    be used by several pages at once.
+    '''
+
+    def __init__(self, parse, logger=logging.getLogger(__name__)):
+        """
+        :param parse    function    Builds an item from one row (camera_from_row, trap_from_row)
+        :param logger   logger      Logging object
+        """
+        self.parse = parse
+        self.logger = logger
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, rows):
+        '''
+        :param rows     iterable    Rows, e.g. from iter_rows()
+        :return         generator   parse(row) for every row that could be parsed
+        '''
+        for row in rows:
+            try:
+                item = self.parse(row)
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+                with self._lock:
+                    self.skipped += 1
+                self.logger.debug(f"socrata.RowDecoder(): skipping row {str(row)[:200]} ({e!r})")
+                continue
+            yield item
+
+
+def read_page(response, decode=None):
+    '''
+    Parse a response's rows straight off the socket
+
+    :param response     Response    Successful response, made with stream=True
+    :param decode       function    Applied to the rows as they are parsed (e.g. a RowDecoder)
+    :return             tuple       (decoded items, number of rows in the page)
+    '''
+    count = 0
+
+    def rows():
+        nonlocal count
+        for row in iter_rows(response.iter_content(chunk_size=READ_SIZE)):
+            count += 1
+            yield row
+
+    try:
+        items = list(decode(rows()) if decode else rows())
+    finally:
+        response.close()
+    return items, count
+
+
+def get_page(url:str, params:dict, offset:int, decode=None):
+    '''
+    One page of a query
+
+    :param url      str         Socrata resource endpoint
+    :param params   dict        SoQL parameters, including $order and $limit
+    :param offset   int         Rows to skip
+    :param decode   function    Applied to the rows as they are parsed (e.g. a RowDecoder)
+    :return         tuple       (decoded items, number of rows in the page)
+    :raises         requests.RequestException on network errors or an unexpected status code
+    '''
+    response = client.get(url, params=dict(params, **{"$offset": offset}), stream=True)
+    response.raise_for_status()
+    return read_page(response, decode)
+
+
+def get_pages(url:str, params:dict, start:int=0, workers:int=PAGE_WORKERS, decode=None):
+    '''
+    Every row of a query from `start` on, fetching up to `workers` pages at once
+
+    Pages are requested by $offset over a stable $order, so they can be fetched in any order.
+    The first page that comes back short marks the end of the query; nothing past it is requested.
+
+    :param url      str         Socrata resource endpoint
+    :param params   dict        SoQL parameters, including $order and $limit (the page size)
+    :param start    int         Offset of the first page
+    :param workers  int         Pages in flight at once
+    :param decode   function    Applied to each page's rows as they are parsed (e.g. a RowDecoder)
+    :return         list        Decoded items (or rows) in query order
+    :raises         requests.RequestException if any page fails
+    '''
+    size = int(params["$limit"])
+    pages = {}
+    end = None          # Offset of the first short page
+    offsets = iter(range(start, 2 ** 62, size))
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="driftkit-page")
+    try:
+        pending = {}
+        for _ in range(workers):
+            offset = next(offsets)
+            pending[pool.submit(get_page, url, params, offset, decode)] = offset
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = pending.pop(future)
+                pages[offset], count = future.result()
+                if count < size:
+                    end = offset if end is None else min(end, offset)
+                elif end is None:
+                    offset = next(offsets)
+                    pending[pool.submit(get_page, url, params, offset, decode)] = offset
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    items = []
+    for offset in sorted(pages):
+        if end is not None and offset > end:
+            break
+        items += pages[offset]
+    return items
+
+
+def fetch_all(url:str, columns, params:dict=None, page_size:int=PAGE_SIZE, workers:int=PAGE_WORKERS, decode=None):
+    '''
+    Every row of a dataset, only the given columns, a page at a time
+
+    The first page is requested on its own, since most queries (a within_circle() search)
+    fit in it; only when it comes back full do the rest go out `workers` at a time.
+
+    :param url          str         Socrata resource endpoint
+    :param columns      tuple       Columns to download (CAMERA_COLUMNS, TRAP_COLUMNS)
+    :param params       dict        Extra SoQL parameters, e.g. $where
+    :param page_size    int         Rows per request
+    :param workers      int         Pages in flight at once
+    :param decode       function    Applied to the rows as they are parsed (e.g. a RowDecoder)
+    :return             list        Decoded items, or rows as dicts
+    :raises             requests.RequestException on network errors or an unexpected status code
+    '''
+    params = dict(params or {}, **{"$select": ", ".join(columns), "$order": ":id", "$limit": page_size})
+    items, count = get_page(url, params, 0, decode)
+    if count < page_size:
+        return items
+    return items + get_pages(url, params, start=page_size, workers=workers, decode=decode)
+
+
+def fetch_devices(url:str, parse, columns, params:dict=None, logger=logging.getLogger(__name__)):
+    '''
+    Every device a query matches, built as the rows arrive; what every loader goes through
+
+    :param url      str         Socrata resource endpoint
+    :param parse    function    Builds a device from one row (camera_from_row, trap_from_row)
+    :param columns  tuple       Columns parse reads (CAMERA_COLUMNS, TRAP_COLUMNS)
+    :param params   dict        Extra SoQL parameters, e.g. a within_circle() $where
+    :param logger   logger      Logging object
+    :return         list        Devices (empty if the download failed)
+    '''
+    decoder = RowDecoder(parse, logger)
+    try:
+        devices = fetch_all(url, columns, params=params, decode=decoder)
+    except Exception as e:
+        logger.error(f"socrata.fetch_devices(): couldn't load {url} ({e})")
+        return []
+    if decoder.skipped:
+        logger.warning(f"socrata.fetch_devices(): skipped {decoder.skipped} malformed rows from {url}")
+    return devices
+
+
+class DatasetFeed:
+    '''
+    Local copy of a Socrata dataset kept in sync with conditional, incremental requests
+
+    After the first full download, sync() only asks for rows whose :updated_at is at or past
+    the newest one we have, and sends the ETag of the previous identical request so an
+    unchanged dataset costs a single 304 with no body to parse. Rows are keyed on Socrata's
+    :id so updates replace the old device. Deleted rows never show up in a delta, so every
+    full_sync_every syncs the whole dataset is downloaded again.
+
+    Only the columns the parser reads are requested, page_size rows at a time: the first page
+    is conditional, and if it comes back full the rest are fetched `workers` pages at once.
+    '''
+
+    def __init__(self, url:str, parse, full_sync_every:int=24, columns=None, page_size:int=PAGE_SIZE,
+                 workers:int=PAGE_WORKERS):
+        """
+        :param url              str         Socrata resource endpoint
+        :param parse            function    Builds a device from one row (camera_from_row, trap_from_row)
+        :param full_sync_every  int         Number of syncs between full downloads (0 = always incremental)
+        :param columns          tuple       Columns parse reads (None = every column)
+        :param page_size        int         Rows per request
+        :param workers          int         Pages in flight at once after the first
+        """
+        self.url = url
+        self.parse = parse
+        self.full_sync_every = full_sync_every
+        self.columns = columns
+        self.page_size = page_size
+        self.workers = workers
+
+        self.devices_by_id = {}
+        self.updated_by_id = {}     # :updated_at of each row we have
+        self.watermark = None       # Newest :updated_at seen
+        self.syncs = 0
+        self.skipped = 0            # Malformed rows left out of the last sync
+
+        # ETag of the last response and the query it answered
+        self._etag = None
+        self._etag_params = None
+
+    def devices(self):
+        return list(self.devices_by_id.values())
+
+    def sync(self, logger=logging.getLogger(__name__)):
+        '''
+        Bring the local copy up to date
+
+        :param logger   logger      Logging object
+        :return         bool        True if any devices were added, changed or removed
+        :raises         requests.RequestException on network errors or an unexpected status code
+        '''
+        full = self.watermark is None or (self.full_sync_every and self.syncs % self.full_sync_every == 0)
+        self.syncs += 1
+
+        params = {"$select": ", ".join((":id", ":updated_at") + tuple(self.columns or ("*",))),
+                  "$order": ":id", "$limit": self.page_size}
+        if not full:
+            params["$where"] = f":updated_at >= '{self.watermark}'"
+
+        headers = {}
+        if self._etag and params == self._etag_params:
+            headers["If-None-Match"] = self._etag
+
+        response = client.get(self.url, params=params, headers=headers, stream=True)
+
+        if response.status_code == 304:
+            response.close()
+            return False
+        response.raise_for_status()
+
+        decoder = RowDecoder(self._entry, logger)
+        entries, count = read_page(response, decoder)
+        if count >= self.page_size:
+            entries += get_pages(self.url, params, start=self.page_size, workers=self.workers, decode=decoder)
+        self._etag = response.headers.get("ETag")
+        self._etag_params = params
+
+        # A delta always brings back the rows at the watermark, and a full download every row,
+        # so only rows that are new or have a different :updated_at count as a change
+        devices_by_id = {} if full else dict(self.devices_by_id)
+        updated_by_id = {} if full else dict(self.updated_by_id)
+        changed = False
+        for key, device, updated_at in entries:
+            if key not in self.devices_by_id or self.updated_by_id.get(key) != updated_at:
+                changed = True
+            devices_by_id[key] = device
+            updated_by_id[key] = updated_at
+
+            if updated_at and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+
+        # Rows deleted upstream only go missing from a full download
+        if full and not changed:
+            changed = any(key not in devices_by_id for key in self.devices_by_id)
+
+        self.devices_by_id = devices_by_id
+        self.updated_by_id = updated_by_id
+        self.skipped = decoder.skipped
+        if decoder.skipped:
+            logger.warning(f"socrata.sync(): skipped {decoder.skipped} malformed rows from {self.url}")
+        logger.info(f"socrata.sync(): {len(entries)} rows from {self.url} ({'full' if full else 'delta'})")
+        return changed
+
+    def _entry(self, row:dict):
+        # (key, device, :updated_at) for one row; rows are keyed on :id when the query selected it
+        key = row.get(":id") or json.dumps(row, sort_keys=True)
+        return key, self.parse(row), row.get(":updated_at")
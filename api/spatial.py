@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Spatial index
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import math
+import heapq
+import struct
+from array import array
+
+from api import geohash, distance
+
+"""
+Index file layout (native byte order)
+
+    header      magic, version, byte order, generation, points, levels
+    lat         float64 x points
+    lon         float64 x points
+    order       uint32  x points    positions sorted by geohash at the finest level
+    then for every level, coarsest first
+        level   precision, cells
+        keys    ascii geohash x cells, back to back
+        starts  uint32 x (cells + 1), where each cell's run begins in order
+"""
+MAGIC = b"DKINDEX\0"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQQI")
+LEVEL = struct.Struct("<II")
+LITTLE_ENDIAN = 1 if sys.byteorder == "little" else 0
+
+# A radius query uses the finest level whose covering is at most this many cells
+MAX_COVERING = 16
+
+# No two points on the Earth are farther apart than this (in kilometres)
+HALF_CIRCUMFERENCE = 180 * geohash.KM_PER_DEGREE
+
+
+class GeohashIndex:
+    '''
+    Buckets points by geohash cell at a few resolutions, so a radius query only looks at the
+    cells around it whatever the size of the dataset
+
+    Points are sorted once by their geohash at the finest level. A geohash cell contains
+    every cell whose hash it prefixes, so each cell at every level is one contiguous run
+    of that order and a level is just a dict of cell -> (start, stop).
+
+    Points are referred to by their position in the sequence the index was built from,
+    so the same index can sit in front of a list of devices or a column of coordinates
+    '''
+
+    def __init__(self, points, precision:int=5, levels=(4, 5, 6, 7), directions=None):
+        """
+        :param points       list    GPS coordinates of every point (lat:float, lon:float)
+        :param precision    int     Base geohash length, always indexed (5 is roughly 5x3 km in Edmonton)
+        :param levels       tuple   Geohash lengths to index (precision is always included)
+        :param directions   list    Travel direction code of every point (device.direction_code(), None = all unknown)
+        """
+        self.precision = precision
+        self.lats, self.lons = distance.columns(points)
+        self.directions = array("B", directions if directions is not None else bytes(len(self.lats)))
+        self._bounds = {}       # level -> (row_min, row_max, col_min, col_max) of occupied cells, for nearest()
+
+        finest = max(max(levels), precision)
+        hashes = [geohash.encode(lat, lon, finest) for lat, lon in zip(self.lats, self.lons)]
+        self.order = array("I", sorted(range(len(hashes)), key=hashes.__getitem__))
+
+        self.levels = {}
+        for level in sorted(set(levels) | {precision}):
+            cells = {}
+            start = 0
+            for stop in range(1, len(self.order) + 1):
+                cell = hashes[self.order[start]][:level]
+                if stop == len(self.order) or hashes[self.order[stop]][:level] != cell:
+                    cells[cell] = (start, stop)
+                    start = stop
+            self.levels[level] = cells
+
+    def __len__(self):
+        return len(self.lats)
+
+    @property
+    def cells(self):
+        '''
+        Cells at the base precision, mapped to (start, stop) in order
+        '''
+        return self.levels[self.precision]
+
+    def cell(self, cell:str):
+        '''
+        Positions of the points in one cell of any indexed level
+
+        :param cell     str     Geohash
+        :return         array   Positions (empty if the cell has no points)
+        '''
+        span = self.levels[len(cell)].get(cell)
+        return self.order[span[0]:span[1]] if span else ()
+
+    def level_for(self, coords, radius:float):
+        '''
+        The finest indexed level that covers a circle in at most MAX_COVERING cells
+
+        :param coords   tuple   GPS coordinates of the centre (lat:float, lon:float)
+        :param radius   float   Radius of the circle (in kilometres)
+        '''
+        return next((level for level in sorted(self.levels, reverse=True)
+                     if self._covering_size(coords, radius, level) <= MAX_COVERING), min(self.levels))
+
+    def candidates(self, coords, radius:float):
+        '''
+        Positions of every point in the cells covering a circle (may include points outside it)
+
+        :param coords   tuple   GPS coordinates of the centre (lat:float, lon:float)
+        :param radius   float   Radius of the circle (in kilometres)
+        '''
+        level = self.level_for(coords, radius)
+        # A circle that needs more cells than the level has occupied is quicker to check point by point
+        if self._covering_size(coords, radius, level) > len(self.levels[level]):
+            yield from self.order
+            return
+        for cell in geohash.covering(coords[0], coords[1], radius, level):
+            yield from self.cell(cell)
+
+    def _covering_size(self, coords, radius, level):
+        '''
+        Roughly how many cells of a level cover a circle
+        '''
+        if not math.isfinite(radius):
+            raise ValueError(f"radius must be finite, not {radius}")
+        radius = min(radius, HALF_CIRCUMFERENCE)
+        cos_lat = max(math.cos(math.radians(min(abs(coords[0]) + radius / geohash.KM_PER_DEGREE, 90.0))), 1e-9)
+        dlat, dlon = geohash.cell_size(level)
+        rows = math.ceil(2 * radius / (dlat * geohash.KM_PER_DEGREE)) + 1
+        cols = math.ceil(2 * radius / (dlon * geohash.KM_PER_DEGREE * cos_lat)) + 1
+        return rows * cols
+
+    def facing(self, positions, direction:int):
+        '''
+        The positions whose travel direction is `direction` or unknown
+
+        :param positions    list    Positions of points
+        :param direction    int     Direction code (0 keeps every position)
+        :return             list    Matching positions, in the same order
+        '''
+        if not direction:
+            return positions
+        directions = self.directions
+        return [i for i in positions if directions[i] == direction or not directions[i]]
+
+    def within(self, coords, radius:float, direction:int=0):
+        '''
+        Positions and distances of every point inside a circle
+
+        :param coords       tuple   GPS coordinates of the centre (lat:float, lon:float)
+        :param radius       float   Radius of the circle (in kilometres)
+        :param direction    int     Only points with this travel direction code or none (0 = every point)
+        :return             list    (position, distance in kilometres) tuples, unordered
+        '''
+        positions = self.facing(list(self.candidates(coords, radius)), direction)
+        if not positions:
+            return []
+
+        # One vectorized pass over the candidates' coordinates, the exact check for cells on the edge
+        distances = distance.distances(coords, distance.take(self.lats, positions), distance.take(self.lons, positions))
+        return [(i, float(d)) for i, d in zip(positions, distances) if d <= radius]
+
+    def save(self, path:str, generation:int=0):
+        '''
+        Write the index to a file, so another process can load it instead of building it again
+
+        :param path         str     Destination file (replaced atomically)
+        :param generation   int     Snapshot generation the index was built for
+        '''
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, LITTLE_ENDIAN, generation, len(self), len(self.levels)))
+            f.write(self.lats.tobytes())
+            f.write(self.lons.tobytes())
+            f.write(self.order.tobytes())
+            f.write(self.directions.tobytes())
+            for level in sorted(self.levels):
+                cells = self.levels[level]
+                f.write(LEVEL.pack(level, len(cells)))
+                f.write("".join(cells).encode("ascii"))
+                f.write(array("I", [start for start, _ in cells.values()] + [len(self)]).tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path:str, precision:int=5, generation:int=None):
+        '''
+        Read an index written by save()
+
+        :param path         str     Index file
+        :param precision    int     Base geohash length (must be one of the saved levels)
+        :param generation   int     Snapshot generation the index must have been built for (None = any)
+        :raises             ValueError if the file is not a matching index this version can read
+        '''
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if len(data) < HEADER.size:
+            raise ValueError(f"{path} is not a spatial index")
+        magic, version, endian, saved_generation, points, levels = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or endian != LITTLE_ENDIAN:
+            raise ValueError(f"{path} is not a version {VERSION} spatial index for this machine")
+        if generation is not None and saved_generation != generation:
+            raise ValueError(f"{path} is for generation {saved_generation}, not {generation}")
+
+        def read(typecode, count):
+            nonlocal offset
+            column = array(typecode)
+            column.frombytes(data[offset:offset + column.itemsize * count])
+            offset += column.itemsize * count
+            return column
+
+        index = cls.__new__(cls)
+        index.precision = precision
+        index._bounds = {}
+
+        offset = HEADER.size
+        lats, lons = read("d", points), read("d", points)
+        numpy = distance.load_numpy()
+        index.lats, index.lons = (lats, lons) if numpy is None else \
+            (numpy.frombuffer(lats, dtype=numpy.float64), numpy.frombuffer(lons, dtype=numpy.float64))
+        index.order = read("I", points)
+        index.directions = read("B", points)
+
+        index.levels = {}
+        for _ in range(levels):
+            level, count = LEVEL.unpack_from(data, offset)
+            offset += LEVEL.size
+            keys = data[offset:offset + level * count].decode("ascii")
+            offset += level * count
+            starts = read("I", count + 1)
+            index.levels[level] = {keys[j * level:(j + 1) * level]: (starts[j], starts[j + 1]) for j in range(count)}
+
+        if precision not in index.levels:
+            raise ValueError(f"{path} has no level {precision}")
+        return index
+
+    def nearest(self, coords, k:int, radius:float=None, direction:int=0):
+        '''
+        Positions and distances of the k points closest to coords
+
+        Searches square rings of cells outwards from the cell holding coords and stops as soon
+        as nothing in an unsearched ring could beat the k-th best point found so far, so only
+        the points near the answer get a distance computed. Rings are made of cells at the
+        finest level whose occupied cells hold k points on average, so denser datasets
+        search smaller cells.
+
+        :param coords       tuple   GPS coordinates of the centre (lat:float, lon:float)
+        :param k            int     Number of points to return
+        :param radius       float   Ignore points farther than this (in kilometres, None = no limit)
+        :param direction    int     Only points with this travel direction code or none (0 = every point)
+        :return             list    (position, distance in kilometres) tuples, closest first
+        '''
+        if k <= 0 or not self.cells:
+            return []
+
+        level = next((level for level in sorted(self.levels, reverse=True) if len(self) >= k * len(self.levels[level])),
+                     min(self.levels))
+        if level not in self._bounds:
+            cells = [geohash.decode_cell(cell) for cell in self.levels[level]]
+            self._bounds[level] = (min(r for r, _ in cells), max(r for r, _ in cells),
+                                   min(c for _, c in cells), max(c for _, c in cells))
+        row_min, row_max, col_min, col_max = self._bounds[level]
+
+        row, col = geohash.cell_of(coords[0], coords[1], level)
+        dlat, dlon = geohash.cell_size(level)
+        heap = []   # (-distance, position) of the best k so far
+
+        ring = 0
+        while True:
+            positions = []
+            for r, c in _ring(row, col, ring):
+                if row_min <= r <= row_max and col_min <= c <= col_max:
+                    positions.extend(self.cell(geohash.encode_cell(r, c, level)))
+            positions = self.facing(positions, direction)
+
+            if positions:
+                distances = distance.distances(coords, distance.take(self.lats, positions), distance.take(self.lons, positions))
+                for i, d in zip(positions, distances):
+                    d = float(d)
+                    if radius is not None and d > radius:
+                        continue
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, i))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, i))
+
+            # Everything outside this ring is at least `reach` km away
+            edge = abs(coords[0]) + (ring + 1) * dlat
+            reach = ring * geohash.KM_PER_DEGREE * min(dlat, dlon * math.cos(math.radians(min(edge, 90.0))))
+            covered = row - ring <= row_min and row + ring >= row_max and col - ring <= col_min and col + ring >= col_max
+            if covered or (len(heap) == k and -heap[0][0] <= reach) or (radius is not None and reach > radius):
+                break
+            ring += 1
+
+        return [(i, -d) for d, i in sorted(heap, reverse=True)]
+
+    def corridor(self, route, buffer:float):
+        '''
+        Positions of every point within `buffer` of a polyline, and how far along it each one is
+
+        Each segment is cut into pieces about one cell long and only the cells around each piece
+        are searched, so a long route costs roughly its length in cells rather than one radius
+        query per vertex. Candidates are then measured against the segments that reached their
+        cell, in one vectorized pass per segment (see distance.to_segment()).
+
+        :param route    list    GPS coordinates of the polyline's vertices, in driving order
+        :param buffer   float   Max distance from the route (in kilometres)
+        :return         list    (position, km along the route, km from the route) tuples, ordered along the route
+        '''
+        route = [tuple(point) for point in route]
+        if not route or not len(self):
+            return []
+        if len(route) == 1:
+            return sorted(((i, 0.0, d) for i, d in self.within(route[0], buffer)), key=lambda match: match[2])
+
+        # Length of every segment and where along the route it starts
+        lengths = [distance.between(a, b) for a, b in zip(route, route[1:])]
+        starts = [0.0]
+        for length in lengths[:-1]:
+            starts.append(starts[-1] + length)
+
+        # Cells about as wide as the corridor: smaller ones mostly come back empty
+        level = self.level_for(route[0], 2 * buffer)
+        step = geohash.cell_size(level)[0] * geohash.KM_PER_DEGREE
+        cells_by_segment = []
+        for s, ((lat1, lon1), (lat2, lon2)) in enumerate(zip(route, route[1:])):
+            pieces = max(1, math.ceil(lengths[s] / step))
+            cells = set()
+            for p in range(pieces):
+                t = (p + 0.5) / pieces
+                middle = (lat1 + (lat2 - lat1) * t, lon1 + (lon2 - lon1) * t)
+                # A point within buffer of this piece is within this circle of its middle
+                reach = (lengths[s] / pieces / 2 + buffer) * 1.01
+                cells.update(geohash.covering_cells(middle[0], middle[1], reach, level))
+            cells_by_segment.append(cells)
+
+        # Each cell is looked up once, however many segments pass by it
+        positions_by_cell = {}
+        best = {}   # position -> (km along the route, km from the route)
+        for s, cells in enumerate(cells_by_segment):
+            positions = []
+            for cell in cells:
+                if cell not in positions_by_cell:
+                    positions_by_cell[cell] = self.cell(geohash.encode_cell(cell[0], cell[1], level))
+                positions.extend(positions_by_cell[cell])
+            if not positions:
+                continue
+
+            # One vectorized pass over the segment's candidates
+            offsets, ts = distance.to_segment(route[s], route[s + 1], distance.take(self.lats, positions),
+                                              distance.take(self.lons, positions))
+            for i, offset, t in zip(positions, offsets, ts):
+                if offset <= buffer and (i not in best or offset < best[i][1]):
+                    best[i] = (starts[s] + float(t) * lengths[s], float(offset))
+
+        found = [(i, along, offset) for i, (along, offset) in best.items()]
+        found.sort(key=lambda match: (match[1], match[2]))
+        return found
+
+
+def _ring(row, col, ring):
+    '''
+    (row, col) of the cells on the border of the square `ring` cells out from (row, col)
+    '''
+    if ring == 0:
+        yield row, col
+        return
+    for c in range(col - ring, col + ring + 1):
+        yield row - ring, c
+        yield row + ring, c
+    for r in range(row - ring + 1, row + ring):
+        yield r, col - ring
+        yield r, col + ring
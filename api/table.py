@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Memory-mapped device table
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+from array import array
+from collections.abc import Sequence
+
+from api.device import Camera, Trap, MAPPINGS, direction_code
+
+"""
+File layout (native byte order, every section starts on an 8 byte boundary)
+
+    header      magic, version, byte order, generation, created, rows, cameras, strings, blob size
+    lat         float64 x rows
+    lon         float64 x rows
+    speed       int32   x rows
+    kind        uint8   x rows      0 = camera, 1 = trap (cameras come first)
+    site_id     uint32  x rows      index into the string table
+    direction   uint32  x rows
+    location    uint32  x rows
+    offsets     uint32  x (strings + 1)
+    blob        utf-8 bytes of every distinct string, back to back
+"""
+MAGIC = b"DRIFTKIT"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQdQQQQ")
+LITTLE_ENDIAN = 1 if sys.byteorder == "little" else 0
+
+CAMERA, TRAP = 0, 1
+
+# Trap() maps abbreviations to full directions, so views need to go back the other way
+ABBREVIATIONS = {direction: abbreviation for abbreviation, direction in MAPPINGS.items()}
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _layout(rows, strings):
+    '''
+    Byte offset of every section for a table of the given size
+    '''
+    sections = (("lat", "d", rows), ("lon", "d", rows), ("speed", "i", rows), ("kind", "B", rows),
+                ("site_id", "I", rows), ("direction", "I", rows), ("location", "I", rows),
+                ("offsets", "I", strings + 1))
+    offsets = {}
+    offset = _align(HEADER.size)
+    for name, typecode, count in sections:
+        offsets[name] = (offset, typecode, count)
+        offset = _align(offset + array(typecode).itemsize * count)
+    offsets["blob"] = (offset, "B", None)
+    return offsets
+
+
+def write_table(path:str, cameras, traps, generation:int=0, created:float=None):
+    '''
+    Write cameras and traps to a table file, replacing any existing file atomically
+
+    Readers that already mapped the old file keep reading it until they open the new one
+
+    :param path         str     Destination file
+    :param cameras      list    List of Camera() objects
+    :param traps        list    List of Trap() objects
+    :param generation   int     Snapshot generation to record in the header
+    :param created      float   When the data was fetched (defaults to now)
+    '''
+    devices = list(cameras) + list(traps)
+    strings, blob, ends = {}, bytearray(), array("I", [0])
+
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(strings)
+            blob.extend(value.encode("utf-8"))
+            ends.append(len(blob))
+        return strings[value]
+
+    columns = {
+        "lat":       array("d", (d.coords[0] for d in devices)),
+        "lon":       array("d", (d.coords[1] for d in devices)),
+        "speed":     array("i", (d.speed for d in devices)),
+        "kind":      array("B", [CAMERA] * len(cameras) + [TRAP] * len(traps)),
+        "site_id":   array("I", (intern(str(d.site_id)) for d in devices)),
+        "direction": array("I", (intern(d.direction) for d in devices)),
+        "location":  array("I", (intern(d.location) for d in devices)),
+    }
+    columns["offsets"] = ends
+    layout = _layout(len(devices), len(strings))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, LITTLE_ENDIAN, generation, created or time.time(),
+                            len(devices), len(cameras), len(strings), len(blob)))
+        for name, (offset, _, _) in layout.items():
+            if name == "blob":
+                break
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(columns[name].tobytes())
+        f.write(b"\0" * (layout["blob"][0] - f.tell()))
+        f.write(blob)
+    os.replace(tmp, path)
+
+
+class DeviceTable:
+    '''
+    Read-only, memory-mapped view of a table file
+
+    The columns are memoryviews straight into the mapping, so every process that opens the
+    same file shares one copy of the data through the page cache. Camera() and Trap()
+    objects are only built for the rows a caller actually asks for.
+    '''
+
+    def __init__(self, path:str):
+        """
+        :param path     str     Table file written by write_table()
+        :raises         ValueError if the file is not a table this version can read
+        """
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is not a device table")
+        magic, version, endian, self.generation, self.created, self.rows, self.camera_count, strings, blob_size = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or endian != LITTLE_ENDIAN:
+            raise ValueError(f"{path} is not a version {VERSION} device table for this machine")
+
+        view = memoryview(self._map)
+        for name, (offset, typecode, count) in _layout(self.rows, strings).items():
+            if name == "blob":
+                self._blob = view[offset:offset + blob_size]
+            else:
+                setattr(self, name, view[offset:offset + array(typecode).itemsize * count].cast(typecode))
+
+        self.cameras = TableView(self, 0, self.camera_count)
+        self.traps = TableView(self, self.camera_count, self.rows)
+
+    def __len__(self):
+        return self.rows
+
+    def string(self, i:int):
+        return str(self._blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def device(self, i:int):
+        '''
+        Build the Camera() or Trap() stored in row i
+        '''
+        site_id, direction, location = self.string(self.site_id[i]), self.string(self.direction[i]), self.string(self.location[i])
+        coords = (self.lat[i], self.lon[i])
+
+        if self.kind[i] == CAMERA:
+            return Camera(site_id=site_id, speed=self.speed[i], direction=direction, location=location, coords=coords)
+        return Trap(site_id=site_id, speed=self.speed[i], direction=ABBREVIATIONS.get(direction, ""),
+                    location=location, coords=coords)
+
+
+class TableView(Sequence):
+    '''
+    Rows [start, stop) of a DeviceTable as a sequence of devices built on access
+    '''
+
+    def __init__(self, table:DeviceTable, start:int, stop:int):
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("table view index out of range")
+        return self.table.device(self.start + i)
+
+    def points(self):
+        '''
+        Coordinates of every row, read straight from the lat/lon columns
+        '''
+        lat, lon = self.table.lat, self.table.lon
+        return [(lat[i], lon[i]) for i in range(self.start, self.stop)]
+
+    def directions(self):
+        '''
+        Direction code of every row, decoding each distinct direction string once
+        '''
+        column, codes = self.table.direction, {}
+        for string in set(column[self.start:self.stop]):
+            codes[string] = direction_code(self.table.string(string))
+        return [codes[column[i]] for i in range(self.start, self.stop)]
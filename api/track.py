@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Live GPS tracks
+-------------------------------------------------------------------------------
+"""
+
+import json
+import math
+
+from api import distance, geohash
+from api.registry import KINDS
+from api.server import device_record
+
+# Moves shorter than this (in kilometres) don't change the heading worked out from the fixes
+MIN_MOVE = 0.01
+
+
+def parse_fix(line:str):
+    '''
+    One GPS fix from a line of a track: a JSON object with lat, lon and optionally heading,
+    time and vehicle, or "lat,lon[,heading[,time]]"
+
+    :param line     str     Line of a track (blank lines and lines starting with # are skipped)
+    :return         dict    {"lat", "lon", "heading", "time", "vehicle"}, or None for a skipped line
+    :raises         ValueError if the line isn't a fix
+    '''
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    if line.startswith("{"):
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid fix {line!r} ({e})") from e
+        if not isinstance(row, dict):
+            raise ValueError(f"invalid fix {line!r}")
+        values = [row.get("lat"), row.get("lon"), row.get("heading"), row.get("time")]
+        vehicle = row.get("vehicle")
+    else:
+        values = line.split(",") + [None, None]
+        vehicle = None
+
+    try:
+        lat, lon = float(values[0]), float(values[1])
+        heading = float(values[2]) % 360 if values[2] not in (None, "") else None
+        time = float(values[3]) if values[3] not in (None, "") else None
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid fix {line!r}") from e
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"invalid fix {line!r} (coordinates out of range)")
+    return {"lat": lat, "lon": lon, "heading": heading, "time": time, "vehicle": vehicle}
+
+
+class Tracker:
+    '''
+    Proximity alerts for one vehicle, fed one GPS fix at a time
+
+    The devices near the vehicle are gathered from the spatial index only when it moves into
+    another cell (or the registry publishes a new snapshot); every other fix just measures
+    those few candidates. A device raises one alert when it comes within `alert_distance`
+    inside the cone around the vehicle's heading, and can alert again once the vehicle has
+    got 1.5 times that far away from it.
+
+    The heading comes from the fix if it has one, otherwise from the last two fixes far enough
+    apart. Until there is a heading, every device within range alerts.
+    '''
+
+    def __init__(self, registry, alert_distance:float=0.5, cone:float=30.0, kinds=KINDS):
+        """
+        :param registry         DeviceRegistry  Loaded registry
+        :param alert_distance   float           Alert when a device gets this close (in kilometres)
+        :param cone             float           Max degrees between the heading and a device ahead
+        :param kinds            tuple           Any of "camera", "trap"
+        """
+        self.registry = registry
+        self.alert_distance = alert_distance
+        self.cone = cone
+        self.kinds = kinds
+
+        self.position = None
+        self.heading = None
+        self.fixes = 0
+
+        self.area = None            # (generation, level, row, col) the vehicle is in
+        self._candidates = []       # (kind, devices, position, lat, lon)
+        self._alerted = set()       # (kind, lat, lon), which stays the same across snapshots
+
+    def _gather(self, snapshot, lat, lon):
+        area = area_of(snapshot, lat, lon, self.alert_distance)
+        if area == self.area:
+            return
+        self._candidates = gather(snapshot, area, self.alert_distance, self.kinds)
+        self.enter(area, {(kind, dlat, dlon) for kind, _, _, dlat, dlon in self._candidates})
+
+    def enter(self, area, keys):
+        '''
+        Move the vehicle into another area, forgetting the alerts of devices it has left behind
+
+        :param area     tuple       Key from area_of()
+        :param keys     container   (kind, lat, lon) of every device gathered for the area
+        '''
+        self.area = area
+        # Devices left behind can alert again next time
+        self._alerted.intersection_update(keys)
+
+    def has_alerted(self, key):
+        '''
+        :param key      tuple   (kind, lat, lon) of a device
+        :return         bool    True if the device has alerted and isn't rearmed yet
+        '''
+        return key in self._alerted
+
+    def mark_alerted(self, key):
+        '''
+        :param key      tuple   (kind, lat, lon) of a device that has just alerted
+        '''
+        self._alerted.add(key)
+
+    def rearm(self, left_behind):
+        '''
+        Let the devices the vehicle has got far enough away from alert again
+
+        :param left_behind  function    Takes a (kind, lat, lon) key, True if the device can alert again
+        '''
+        if self._alerted:
+            self._alerted.difference_update([key for key in self._alerted if left_behind(key)])
+
+    def move(self, lat:float, lon:float, heading:float=None):
+        '''
+        Record a fix without looking for devices: the position, and the heading it gives
+
+        :param lat      float   Latitude of the fix
+        :param lon      float   Longitude of the fix
+        :param heading  float   Compass heading in degrees (None = work it out from the track)
+        '''
+        position = (lat, lon)
+        moved = self.position is None or distance.between(self.position, position) >= MIN_MOVE
+        if heading is not None:
+            self.heading = heading
+        elif self.position and moved:
+            self.heading = distance.bearing(self.position, position)
+        if heading is not None or moved:
+            self.position = position
+        self.fixes += 1
+
+    def update(self, lat:float, lon:float, heading:float=None, time:float=None):
+        '''
+        Move the vehicle and return the alerts it triggers
+
+        :param lat      float   Latitude of the fix
+        :param lon      float   Longitude of the fix
+        :param heading  float   Compass heading in degrees (None = work it out from the track)
+        :param time     float   Time of the fix, copied to the alerts
+        :return         list    JSON-ready dicts, one per device the vehicle is approaching
+        '''
+        position = (lat, lon)
+        self.move(lat, lon, heading)
+
+        snapshot = self.registry.snapshot
+        if snapshot is None:
+            return []
+        self._gather(snapshot, lat, lon)
+
+        # Flat-earth distances are plenty to rule out the candidates that are nowhere near
+        ky = geohash.KM_PER_DEGREE
+        kx = ky * math.cos(math.radians(lat))
+        far = (1.6 * self.alert_distance) ** 2
+
+        alerts = []
+        for kind, devices, i, dlat, dlon in self._candidates:
+            key = (kind, dlat, dlon)
+            if ((dlat - lat) * ky) ** 2 + ((dlon - lon) * kx) ** 2 > far:
+                self._alerted.discard(key)
+                continue
+            d = distance.between(position, (dlat, dlon))
+            if d > self.alert_distance:
+                if d > 1.5 * self.alert_distance:
+                    self._alerted.discard(key)
+                continue
+            if key in self._alerted:
+                continue
+
+            bearing = distance.bearing(position, (dlat, dlon))
+            if self.heading is not None and angle(bearing, self.heading) > self.cone:
+                continue
+
+            self._alerted.add(key)
+            alerts.append(dict(device_record(devices[i], kind, d), bearing=round(bearing, 1), time=time))
+
+        alerts.sort(key=lambda alert: alert["distance"])
+        return alerts
+
+
+def area_of(snapshot, lat:float, lon:float, alert_distance:float, level:int=None):
+    '''
+    The index cell a fix falls in, at a level about as big as the alert distance
+
+    :param level    int     Index level to use instead of working it out
+    :return         tuple   (generation, level, row, col), the key for gather()
+    '''
+    if level is None:
+        level = snapshot.camera_index.level_for((lat, lon), alert_distance)
+    row, col = geohash.cell_of(lat, lon, level)
+    return (snapshot.generation, level, row, col)
+
+
+def gather(snapshot, area, alert_distance:float, kinds=KINDS):
+    '''
+    Every device that a fix anywhere in an area could be within the alert distance of
+
+    :param snapshot         Snapshot    Snapshot the area was worked out from
+    :param area             tuple       Key from area_of()
+    :param alert_distance   float       Alert distance (in kilometres)
+    :param kinds            tuple       Any of "camera", "trap"
+    :return                 list        (kind, devices, position, lat, lon) tuples
+    '''
+    _, level, row, col = area
+    dlat, dlon = geohash.cell_size(level)
+    lat, lon = -90.0 + (row + 0.5) * dlat, -180.0 + (col + 0.5) * dlon
+    reach = alert_distance + math.hypot(dlat, dlon) / 2 * geohash.KM_PER_DEGREE
+
+    candidates = []
+    for kind, devices, index in snapshot.datasets():
+        if kind not in kinds:
+            continue
+        for cell in geohash.covering(lat, lon, reach, level):
+            candidates.extend((kind, devices, i, float(index.lats[i]), float(index.lons[i])) for i in index.cell(cell))
+    return candidates
+
+
+def angle(a:float, b:float):
+    '''
+    Smallest difference between two compass bearings, in degrees
+    '''
+    return abs((a - b + 180) % 360 - 180)
+
+
+def track(fixes, registry, alert_distance:float=0.5, cone:float=30.0, kinds=KINDS):
+    '''
+    Alerts for a stream of fixes, keeping a Tracker per vehicle
+
+    :param fixes            iterable    Dicts from parse_fix()
+    :param registry         DeviceRegistry  Loaded registry
+    :param alert_distance   float       Alert when a device gets this close (in kilometres)
+    :param cone             float       Max degrees between the heading and a device ahead
+    :param kinds            tuple       Any of "camera", "trap"
+    :return                 generator   Alert dicts with the vehicle they are for, as they happen
+    '''
+    trackers = {}
+    for fix in fixes:
+        vehicle = fix.get("vehicle")
+        if vehicle not in trackers:
+            trackers[vehicle] = Tracker(registry, alert_distance=alert_distance, cone=cone, kinds=kinds)
+        for alert in trackers[vehicle].update(fix["lat"], fix["lon"], heading=fix.get("heading"), time=fix.get("time")):
+            alert["vehicle"] = vehicle
+            yield alert
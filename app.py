@@ -22,13 +22,169 @@ Server entrypoint
 -------------------------------------------------------------------------------
 """
 
-from flask import Flask, render_template, request
+import os
+import hmac
+import math
+import time
+import heapq
+
+from flask import Flask, Response, g, jsonify, render_template, request, stream_with_context
 from api.server import *
-from api.cli import address_to_coords, refresh_devices
+from api.cli import address_to_coords, refresh_devices, geocode_cache, SNAPSHOT_DIR
+from api import client, distance
+from api.registry import registry, KINDS
+from api.cache import ResponseCache, quantize
+from api.batch import MAX_ADDRESSES, locate_all
+from api.track import Tracker, parse_fix
+from api.device import heading_direction
+from api.metrics import metrics, REQUESTS, REQUEST_SECONDS
+from api.profiler import profiler
 
 app = Flask(__name__)
 gunicorn_logger = logging.getLogger('gunicorn.error')
 
+# Re-fetch the full datasets in the background (seconds, 0 to disable)
+REFRESH_INTERVAL = float(os.environ.get('DRIFTKIT_REFRESH_INTERVAL', '3600'))
+
+# Workers pointed at the same directory share one fetcher and one memory-mapped copy of the data
+SHARED_DIR = os.environ.get('DRIFTKIT_SHARED_DIR')
+
+# Serve the last saved snapshot straight away, the refresh below replaces it
+if SNAPSHOT_DIR:
+    registry.persist(SNAPSHOT_DIR, logger=gunicorn_logger)
+
+registry.start(interval=REFRESH_INTERVAL, logger=gunicorn_logger, directory=SHARED_DIR)
+
+# They also share one Nominatim rate limit, so more workers don't mean more requests per second
+if SHARED_DIR:
+    client.nominatim_limit.path = os.path.join(SHARED_DIR, 'nominatim.next')
+
+# Searches are answered from the centre of the geohash cell they start in (7 is about 150 x 90 m),
+# so everyone searching from the same block shares one cached response
+CACHE_PRECISION = int(os.environ.get('DRIFTKIT_CACHE_PRECISION', '7'))
+CACHE_SIZE = int(os.environ.get('DRIFTKIT_CACHE_SIZE', '512'))
+CACHE_MAX_AGE = int(os.environ.get('DRIFTKIT_CACHE_MAX_AGE', '300'))
+
+response_cache = ResponseCache(size=CACHE_SIZE)
+
+# Each worker writes its metrics here every DRIFTKIT_METRICS_INTERVAL seconds, and /metrics adds them up
+METRICS_DIR = os.environ.get('DRIFTKIT_METRICS_DIR', os.path.join(SHARED_DIR, 'metrics') if SHARED_DIR else '')
+METRICS_INTERVAL = float(os.environ.get('DRIFTKIT_METRICS_INTERVAL', '5'))
+
+metrics.directory = METRICS_DIR or None
+metrics.start(interval=METRICS_INTERVAL, logger=gunicorn_logger)
+
+# Profiling is off unless a token is set; POST /debug/profile with it to profile every worker
+PROFILE_TOKEN = os.environ.get('DRIFTKIT_PROFILE_TOKEN', '')
+PROFILE_DIR = os.environ.get('DRIFTKIT_PROFILE_DIR', os.path.join(os.path.expanduser("~"), ".cache", "driftkit", "profiles"))
+
+if PROFILE_TOKEN:
+    profiler.directory = PROFILE_DIR
+    profiler.watch(logger=gunicorn_logger)
+
+# Limits on /api/route
+MAX_ROUTE_POINTS = 10000
+MAX_ROUTE_BUFFER = 5000
+MAX_ROUTE_LENGTH = 2000
+
+# Limits on /api/track
+MAX_ALERT_DISTANCE = 5000
+
+
+metrics.describe("driftkit_devices", "gauge", "Devices in the current snapshot")
+metrics.describe("driftkit_snapshot_generation", "gauge", "Generation of the current snapshot")
+metrics.describe("driftkit_snapshot_age_seconds", "gauge", "Seconds since the current snapshot was fetched")
+metrics.describe("driftkit_refresh_failures", "gauge", "Background refreshes that have failed in a row")
+metrics.describe("driftkit_cache_requests_total", "counter", "Response and geocode cache lookups, by result")
+
+
+def collect_metrics():
+    '''
+    Dataset size and cache counters, read by the metrics snapshot instead of being counted twice
+    '''
+    snapshot = registry.snapshot
+    if snapshot is not None:
+        yield "driftkit_devices", {"kind": "camera"}, len(snapshot.cameras)
+        yield "driftkit_devices", {"kind": "trap"}, len(snapshot.traps)
+        yield "driftkit_snapshot_generation", {}, snapshot.generation
+        yield "driftkit_snapshot_age_seconds", {}, round(snapshot.age(), 1)
+    yield "driftkit_refresh_failures", {}, registry.failures
+
+    yield "driftkit_cache_requests_total", {"cache": "responses", "result": "hit"}, response_cache.hits
+    yield "driftkit_cache_requests_total", {"cache": "responses", "result": "miss"}, response_cache.misses
+    yield "driftkit_cache_requests_total", {"cache": "geocode", "result": "hit"}, geocode_cache.hits
+    yield "driftkit_cache_requests_total", {"cache": "geocode", "result": "disk_hit"}, geocode_cache.disk_hits
+    yield "driftkit_cache_requests_total", {"cache": "geocode", "result": "miss"}, geocode_cache.misses
+
+
+metrics.collect(collect_metrics)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    g.profiled = request.endpoint == 'index' and profiler.enter()
+
+
+@app.teardown_request
+def stop_profiling(error):
+    if g.get('profiled'):
+        profiler.leave()
+
+
+@app.after_request
+def count_request(response):
+    # Streamed responses are timed until their first byte
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe(REQUEST_SECONDS, time.perf_counter() - g.started, endpoint=endpoint)
+    metrics.inc(REQUESTS, endpoint=endpoint, status=response.status_code)
+    return response
+
+
+def locate(location:str):
+    '''
+    address_to_coords(), timed as the "geocode" stage
+    '''
+    with metrics.timer("geocode"):
+        return address_to_coords(location=location, logger=gunicorn_logger)
+
+
+def valid_coords(coords):
+    '''
+    True if a (lat, lon) pair is finite, with lat between -90 and 90 and lon between -180 and 180
+    '''
+    return math.isfinite(coords[0]) and math.isfinite(coords[1]) and -90 <= coords[0] <= 90 and -180 <= coords[1] <= 180
+
+
+def cached_response(key, render, mimetype:str):
+    '''
+    Answer a search from the response cache, rendering and storing it on a miss
+
+    Only used while the registry is ready, so every response belongs to a snapshot generation.
+    The ETag depends only on the key and the generation, so a matching If-None-Match gets a
+    304 without the search running at all.
+
+    :param key          tuple       Quantized origin and search parameters
+    :param render       function    Builds the body (str or bytes) on a miss
+    :param mimetype     str         Content type of the body
+    '''
+    generation = registry.snapshot.generation
+    etag = response_cache.etag(key, generation)
+    headers = {'Cache-Control': f'public, max-age={CACHE_MAX_AGE}'}
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+    else:
+        body = response_cache.get(key, generation)
+        if body is None:
+            body = render()
+            body = body.encode() if isinstance(body, str) else body
+            response_cache.put(key, generation, body)
+        response = Response(body, mimetype=mimetype, headers=headers)
+
+    response.set_etag(etag)
+    return response
+
 
 # Main webpage
 @app.route('/', methods=['GET'])
@@ -39,23 +195,325 @@ def index(devices=[]):
         default_radius = 10
 
         # Get coordinates from address and convert radius from kilometers to meters
-        coords = address_to_coords(location=request.args.get('address', ''), logger=gunicorn_logger)
-        radius = float(request.args.get('radius', default_radius) or default_radius) * 1000
+        # (a radius that isn't a finite number gets the default)
+        coords = locate(request.args.get('address', ''))
+        try:
+            radius = float(request.args.get('radius', default_radius) or default_radius)
+        except ValueError:
+            radius = default_radius
+        if not math.isfinite(radius):
+            radius = default_radius
+        radius *= 1000
+
+        # Max number of results (0 for no limit, which is also what a limit that isn't a number gets)
+        try:
+            limit = int(request.args.get('limit', 0) or 0)
+        except ValueError:
+            limit = 0
+
+        # Answer from the in-memory registry (through the response cache), only asking
+        # data.edmonton.ca until it has loaded
+        if coords and registry.ready():
+            cell, origin = quantize(coords, CACHE_PRECISION)
+            return cached_response(("index", cell, radius, limit),
+                                   lambda: render_index(nearby_devices(origin, radius, limit)),
+                                   mimetype='text/html')
 
         # If we have coordinates, load cameras and traps
-        if coords:   
-            cameras = load_cameras(coords=coords, radius=radius, logger=gunicorn_logger)
-            traps   = load_traps(coords=coords, radius=radius, logger=gunicorn_logger)
-            devices = cameras + traps
+        if coords:
+            with metrics.timer("fetch"):
+                devices = load_devices(coords=coords, radius=radius, logger=gunicorn_logger)
 
-            # Refresh device distances and sort from closest to farthest
-            refresh_devices(devices, coords)
-            devices.sort()
+            # Refresh device distances
+            with metrics.timer("refresh_devices"):
+                refresh_devices(devices, coords)
+
+            # Sort from closest to farthest, keeping only the closest few if there's a limit
+            with metrics.timer("sort"):
+                if limit > 0:
+                    devices = heapq.nsmallest(limit, devices)
+                else:
+                    devices.sort()
 
             # Log number of devices on successful load
             gunicorn_logger.info(f"Got {len(devices)} devices")
 
-    return render_template('index.html', data=devices)
+    return render_index(devices)
+
+
+def render_index(devices):
+    with metrics.timer("render"):
+        return render_template('index.html', data=devices)
+
+
+def nearby_devices(coords, radius:float, limit:int):
+    '''
+    Devices around coords from the registry, closest first
+
+    :param coords   tuple   GPS coordinates (lat:float, lon:float)
+    :param radius   float   Search radius (in meters)
+    :param limit    int     Max number of devices (0 for no limit)
+    '''
+    if limit > 0:
+        # nearest() sorts as it goes, so all of its time counts as the search
+        with metrics.timer("search"):
+            devices = registry.nearest(coords=coords, k=limit, radius=radius)
+    else:
+        with metrics.timer("search"):
+            devices = registry.load_cameras(coords=coords, radius=radius) + registry.load_traps(coords=coords, radius=radius)
+        with metrics.timer("sort"):
+            devices.sort()
+
+    gunicorn_logger.info(f"Got {len(devices)} devices")
+    return devices
+
+
+# JSON API
+@app.route('/api/devices', methods=['GET'])
+def api_devices():
+    '''
+    Devices around a location as JSON, closest first
+
+    Query parameters
+        lat, lon    GPS coordinates of the user, or
+        address     an address to geocode
+        radius      Search radius in kilometres (default 10, 0 for no limit)
+        kinds       Comma-separated "camera" and/or "trap" (default both)
+        limit       Devices per page (default 100, 0 with stream=1 for everything)
+        heading     Compass heading of the user in degrees, to leave out devices facing other traffic
+        cursor      "next" value from the previous page
+        stream      1 (or true) to send every match as one chunked response instead of pages
+    '''
+    args = request.args
+    try:
+        if 'lat' in args and 'lon' in args:
+            coords = (float(args['lat']), float(args['lon']))
+        else:
+            coords = locate(args.get('address', ''))
+
+        radius = float(args.get('radius', 10) or 0) * 1000 or None
+        kinds = tuple(kind for kind in args.get('kinds', ','.join(KINDS)).split(',') if kind)
+        limit = int(args.get('limit', 100))
+        heading = float(args['heading']) if args.get('heading') else None
+        generation, offset = decode_cursor(args['cursor']) if 'cursor' in args else (None, 0)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    stream = args.get('stream') in ('1', 'true')
+
+    if not coords:
+        return jsonify(error="couldn't find that location"), 400
+    if not valid_coords(coords):
+        return jsonify(error="lat must be between -90 and 90 and lon between -180 and 180"), 400
+    if not kinds or any(kind not in KINDS for kind in kinds):
+        return jsonify(error=f"kinds must be one or more of {', '.join(KINDS)}"), 400
+    if radius is not None and not math.isfinite(radius):
+        return jsonify(error="radius must be a finite number of kilometres"), 400
+    if limit < 0 or (limit == 0 and not stream):
+        return jsonify(error="limit must be positive (or 0 with stream=1)"), 400
+    if heading is not None and not math.isfinite(heading):
+        return jsonify(error="heading must be a finite number of degrees"), 400
+
+    if not registry.ready():
+        return jsonify(error="device data is still loading"), 503, {'Retry-After': '30'}
+
+    # Every page of one listing must come from the same snapshot
+    snapshot = registry.snapshot
+    if generation is not None and generation != snapshot.generation:
+        return jsonify(error="the device data changed, start again without a cursor"), 409
+
+    if stream:
+        matches = registry.search(coords, radius=radius, kinds=kinds, k=limit or None, snapshot=snapshot, heading=heading)
+        return Response(stream_devices(matches, snapshot.generation), mimetype='application/json')
+
+    def render():
+        # One extra match tells us whether there's another page
+        matches = registry.search(origin, radius=radius, kinds=kinds, k=offset + limit + 1, snapshot=snapshot,
+                                  heading=heading)
+        page = matches[offset:offset + limit]
+        return dumps({
+            "generation": snapshot.generation,
+            "count": len(page),
+            "next": encode_cursor(snapshot.generation, offset + limit) if len(matches) > offset + limit else None,
+            "devices": [device_record(devices[i], kind, d) for d, kind, devices, i in page],
+        })
+
+    # Headings only matter as far as the travel direction they pick
+    direction = heading_direction(heading) if heading is not None else 0
+    cell, origin = quantize(coords, CACHE_PRECISION)
+    return cached_response(("api", cell, radius, kinds, limit, offset, direction), render, mimetype='application/json')
+
+
+# Devices along a route
+@app.route('/api/route', methods=['GET', 'POST'])
+def api_route():
+    '''
+    Devices within a buffer of a route, in the order a driver reaches them
+
+    GET  /api/route?path=lat,lon;lat,lon;...&buffer=100&kinds=camera
+    POST /api/route  {"route": [[lat, lon], ...], "buffer": 100, "kinds": ["camera"]}
+
+    buffer is in metres (default 100). Each device's "distance" is how far it is from the route,
+    and "along" is the kilometres from the start of the route to the point closest to it.
+    Routes are limited to MAX_ROUTE_POINTS points and MAX_ROUTE_LENGTH kilometres.
+    '''
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    params = body if isinstance(body, dict) else request.args
+    try:
+        if isinstance(body, dict):
+            route = [(float(lat), float(lon)) for lat, lon in body.get('route') or []]
+            kinds = tuple(body.get('kinds') or KINDS)
+        else:
+            route = [tuple(float(x) for x in point.split(',')) for point in params.get('path', '').split(';') if point]
+            kinds = tuple(kind for kind in params.get('kinds', ','.join(KINDS)).split(',') if kind)
+        buffer = float(params.get('buffer', 100))
+    except (TypeError, ValueError) as e:
+        return jsonify(error=f"route must be a list of lat,lon points ({e})"), 400
+
+    if not route or len(route) > MAX_ROUTE_POINTS or any(len(point) != 2 for point in route):
+        return jsonify(error=f"route must have between 1 and {MAX_ROUTE_POINTS} lat,lon points"), 400
+    if not all(valid_coords(point) for point in route):
+        return jsonify(error="lat must be between -90 and 90 and lon between -180 and 180"), 400
+    # The search costs about as much as the route is long
+    if sum(distance.between(a, b) for a, b in zip(route, route[1:])) > MAX_ROUTE_LENGTH:
+        return jsonify(error=f"route must be at most {MAX_ROUTE_LENGTH} km long"), 400
+    if not 0 < buffer <= MAX_ROUTE_BUFFER:
+        return jsonify(error=f"buffer must be between 0 and {MAX_ROUTE_BUFFER} metres"), 400
+    if not kinds or any(kind not in KINDS for kind in kinds):
+        return jsonify(error=f"kinds must be one or more of {', '.join(KINDS)}"), 400
+
+    if not registry.ready():
+        return jsonify(error="device data is still loading"), 503, {'Retry-After': '30'}
+
+    snapshot = registry.snapshot
+    matches = registry.corridor(route, buffer, kinds=kinds, snapshot=snapshot)
+    return Response(dumps({
+        "generation": snapshot.generation,
+        "count": len(matches),
+        "devices": [dict(device_record(devices[i], kind, offset), along=round(along, 4))
+                    for along, offset, kind, devices, i in matches],
+    }), mimetype='application/json')
+
+
+# Batch geocoding
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    '''
+    Devices around each of a list of addresses, as newline-delimited JSON
+
+    Body: {"addresses": [...], "radius": km (default 1, 0 for no limit), "limit": devices per
+    address (default 0 = no limit), "kinds": ["camera", "trap"]}. Each address gets one line,
+    sent as soon as it is resolved, so lines don't come back in the order they were given.
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('addresses'), list) \
+            or not all(isinstance(address, str) for address in body['addresses']):
+        return jsonify(error="expected a JSON object with a list of address strings in \"addresses\""), 400
+    if len(body['addresses']) > MAX_ADDRESSES:
+        return jsonify(error=f"at most {MAX_ADDRESSES} addresses per batch"), 413
+
+    try:
+        radius = float(body.get('radius', 1) or 0) * 1000 or None
+        limit = int(body.get('limit', 0) or 0)
+    except (TypeError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+    if radius is not None and not math.isfinite(radius):
+        return jsonify(error="radius must be a finite number of kilometres"), 400
+    kinds = body.get('kinds') or list(KINDS)
+    if not isinstance(kinds, list) or not all(isinstance(kind, str) and kind in KINDS for kind in kinds) or limit < 0:
+        return jsonify(error=f"kinds must be a list of one or more of {', '.join(KINDS)} and limit must not be negative"), 400
+    kinds = tuple(kinds)
+
+    if not registry.ready():
+        return jsonify(error="device data is still loading"), 503, {'Retry-After': '30'}
+
+    results = locate_all(body['addresses'], locate, registry, radius=radius, k=limit or None, kinds=kinds,
+                         logger=gunicorn_logger)
+    return Response((dumps(result) + b"\n" for result in results), mimetype='application/x-ndjson')
+
+
+# Live GPS track
+@app.route('/api/track', methods=['POST'])
+def api_track():
+    '''
+    Proximity alerts for a live GPS track, as server-sent events
+
+    POST /api/track?distance=500&cone=30&kinds=camera with one fix per line in the body, either
+    {"lat": .., "lon": .., "heading": .., "time": ..} or "lat,lon[,heading[,time]]". The body can be
+    sent chunked as the vehicle moves: each fix is read as it arrives, and every device coming
+    within `distance` metres ahead of the vehicle is sent back straight away as an "alert" event.
+    Lines that aren't fixes get an "error" event and are skipped.
+    '''
+    try:
+        alert_distance = float(request.args.get('distance', 500))
+        cone = float(request.args.get('cone', 30))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    kinds = tuple(kind for kind in request.args.get('kinds', ','.join(KINDS)).split(',') if kind)
+
+    if not 0 < alert_distance <= MAX_ALERT_DISTANCE or not 0 <= cone <= 180:
+        return jsonify(error=f"distance must be between 0 and {MAX_ALERT_DISTANCE} metres and cone between 0 and 180"), 400
+    if not kinds or any(kind not in KINDS for kind in kinds):
+        return jsonify(error=f"kinds must be one or more of {', '.join(KINDS)}"), 400
+
+    if not registry.ready():
+        return jsonify(error="device data is still loading"), 503, {'Retry-After': '30'}
+
+    tracker = Tracker(registry, alert_distance=alert_distance / 1000, cone=cone, kinds=kinds)
+
+    def events():
+        for line in iter(request.stream.readline, b""):
+            try:
+                fix = parse_fix(line.decode("utf-8", "replace"))
+            except ValueError as e:
+                yield b"event: error\ndata: " + dumps({"error": str(e)}) + b"\n\n"
+                continue
+            if fix is None:
+                continue
+            for alert in tracker.update(fix["lat"], fix["lon"], heading=fix["heading"], time=fix["time"]):
+                yield b"event: alert\ndata: " + dumps(alert) + b"\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+# Age of the device snapshot, the outcome of the last background refresh and geocode cache counters
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify(dict(registry.status(), geocode=geocode_cache.stats(), responses=response_cache.stats()))
+
+
+# Prometheus scrape endpoint, covering every gunicorn worker
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Sampling profiler, only with DRIFTKIT_PROFILE_TOKEN set
+@app.route('/debug/profile', methods=['POST'])
+def debug_profile():
+    '''
+    Profile every worker for a while
+
+    POST /debug/profile?seconds=30&fraction=0.1 with "Authorization: Bearer <DRIFTKIT_PROFILE_TOKEN>".
+    Without a fraction each worker samples all of its threads; with one, only that share of
+    requests to index(). When the time is up every worker writes <id>-<pid>.collapsed to
+    DRIFTKIT_PROFILE_DIR, ready for flamegraph.pl or speedscope.
+    '''
+    if not PROFILE_TOKEN:
+        return jsonify(error="profiling is disabled"), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {PROFILE_TOKEN}".encode()):
+        return jsonify(error="a valid profiling token is required"), 403
+
+    try:
+        seconds = float(request.args.get('seconds', 30))
+        fraction = float(request.args['fraction']) if request.args.get('fraction') else None
+        control = profiler.start(seconds, fraction)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except RuntimeError as e:
+        return jsonify(error=str(e)), 409
+
+    gunicorn_logger.info(f"app.debug_profile(): profiling for {seconds}s (fraction {fraction})")
+    return jsonify(dict(control, directory=PROFILE_DIR)), 202
 
 
 if __name__ == '__main__':
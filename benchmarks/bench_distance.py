@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Per-object Device.refresh() vs. the batch distance engine
+
+    python3 -m benchmarks.bench_distance
+-------------------------------------------------------------------------------
+"""
+
+import time
+from unittest import mock
+
+from api import distance
+from benchmarks.synthetic import make_cameras
+
+ORIGIN = (53.5461, -113.4938)
+
+
+def best_of(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    print("-" * 70)
+    print(f"{'points':>8} {'refresh() (ms)':>15} {'python (ms)':>12} {'numpy (ms)':>12} {'refresh_devices (ms)':>21}")
+    for size in (1000, 10000, 100000):
+        cameras = make_cameras(size)
+
+        per_object = best_of(lambda: [camera.refresh(ORIGIN) for camera in cameras])
+
+        # The distance pass alone, over columns built once
+        with mock.patch.object(distance, "numpy", None):
+            lats, lons = distance.columns(camera.coords for camera in cameras)
+            python = best_of(lambda: distance.distances(ORIGIN, lats, lons))
+
+        if distance.load_numpy() is not None:
+            lats, lons = distance.columns(camera.coords for camera in cameras)
+            numpy = f"{best_of(lambda: distance.distances(ORIGIN, lats, lons)) * 1000:>12.3f}"
+        else:
+            numpy = f"{'n/a':>12}"
+
+        # Including building the columns from Device objects and writing distances back
+        batch = best_of(lambda: distance.refresh(cameras, ORIGIN))
+
+        print(f"{size:>8} {per_object * 1000:>15.3f} {python * 1000:>12.3f} {numpy} {batch * 1000:>21.3f}")
+    print("-" * 70)
+
+
+if __name__ == "__main__":
+    main()
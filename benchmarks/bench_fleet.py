@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Fleet throughput: vehicles per second at different fleet sizes
+
+Every vehicle sends one fix per tick, driving about 15 m/s around a city of
+~2,000 cameras and traps. The Fleet processes each tick as one batch; the
+baseline feeds the same fixes to one Tracker per vehicle. With --processes N
+the vehicles are split into N shards by id, each run by its own Fleet in its
+own process, which is how a multi-core box would be used.
+
+    python3 -m benchmarks.bench_fleet [--processes 4]
+-------------------------------------------------------------------------------
+"""
+
+import math
+import time
+import random
+import argparse
+import multiprocessing
+
+from api.fleet import Fleet
+from api.registry import DeviceRegistry
+from api.track import Tracker
+from benchmarks.synthetic import SOUTH, NORTH, WEST, EAST, make_cameras, make_traps
+
+TICKS = 10
+STEP = 0.015        # km per tick
+
+
+def make_ticks(vehicles:int, ticks:int, seed:int=0):
+    '''
+    One batch of fixes per tick, every vehicle moving STEP along its own heading
+    '''
+    rng = random.Random(seed)
+    lats = [rng.uniform(SOUTH, NORTH) for _ in range(vehicles)]
+    lons = [rng.uniform(WEST, EAST) for _ in range(vehicles)]
+    headings = [rng.uniform(0, 360) for _ in range(vehicles)]
+    batches = []
+    for _ in range(ticks):
+        batch = []
+        for v in range(vehicles):
+            headings[v] = (headings[v] + rng.uniform(-10, 10)) % 360
+            lats[v] += STEP / 111.2 * math.cos(math.radians(headings[v]))
+            lons[v] += STEP / 66.1 * math.sin(math.radians(headings[v]))
+            batch.append({"vehicle": v, "lat": lats[v], "lon": lons[v], "heading": headings[v], "time": None})
+        batches.append(batch)
+    return batches
+
+
+def make_registry():
+    registry = DeviceRegistry()
+    registry.set_devices(make_cameras(500), make_traps(1500))
+    return registry
+
+
+def run_fleet(batches):
+    '''
+    :return     tuple   (seconds, alerts)
+    '''
+    fleet = Fleet(make_registry())
+    alerts = 0
+    start = time.perf_counter()
+    for batch in batches:
+        alerts += len(fleet.update(batch))
+    return time.perf_counter() - start, alerts
+
+
+def run_trackers(batches):
+    registry = make_registry()
+    trackers = {}
+    alerts = 0
+    start = time.perf_counter()
+    for batch in batches:
+        for fix in batch:
+            tracker = trackers.get(fix["vehicle"])
+            if tracker is None:
+                tracker = trackers[fix["vehicle"]] = Tracker(registry)
+            alerts += len(tracker.update(fix["lat"], fix["lon"], heading=fix["heading"]))
+    return time.perf_counter() - start, alerts
+
+
+def run_sharded(batches, processes:int):
+    '''
+    The busiest shard's time, as all shards run at once
+    '''
+    shards = [[[fix for fix in batch if fix["vehicle"] % processes == shard] for batch in batches]
+              for shard in range(processes)]
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        results = pool.map(run_fleet, shards)
+    return max(seconds for seconds, _ in results), sum(alerts for _, alerts in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=0, help="also run the fleet sharded over this many processes")
+    args = parser.parse_args()
+
+    print("-" * 80)
+    print(f"{'vehicles':>9} {'alerts':>7} {'fleet (veh/s)':>14} {'trackers (veh/s)':>17}"
+          + (f" {f'{args.processes} procs (veh/s)':>18}" if args.processes else ""))
+    for vehicles in (1000, 10000, 50000):
+        batches = make_ticks(vehicles, TICKS)
+        fixes = vehicles * TICKS
+
+        fleet, alerts = run_fleet(batches)
+        trackers, _ = run_trackers(batches)
+        line = f"{vehicles:>9} {alerts:>7} {fixes / fleet:>14,.0f} {fixes / trackers:>17,.0f}"
+        if args.processes:
+            sharded, _ = run_sharded(batches, args.processes)
+            line += f" {fixes / sharded:>18,.0f}"
+        print(line)
+    print("-" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Cold-start import time of the CLI and the webserver against a budget
+
+Each module is imported in a fresh interpreter with `python -X importtime` and
+the best of a few runs is compared with its budget. Exits with status 1 if a
+module is over budget, so it can run in CI.
+
+    python3 -m benchmarks.bench_import [--repeat N] [module=ms ...]
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import subprocess
+
+# Milliseconds, on a developer laptop. Flask alone is most of the webserver's budget.
+BUDGETS = {"api.cli": 150, "app": 500}
+
+# Only imported when something goes over the network or builds a column of coordinates
+DEFERRED = ("requests", "urllib3", "geopy", "numpy", "haversine")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module:str):
+    '''
+    Cumulative import time of a module in a fresh interpreter
+
+    :param module   str     Module to import
+    :return         tuple   (milliseconds, {child module: milliseconds}, deferred modules that were imported)
+    '''
+    # No background fetch or saved snapshot, just the imports
+    env = dict(os.environ, DRIFTKIT_REFRESH_INTERVAL="0", DRIFTKIT_SNAPSHOT_DIR="")
+    code = f"import sys, {module}; print(' '.join(m for m in {DEFERRED!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+
+    total, children = None, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Imports are listed after everything they imported, indented one level deeper
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0 and name.strip() == module:
+            total = int(cumulative) / 1000
+            break
+        elif depth == 0:
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+
+    return total, children, result.stdout.split()
+
+
+def main(argv):
+    repeat = 5
+    budgets = dict(BUDGETS)
+    args = iter(argv)
+    for arg in args:
+        if arg == "--repeat":
+            repeat = int(next(args))
+        else:
+            module, ms = arg.split("=")
+            budgets[module] = float(ms)
+
+    over = False
+    print("-" * 70)
+    print(f"{'module':>10} {'best (ms)':>10} {'budget (ms)':>12}  slowest imports")
+    for module, budget in budgets.items():
+        runs = [import_time(module) for _ in range(repeat)]
+        total, children, deferred = min(runs, key=lambda run: run[0])
+        slowest = ", ".join(f"{name} {ms:.0f}" for name, ms in sorted(children.items(), key=lambda c: -c[1])[:3])
+        flag = "" if total <= budget else "  OVER BUDGET"
+        print(f"{module:>10} {total:>10.1f} {budget:>12.0f}  {slowest}{flag}")
+        if deferred:
+            print(f"{'':>10} imported eagerly: {', '.join(deferred)}")
+        over = over or total > budget
+    print("-" * 70)
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
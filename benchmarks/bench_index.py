@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Tile index lookups vs. checking every point, as the dataset grows
+
+Each search uses a radius that holds about the same number of points at every
+size, so any growth in the index column comes from the dataset size itself.
+
+    python3 -m benchmarks.bench_index
+-------------------------------------------------------------------------------
+"""
+
+import os
+import math
+import time
+import random
+import tempfile
+
+from api import distance, geohash
+from api.spatial import GeohashIndex
+from benchmarks.synthetic import SOUTH, NORTH, WEST, EAST, make_cameras, random_coords
+
+# Points each search should find
+MATCHES = 20
+
+
+def time_per_call(function, origins):
+    start = time.perf_counter()
+    for origin in origins:
+        function(origin)
+    return (time.perf_counter() - start) / len(origins)
+
+
+def main():
+    rng = random.Random(7)
+    origins = [random_coords(rng) for _ in range(200)]
+
+    height = (NORTH - SOUTH) * geohash.KM_PER_DEGREE
+    width = (EAST - WEST) * geohash.KM_PER_DEGREE * math.cos(math.radians((NORTH + SOUTH) / 2))
+
+    print("-" * 96)
+    print(f"{'points':>8} {'radius (km)':>12} {'level':>6} {'build (s)':>10} {'load (s)':>9} "
+          f"{'scan (ms)':>10} {'index (ms)':>11} {'candidates':>11} {'nearest 10 (ms)':>16}")
+    for size in (1000, 10000, 100000, 1000000):
+        points = [camera.coords for camera in make_cameras(size)]
+        radius = math.sqrt(MATCHES * height * width / (math.pi * size))
+
+        start = time.perf_counter()
+        index = GeohashIndex(points)
+        build = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.index")
+            index.save(path)
+            start = time.perf_counter()
+            GeohashIndex.load(path)
+            load = time.perf_counter() - start
+
+        # Checking every point, which is what a local search would do without the index
+        lats, lons = index.lats, index.lons
+        scan = time_per_call(lambda o: [d for d in distance.distances(o, lats, lons) if d <= radius], origins[:20])
+
+        lookup = time_per_call(lambda o: index.within(o, radius), origins)
+        nearest = time_per_call(lambda o: index.nearest(o, 10), origins)
+        candidates = sum(len(list(index.candidates(o, radius))) for o in origins) / len(origins)
+
+        print(f"{size:>8} {radius:>12.3f} {index.level_for(origins[0], radius):>6} {build:>10.2f} {load:>9.2f} "
+              f"{scan * 1000:>10.3f} {lookup * 1000:>11.3f} {candidates:>11.1f} {nearest * 1000:>16.3f}")
+    print("-" * 96)
+
+
+if __name__ == "__main__":
+    main()
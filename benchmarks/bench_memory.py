@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Memory used by the device layouts
+
+    python3 -m benchmarks.bench_memory
+-------------------------------------------------------------------------------
+"""
+
+import os
+import tempfile
+import tracemalloc
+
+from api.device import Camera
+from api.table import DeviceTable, write_table
+from benchmarks.synthetic import make_cameras
+
+
+class DictCamera:
+    '''
+    The original Device layout: a per-instance __dict__ and a coords tuple
+    '''
+    def __init__(self, site_id, speed, direction, location, coords, distance=0.0, icon="📷"):
+        self.site_id = site_id
+        self.speed = speed
+        self.direction = direction
+        self.location = location
+        self.coords = coords
+        self.distance = distance
+        self.icon = icon
+
+
+def measure(build):
+    '''
+    Bytes still allocated after build() returns, with the result kept alive
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def main():
+    print("-" * 70)
+    print(f"{'devices':>8} {'__dict__ (B/device)':>20} {'__slots__ (B/device)':>21} {'table (B/device)':>17}")
+    for size in (1000, 10000, 100000):
+        rows = [(c.site_id, c.speed, c.direction, c.location, c.coords) for c in make_cameras(size)]
+
+        # Each device gets its own direction string and coords tuple, the way a JSON parse hands them out
+        legacy = measure(lambda: [DictCamera(s, sp, (d + " ")[:-1], l, (co[0], co[1])) for s, sp, d, l, co in rows])
+        compact = measure(lambda: [Camera(s, sp, (d + " ")[:-1], l, (co[0], co[1])) for s, sp, d, l, co in rows])
+
+        # Memory-mapped pages live in the page cache and are shared between workers, so only
+        # the Python-side objects of an open table count against each process
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "devices.table")
+            write_table(path, make_cameras(size), [])
+            table = measure(lambda: DeviceTable(path))
+            table_file = os.path.getsize(path)
+
+        print(f"{size:>8} {legacy / size:>20.1f} {compact / size:>21.1f} {table / size:>17.1f}"
+              f"   (file {table_file / size:.1f} B/device, shared)")
+    print("-" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Registry lookups vs. within_circle() round trips
+
+    python3 -m benchmarks.bench_registry [--remote]
+-------------------------------------------------------------------------------
+"""
+
+import sys
+import time
+import random
+import logging
+
+from api.registry import DeviceRegistry
+from benchmarks.synthetic import make_cameras, make_traps, random_coords
+
+
+def time_per_call(function, origins):
+    start = time.perf_counter()
+    for origin in origins:
+        function(origin)
+    return (time.perf_counter() - start) / len(origins)
+
+
+def main(remote:bool=False):
+    rng = random.Random(42)
+    origins = [random_coords(rng) for _ in range(200)]
+    radius = 10000
+
+    print("-" * 70)
+    print(f"{'devices':>10} {'1 km (ms/search)':>20} {'10 km (ms/search)':>20}")
+    for size in (1000, 10000, 100000):
+        registry = DeviceRegistry()
+        registry.set_devices(make_cameras(size // 4), make_traps(size - size // 4))
+        near, far = (time_per_call(lambda o: registry.load_cameras(o, r) + registry.load_traps(o, r), origins)
+                     for r in (1000, radius))
+        print(f"{size:>10} {near * 1000:>20.3f} {far * 1000:>20.3f}")
+
+    if remote:
+        from api.server import load_cameras, load_traps
+
+        logger = logging.getLogger(__name__)
+        remote_time = time_per_call(lambda o: load_cameras(o, radius, logger) + load_traps(o, radius, logger), origins[:5])
+        print(f"{'remote':>10} {'':>20} {remote_time * 1000:>20.3f}")
+    print("-" * 70)
+
+
+if __name__ == "__main__":
+    main(remote="--remote" in sys.argv)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Corridor query along a route vs. one radius query per vertex
+
+The per-vertex searches use a radius big enough to reach halfway to the next
+vertex, which is what it takes for them to cover the whole corridor, so they
+get slower as vertices get farther apart.
+
+    python3 -m benchmarks.bench_route
+-------------------------------------------------------------------------------
+"""
+
+import time
+import random
+
+from api import distance
+from api.spatial import GeohashIndex
+from benchmarks.synthetic import SOUTH, NORTH, WEST, EAST, make_cameras
+
+BUFFER = 0.1    # km
+
+
+def make_route(rng:random.Random, vertices:int, spacing:float):
+    '''
+    A route wandering west to east across the city
+
+    :param vertices     int     Number of vertices
+    :param spacing      float   Rough distance between vertices (in kilometres)
+    '''
+    step = spacing / 111
+    lat, lon = (SOUTH + NORTH) / 2, WEST + 0.02
+    route = [(lat, lon)]
+    for _ in range(vertices - 1):
+        lat = min(max(lat + rng.uniform(-step, step), SOUTH), NORTH)
+        lon = min(max(lon + rng.uniform(0.2 * step, 1.8 * step), WEST), EAST)
+        route.append((lat, lon))
+    return route
+
+
+def best_of(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    rng = random.Random(11)
+
+    print("-" * 80)
+    print(f"{'points':>8} {'vertices':>9} {'route (km)':>11} {'matches':>8} {'corridor (ms)':>14} {'per vertex (ms)':>16}")
+    for size in (10000, 100000):
+        index = GeohashIndex([camera.coords for camera in make_cameras(size)])
+        # Street-by-street directions, and a highway drawn with a vertex every couple of kilometres
+        for vertices, spacing in ((20, 0.2), (200, 0.2), (15, 2.0)):
+            route = make_route(rng, vertices, spacing)
+            segments = [distance.between(a, b) for a, b in zip(route, route[1:])]
+            reach = BUFFER + max(segments) / 2
+
+            matches = len(index.corridor(route, BUFFER))
+            corridor = best_of(lambda: index.corridor(route, BUFFER))
+            per_vertex = best_of(lambda: {i for point in route for i, _ in index.within(point, reach)})
+
+            print(f"{size:>8} {vertices:>9} {sum(segments):>11.1f} {matches:>8} {corridor * 1000:>14.3f} {per_vertex * 1000:>16.3f}")
+    print("-" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Local stand-in for the Socrata API and Nominatim
+
+Run on its own to point a real webserver at it:
+
+    python3 -m benchmarks.standin --size 10000 --latency 0.05 --port 8081
+    DRIFTKIT_SOCRATA_URL=http://127.0.0.1:8081 DRIFTKIT_NOMINATIM_URL=http://127.0.0.1:8081 \
+        DRIFTKIT_NOMINATIM_RATE=1000 gunicorn app:app
+-------------------------------------------------------------------------------
+"""
+
+import re
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from api import distance
+from api.socrata import CAMERA_URL, TRAP_URL
+from benchmarks.synthetic import SOUTH, NORTH, WEST, EAST
+
+WITHIN_CIRCLE = re.compile(r"within_circle\(\w+,\s*(-?[\d.]+),\s*(-?[\d.]+),\s*([\d.]+)\)")
+
+
+class SocrataStandIn:
+    '''
+    A local HTTP server that answers the SoQL queries driftkit makes, for tests and benchmarks
+
+    Understands $select (column names, :id, :updated_at and *), $where (either
+    ":updated_at >= '...'" or "within_circle(column, lat, lon, metres)"), $order=:id, $limit
+    and $offset, answers If-None-Match with 304, and gzips the body when asked. GET /search
+    answers like Nominatim: addresses in `places` get their coordinates, anything else lands
+    at a spot in Edmonton picked from a hash of the address, so the same address always
+    geocodes the same way. Every response waits `latency` seconds first, and the bytes and
+    requests served are counted.
+
+        with SocrataStandIn({"/resource/cameras.json": camera_rows(5000)}, latency=0.05) as server:
+            fetch_all(server.url("/resource/cameras.json"), CAMERA_COLUMNS)
+    '''
+
+    def __init__(self, datasets:dict, latency:float=0.0, places:dict=None, port:int=0):
+        """
+        :param datasets     dict    Path -> list of rows (dicts with :id and :updated_at)
+        :param latency      float   Seconds added to every response
+        :param places       dict    Address -> (lat, lon) for /search
+        :param port         int     Port to listen on (0 for any free port)
+        """
+        self.datasets = datasets
+        self.latency = latency
+        self.places = places or {}
+        self.port = port
+        self.version = 1            # Part of every ETag; bump it after changing a dataset
+
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._sorted = {}           # Path -> (rows, rows in :id order)
+        self._columns = {}          # Path -> (rows, lats, lons) in :id order
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like the real portal
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_GET(self):
+                standin._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def url(self, path:str):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}{path}"
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def _count(self, size:int):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def _ordered(self, path:str):
+        # Sorted once per dataset (and again if it's replaced), so big datasets are quick to page through
+        rows = self.datasets.get(path)
+        if rows is None:
+            return None
+        with self._lock:
+            cached = self._sorted.get(path)
+            if cached is None or cached[0] is not rows:
+                cached = self._sorted[path] = (rows, sorted(rows, key=lambda row: row[":id"]))
+        return cached[1]
+
+    def _coordinates(self, path:str, ordered:list):
+        # Rows without coordinates never fall in a circle
+        with self._lock:
+            cached = self._columns.get(path)
+            if cached is None or cached[0] is not ordered:
+                nan = float("nan")
+                lats, lons = distance.columns((float(row.get("latitude") or nan), float(row.get("longitude") or nan))
+                                              for row in ordered)
+                cached = self._columns[path] = (ordered, lats, lons)
+        return cached[1:]
+
+    def geocode(self, query:str):
+        '''
+        :return     tuple   Where /search puts an address (lat, lon)
+        '''
+        if query in self.places:
+            return self.places[query]
+        digest = hashlib.blake2b(query.encode(), digest_size=8).digest()
+        u, v = int.from_bytes(digest[:4], "big") / 2 ** 32, int.from_bytes(digest[4:], "big") / 2 ** 32
+        return SOUTH + u * (NORTH - SOUTH), WEST + v * (EAST - WEST)
+
+    def _search(self, request, params:dict):
+        query = params.get("q", "")
+        lat, lon = self.geocode(query)
+        place = {"place_id": hash(query) & 0xffffffff, "lat": f"{lat:.7f}", "lon": f"{lon:.7f}", "display_name": query,
+                 "boundingbox": [f"{lat - 0.001:.7f}", f"{lat + 0.001:.7f}", f"{lon - 0.001:.7f}", f"{lon + 0.001:.7f}"]}
+        self._send(request, 200, json.dumps([place]).encode(), {"Content-Type": "application/json"})
+
+    def _handle(self, request):
+        time.sleep(self.latency)
+        url = urlsplit(request.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/search":
+            return self._search(request, params)
+
+        rows = self._ordered(url.path)
+        if rows is None:
+            return self._send(request, 404, b'{"error": "not found"}')
+
+        etag = f'"{self.version}-{hash(url.query) & 0xffffffff:x}"'
+        if request.headers.get("If-None-Match") == etag:
+            return self._send(request, 304, b"")
+
+        # Rows are always sent in :id order, whatever $order asks for
+        where = params.get("$where", "")
+        circle = WITHIN_CIRCLE.fullmatch(where.strip())
+        if where.startswith(":updated_at >= '"):
+            since = where.split("'")[1]
+            rows = [row for row in rows if row[":updated_at"] >= since]
+        elif circle:
+            lat, lon, radius = map(float, circle.groups())
+            found = distance.distances((lat, lon), *self._coordinates(url.path, rows))
+            rows = [rows[i] for i, d in enumerate(found) if d * 1000 <= radius]
+
+        offset = int(params.get("$offset", 0))
+        rows = rows[offset:offset + int(params.get("$limit", 1000))]
+
+        select = [column.strip() for column in params.get("$select", "*").split(",")]
+        if "*" not in select:
+            rows = [{column: row[column] for column in select if column in row} for row in rows]
+        elif not any(column.startswith(":") for column in select):
+            rows = [{key: value for key, value in row.items() if not key.startswith(":")} for row in rows]
+
+        body = json.dumps(rows).encode()
+        headers = {"ETag": etag, "Content-Type": "application/json"}
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        self._send(request, 200, body, headers)
+
+    def _send(self, request, status:int, body:bytes, headers:dict=None):
+        # Counted before it's sent, so a client that has its response can read the counters
+        self._count(len(body))
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        if status != 304:
+            request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def main():
+    from benchmarks.synthetic import camera_rows, trap_rows
+
+    parser = argparse.ArgumentParser(description="Serve synthetic cameras and traps like data.edmonton.ca")
+    parser.add_argument("--size", type=int, default=10000, help="devices in total, a quarter of them cameras")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    cameras = args.size // 4
+    datasets = {urlsplit(CAMERA_URL).path: camera_rows(cameras), urlsplit(TRAP_URL).path: trap_rows(args.size - cameras)}
+    with SocrataStandIn(datasets, latency=args.latency, port=args.port) as standin:
+        print(f"serving {args.size} devices on {standin.url('/')} with {args.latency}s latency (ctrl-c to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
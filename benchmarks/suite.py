@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Benchmark suite with machine-readable results
+
+Every case runs on synthetic data at each size, with data.edmonton.ca and Nominatim
+replaced by a local stand-in (benchmarks/standin.py) that waits --latency seconds per
+response, so results only depend on the code and the machine. Save a run as JSON and
+compare a later one against it to catch regressions between commits:
+
+    python3 -m benchmarks.suite --output before.json
+    git checkout my-branch
+    python3 -m benchmarks.suite --compare before.json        # exits with 1 on a regression
+
+    python3 -m benchmarks.suite --sizes city,10k,100k,1m --cases build,query,nearest
+-------------------------------------------------------------------------------
+"""
+
+import os
+
+# The end-to-end cases import the webserver: keep it from refreshing over the network,
+# reading the real snapshot or geocode cache, or sharing anything with a running server
+os.environ.update(DRIFTKIT_REFRESH_INTERVAL="0", DRIFTKIT_SNAPSHOT_DIR="", DRIFTKIT_GEOCODE_CACHE="",
+                  DRIFTKIT_METRICS_DIR="", DRIFTKIT_PROFILE_TOKEN="")
+os.environ.pop("DRIFTKIT_SHARED_DIR", None)
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import functools
+import itertools
+import statistics
+import subprocess
+from unittest import mock
+from urllib.parse import urlsplit
+
+from api import client, distance, server, socrata
+from api.cli import refresh_devices
+from api.geocache import GeocodeCache
+from api.registry import DeviceRegistry
+from api.socrata import CAMERA_URL, TRAP_URL, CAMERA_COLUMNS, READ_SIZE, RowDecoder, camera_from_row, \
+    trap_from_row, fetch_devices, iter_rows
+from benchmarks.standin import SocrataStandIn
+from benchmarks.synthetic import make_devices, make_rows, random_coords
+
+
+# Named sizes, from about a city's worth of devices up to a million
+SIZES = {"city": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+DEFAULT_SIZES = ("city", "10k", "100k")
+
+# Cases that download rows stop here: rows take ~5 KB each to generate and serve
+MAX_ROWS = 200000
+
+# A case that gets slower than its baseline by more than this share is a regression
+THRESHOLD = 0.25
+
+ORIGIN = (53.5461, -113.4938)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+CASES = {}
+
+# Shared by every dataset, so no address is ever looked up twice in one process
+_addresses = itertools.count()
+
+
+def case(name:str, description:str, max_size:int=None):
+    '''
+    Register a benchmark case
+
+    The decorated function takes a Dataset and returns (run, operations): run() performs
+    `operations` operations once, and is timed as a whole.
+
+    :param name         str     Name used by --cases and in the results
+    :param description  str     One line description
+    :param max_size     int     Largest size the case runs at
+    '''
+    def register(function):
+        CASES[name] = (function, description, max_size)
+        return function
+    return register
+
+
+class Dataset:
+    '''
+    Synthetic devices, rows and a stand-in server for one size, built on first use and
+    shared by every case at that size
+    '''
+
+    def __init__(self, size:int, latency:float):
+        """
+        :param size     int     Number of devices
+        :param latency  float   Seconds the stand-in waits before every response
+        """
+        self.size = size
+        self.latency = latency
+        self._standin = None
+
+    @functools.cached_property
+    def devices(self):
+        return make_devices(self.size)
+
+    @functools.cached_property
+    def rows(self):
+        return make_rows(self.size)
+
+    @functools.cached_property
+    def registry(self):
+        registry = DeviceRegistry()
+        registry.set_devices(*self.devices)
+        return registry
+
+    @property
+    def standin(self):
+        if self._standin is None:
+            # Past MAX_ROWS it only geocodes
+            cameras, traps = self.rows if self.size <= MAX_ROWS else ([], [])
+            self._standin = SocrataStandIn({urlsplit(CAMERA_URL).path: cameras, urlsplit(TRAP_URL).path: traps},
+                                           latency=self.latency)
+            self._standin.start()
+        return self._standin
+
+    def addresses(self, n:int):
+        '''
+        n addresses nobody has looked up yet, so geocode and response caches always miss
+        '''
+        return [f"{next(_addresses)} Benchmark Avenue" for _ in range(n)]
+
+    def origins(self, n:int, seed:int=7):
+        rng = random.Random(seed)
+        return [random_coords(rng) for _ in range(n)]
+
+    def close(self):
+        if self._standin is not None:
+            self._standin.stop()
+
+
+def through_standin(standin:SocrataStandIn):
+    '''
+    Patches that send the webserver's Socrata and Nominatim requests to the stand-in, with
+    an empty geocode cache that stays in memory
+    '''
+    return [
+        mock.patch("api.cli.geocode_cache", GeocodeCache()),
+        mock.patch("api.server.CAMERA_URL", standin.url(urlsplit(CAMERA_URL).path)),
+        mock.patch("api.server.TRAP_URL", standin.url(urlsplit(TRAP_URL).path)),
+        mock.patch.object(client, "NOMINATIM_URL", standin.url("")),
+        mock.patch.object(client, "_geolocator", None),
+        mock.patch.object(client, "nominatim_limit", client.RateLimiter(10 ** 9)),
+    ]
+
+
+@case("parse", "Decode one response body of every row into devices", max_size=MAX_ROWS)
+def parse(dataset):
+    cameras, traps = dataset.rows
+    body = json.dumps(cameras + traps).encode()
+    chunks = [body[i:i + READ_SIZE] for i in range(0, len(body), READ_SIZE)]
+    parse_row = lambda row: camera_from_row(row) if "posted_speed" in row else trap_from_row(row)
+
+    def run():
+        decode = RowDecoder(parse_row, logger)
+        assert sum(1 for _ in decode(iter_rows(chunks))) == dataset.size
+    return run, 1
+
+
+@case("load", "Download both datasets from the stand-in, page by page", max_size=MAX_ROWS)
+def load(dataset):
+    standin = dataset.standin
+    cameras_url, traps_url = standin.url(urlsplit(CAMERA_URL).path), standin.url(urlsplit(TRAP_URL).path)
+
+    def run():
+        devices = fetch_devices(cameras_url, camera_from_row, CAMERA_COLUMNS, logger=logger) + \
+                  fetch_devices(traps_url, trap_from_row, socrata.TRAP_COLUMNS, logger=logger)
+        assert len(devices) == dataset.size
+    return run, 1
+
+
+@case("build", "Index both datasets into a new registry snapshot")
+def build(dataset):
+    cameras, traps = dataset.devices
+    return lambda: DeviceRegistry().set_devices(cameras, traps), 1
+
+
+@case("refresh", "Distance from one point to every device (refresh_devices)")
+def refresh(dataset):
+    devices = dataset.devices[0] + dataset.devices[1]
+    return lambda: refresh_devices(devices, ORIGIN), 1
+
+
+@case("sort", "Sort every device by distance")
+def sort(dataset):
+    devices = dataset.devices[0] + dataset.devices[1]
+    refresh_devices(devices, ORIGIN)
+    return lambda: sorted(devices), 1
+
+
+@case("query", "Registry search for everything within 1 km, closest first")
+def query(dataset):
+    registry, origins = dataset.registry, dataset.origins(100)
+    return lambda: [registry.search(origin, radius=1000) for origin in origins], len(origins)
+
+
+@case("nearest", "Registry search for the 10 closest devices")
+def nearest(dataset):
+    registry, origins = dataset.registry, dataset.origins(100)
+    return lambda: [registry.nearest(origin, k=10) for origin in origins], len(origins)
+
+
+@case("index", "GET / for a new address: geocode through the stand-in, search the registry, render")
+def index(dataset):
+    import app
+
+    registry = dataset.registry
+    standin = dataset.standin
+
+    def run():
+        with mock.patch.object(app, "registry", registry), mock.patch.object(app, "response_cache", app.ResponseCache()):
+            for patch in through_standin(standin):
+                patch.start()
+            try:
+                web = app.app.test_client()
+                requests = standin.requests
+                for address in dataset.addresses(20):
+                    assert web.get("/", query_string={"address": address, "radius": 2, "limit": 20}).status_code == 200
+                assert standin.requests == requests + 20, "every address should have been geocoded"
+            finally:
+                mock.patch.stopall()
+    return run, 20
+
+
+@case("index_fetch", "GET / before the registry has loaded: geocode and fetch from the stand-in, refresh, sort, render",
+      max_size=MAX_ROWS)
+def index_fetch(dataset):
+    import app
+
+    standin = dataset.standin
+
+    def run():
+        with mock.patch.object(app, "registry", DeviceRegistry()):
+            for patch in through_standin(standin):
+                patch.start()
+            try:
+                web = app.app.test_client()
+                requests = standin.requests
+                for address in dataset.addresses(10):
+                    assert web.get("/", query_string={"address": address, "radius": 2}).status_code == 200
+                assert standin.requests == requests + 30, "every address should have been geocoded and fetched"
+            finally:
+                mock.patch.stopall()
+    return run, 10
+
+
+def measure(function, dataset, repeat:int):
+    '''
+    :return     dict    Seconds per operation over `repeat` timed runs, after one untimed run
+    '''
+    run, operations = function(dataset)
+    run()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        runs.append((time.perf_counter() - start) / operations)
+    return {"operations": operations, "min": min(runs), "median": statistics.median(runs), "max": max(runs), "runs": runs}
+
+
+def environment(latency:float):
+    '''
+    What the results depend on besides the code: the commit, the interpreter and the machine
+    '''
+    def git(*args):
+        try:
+            return subprocess.run(("git",) + args, capture_output=True, text=True, check=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    numpy = distance.load_numpy()
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": numpy.__version__ if numpy is not None else None,
+        "orjson": server.orjson is not None,
+        "latency": latency,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def parse_size(size:str):
+    if size.lower() in SIZES:
+        return size.lower(), SIZES[size.lower()]
+    return size, int(size)
+
+
+def run(sizes, cases, repeat:int=5, latency:float=0.02, output=sys.stdout):
+    '''
+    Run every case at every size
+
+    :param sizes    list    Size names from SIZES, or device counts
+    :param cases    list    Case names from CASES
+    :param repeat   int     Timed runs per case
+    :param latency  float   Seconds the stand-in waits before every response
+    :param output   file    Where progress is printed
+    :return         dict    The environment and one result per case and size
+    '''
+    results = []
+    for name, size in map(parse_size, sizes):
+        dataset = Dataset(size, latency)
+        try:
+            for case_name in cases:
+                function, _, max_size = CASES[case_name]
+                result = {"case": case_name, "size": name, "devices": size}
+                if max_size is not None and size > max_size:
+                    result["skipped"] = f"only runs up to {max_size} devices"
+                else:
+                    result.update(measure(function, dataset, repeat))
+                results.append(result)
+                print(format_result(result), file=output, flush=True)
+        finally:
+            dataset.close()
+    return {"environment": environment(latency), "repeat": repeat, "results": results}
+
+
+def format_result(result:dict, baseline:dict=None):
+    line = f"{result['case']:>12} {result['size']:>8}"
+    if "skipped" in result:
+        return f"{line} {'skipped':>14}"
+    line += f" {result['median'] * 1000:>14.3f} {result['min'] * 1000:>12.3f}"
+    if baseline is not None and "median" in baseline:
+        line += f" {baseline['median'] * 1000:>14.3f} {result['median'] / baseline['median'] - 1:>+9.1%}"
+    return line
+
+
+def compare(results:dict, baseline:dict, threshold:float=THRESHOLD, output=sys.stdout):
+    '''
+    Print each case next to the same case in an earlier run
+
+    :param results      dict    From run()
+    :param baseline     dict    An earlier run()
+    :param threshold    float   Share a median may grow by before it counts as a regression
+    :param output       file    Where the comparison is printed
+    :return             list    (case, size, change) for every regression
+    '''
+    before = {(result["case"], result["size"]): result for result in baseline["results"]}
+    print(f"compared with {baseline['environment'].get('commit')} ({baseline['environment'].get('time')})", file=output)
+    print(f"{'case':>12} {'size':>8} {'median (ms)':>14} {'min (ms)':>12} {'before (ms)':>14} {'change':>9}", file=output)
+
+    regressions = []
+    for result in results["results"]:
+        old = before.get((result["case"], result["size"]))
+        print(format_result(result, old), file=output)
+        if old is not None and "median" in old and "median" in result:
+            change = result["median"] / old["median"] - 1
+            if change > threshold:
+                regressions.append((result["case"], result["size"], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the driftkit benchmark suite")
+    parser.add_argument("--sizes", default=",".join(DEFAULT_SIZES),
+                        help=f"comma-separated sizes ({', '.join(SIZES)} or a number of devices)")
+    parser.add_argument("--cases", default=",".join(CASES), help=f"comma-separated cases ({', '.join(CASES)})")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the stand-in waits per response")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    cases = [name for name in args.cases.split(",") if name]
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    print("-" * 70)
+    print(f"{'case':>12} {'size':>8} {'median (ms)':>14} {'min (ms)':>12}")
+    results = run([size for size in args.sizes.split(",") if size], cases, repeat=args.repeat, latency=args.latency)
+    print("-" * 70)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        print("-" * 70)
+        for name, size, change in regressions:
+            print(f"regression: {name} at {size} is {change:+.1%} slower")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Synthetic datasets for benchmarks
+-------------------------------------------------------------------------------
+"""
+
+import random
+
+from api.device import Camera, Trap
+
+# Rough bounding box of the City of Edmonton
+SOUTH, NORTH = 53.39, 53.72
+WEST, EAST = -113.71, -113.27
+
+DIRECTIONS = ["Northbound", "Eastbound", "Southbound", "Westbound"]
+ABBREVIATIONS = ["NB", "EB", "SB", "WB"]
+
+
+def random_coords(rng:random.Random):
+    return rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST)
+
+
+def make_cameras(n:int, seed:int=0):
+    '''
+    Build n Camera() objects scattered over Edmonton
+
+    :param n        int     Number of cameras
+    :param seed     int     Random seed, so runs are comparable
+    '''
+    rng = random.Random(seed)
+    return [Camera(site_id=f"SYN_CAM_{i}",
+                   speed=rng.choice((30, 40, 50, 60, 70, 80)),
+                   direction=rng.choice(DIRECTIONS),
+                   location=f"{rng.randint(1, 200)} Street at {rng.randint(1, 200)} Avenue",
+                   coords=random_coords(rng)) for i in range(n)]
+
+
+def make_traps(n:int, seed:int=1):
+    '''
+    Build n Trap() objects scattered over Edmonton
+
+    :param n        int     Number of traps
+    :param seed     int     Random seed, so runs are comparable
+    '''
+    rng = random.Random(seed)
+    return [Trap(site_id=f"SYN_TRAP_{i}",
+                 speed=rng.choice((30, 40, 50, 60, 70, 80)),
+                 direction=rng.choice(ABBREVIATIONS),
+                 location=f"{rng.randint(1, 200)} St between {rng.randint(1, 200)} - {rng.randint(1, 200)} Ave",
+                 coords=random_coords(rng)) for i in range(n)]
+
+
+def camera_rows(n:int, seed:int=0):
+    '''
+    n rows shaped like the intersection camera dataset, including the columns driftkit doesn't read
+
+    :param n        int     Number of rows
+    :param seed     int     Random seed, so runs are comparable
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        lat, lon = random_coords(rng)
+        rows.append({
+            ":id": f"row-cam-{i:07d}",
+            ":updated_at": f"2024-01-{1 + i % 28:02d}T00:00:00.000Z",
+            "site_id": f"SYN_CAM_{i}",
+            "posted_speed": f"{rng.choice((30, 40, 50, 60, 70, 80))} km/h",
+            "travel_direction": rng.choice(DIRECTIONS),
+            "approach": f"{rng.randint(1, 200)} Street",
+            "cross_street": f"at {rng.randint(1, 200)} Avenue",
+            "latitude": f"{lat:.8f}",
+            "longitude": f"{lon:.8f}",
+            "location": {"type": "Point", "coordinates": [round(lon, 8), round(lat, 8)]},
+            "geo_location": {"latitude": f"{lat:.8f}", "longitude": f"{lon:.8f}", "human_address": "{}"},
+            "enforcement_start_date": "2010-01-01T00:00:00.000",
+            "camera_type": rng.choice(("Red Light", "Speed on Green", "Red Light and Speed on Green")),
+            "ward": f"Ward {rng.randint(1, 12)}",
+            "neighbourhood": f"Neighbourhood {rng.randint(1, 400)}",
+        })
+    return rows
+
+
+def trap_rows(n:int, seed:int=1):
+    '''
+    n rows shaped like the speed trap zone dataset, including the columns driftkit doesn't read
+
+    :param n        int     Number of rows
+    :param seed     int     Random seed, so runs are comparable
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        lat, lon = random_coords(rng)
+        rows.append({
+            ":id": f"row-trap-{i:07d}",
+            ":updated_at": f"2024-01-{1 + i % 28:02d}T00:00:00.000Z",
+            "site_id": f"SYN_TRAP_{i}",
+            "speed_limit": str(rng.choice((30, 40, 50, 60, 70, 80))),
+            "location_description": f"{rng.choice(ABBREVIATIONS)} {rng.randint(1, 200)} St between "
+                                    f"{rng.randint(1, 200)} - {rng.randint(1, 200)} Ave",
+            "latitude": f"{lat:.8f}",
+            "longitude": f"{lon:.8f}",
+            "location": {"type": "Point", "coordinates": [round(lon, 8), round(lat, 8)]},
+            "reason_codes": "Collisions, Speeding, Community Concern",
+            "enforcement_zone": f"Zone {rng.randint(1, 900)}",
+            "ward": f"Ward {rng.randint(1, 12)}",
+        })
+    return rows
+
+
+def make_devices(n:int, seed:int=0):
+    '''
+    n devices split the way bench_registry splits them, a quarter cameras and the rest traps
+
+    :param n        int     Number of devices
+    :param seed     int     Random seed, so runs are comparable
+    :return         tuple   (cameras, traps)
+    '''
+    return make_cameras(n // 4, seed), make_traps(n - n // 4, seed + 1)
+
+
+def make_rows(n:int, seed:int=0):
+    '''
+    Rows for n devices, split like make_devices()
+
+    :return     tuple   (camera rows, trap rows)
+    '''
+    return camera_rows(n // 4, seed), trap_rows(n - n // 4, seed + 1)
@@ -21,11 +21,24 @@ Gunicorn config file
 """
 
 import os
+import tempfile
 
 workers = int(os.environ.get('GUNICORN_PROCESSES', '2'))
 threads = int(os.environ.get('GUNICORN_THREADS', '4'))
 bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8080')
 
+# Workers share the device table through this directory (tmpfs where available)
+os.environ.setdefault('DRIFTKIT_SHARED_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'driftkit'))
+
+# Every worker's metrics file is kept until the server restarts, so /metrics still counts workers that have exited
+def on_starting(server):
+    from api.metrics import clear
+    directory = os.environ.get('DRIFTKIT_METRICS_DIR', os.path.join(os.environ['DRIFTKIT_SHARED_DIR'], 'metrics'))
+    if directory:
+        clear(directory)
+
+
 forwarded_allow_ips = '*'
 secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Web app unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+# Keep the app from fetching in the background or reading a saved snapshot while it's under test
+os.environ['DRIFTKIT_REFRESH_INTERVAL'] = '0'
+os.environ['DRIFTKIT_SNAPSHOT_DIR'] = ''
+
+import app
+from api.cache import ResponseCache
+from api.registry import DeviceRegistry
+from benchmarks.synthetic import make_cameras, make_traps
+
+
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+ORIGIN = {"lat": "53.5461", "lon": "-113.4938"}
+
+
+class TestDevicesAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(200), make_traps(300))
+        for name, value in (("registry", self.registry), ("response_cache", ResponseCache())):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def get(self, **params):
+        return self.client.get("/api/devices", query_string=dict(ORIGIN, **params))
+
+    def test_page(self):
+        response = self.get(radius=5, limit=10)
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body["count"], 10)
+        self.assertIsNotNone(body["next"])
+
+        distances = [device["distance"] for device in body["devices"]]
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual(set(body["devices"][0]), {"kind", "site_id", "speed", "direction", "location", "lat", "lon", "distance"})
+
+    def test_cursor(self):
+        # Following "next" visits every device in the radius exactly once
+        seen, cursor = [], None
+        while True:
+            params = dict(radius=5, limit=25, **({"cursor": cursor} if cursor else {}))
+            body = self.get(**params).get_json()
+            seen += [device["site_id"] for device in body["devices"]]
+            cursor = body["next"]
+            if not cursor:
+                break
+
+        everything = self.get(radius=5, limit=1000).get_json()
+        self.assertEqual(seen, [device["site_id"] for device in everything["devices"]])
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_stale_cursor(self):
+        cursor = self.get(radius=5, limit=10).get_json()["next"]
+        self.registry.set_devices(make_cameras(10), [])
+        self.assertEqual(self.get(radius=5, limit=10, cursor=cursor).status_code, 409)
+
+    def test_stream(self):
+        response = self.get(radius=0, limit=0, stream=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+
+        body = json.loads(response.get_data())
+        self.assertEqual(body["count"], 500)
+        self.assertEqual(len(body["devices"]), 500)
+        self.assertIn(body["devices"][0]["kind"], ("camera", "trap"))
+
+    def test_kinds(self):
+        body = self.get(radius=0, limit=1000, kinds="trap").get_json()
+        self.assertEqual(body["count"], 300)
+        self.assertEqual({device["kind"] for device in body["devices"]}, {"trap"})
+
+    def test_heading(self):
+        body = self.get(radius=0, limit=1000, heading=95).get_json()
+        self.assertEqual({device["direction"] for device in body["devices"]}, {"Eastbound"})
+        everything = self.get(radius=0, limit=1000).get_json()
+        self.assertEqual(body["count"], sum(device["direction"] == "Eastbound" for device in everything["devices"]))
+        self.assertEqual(self.get(heading="east").status_code, 400)
+        self.assertEqual(self.get(heading="nan").status_code, 400)
+        self.assertEqual(self.get(heading="inf").status_code, 400)
+
+    def test_bad_request(self):
+        self.assertEqual(self.get(kinds="bus").status_code, 400)
+        self.assertEqual(self.get(limit="ten").status_code, 400)
+        self.assertEqual(self.get(limit=0).status_code, 400)
+        self.assertEqual(self.get(cursor="???").status_code, 400)
+        self.assertEqual(self.client.get("/api/devices", query_string={"lat": "nan", "lon": "-113.4938"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/devices", query_string={"lat": "53.5", "lon": "-inf"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/devices", query_string={"lat": "95", "lon": "-113.4938"}).status_code, 400)
+        self.assertEqual(self.get(radius="nan", stream=1, limit=0).status_code, 400)
+        self.assertEqual(self.get(radius="inf", stream=1, limit=0).status_code, 400)
+        # stream=0 doesn't stream, so it still needs a limit
+        self.assertEqual(self.get(stream=0, limit=0).status_code, 400)
+        self.assertEqual(self.get(stream="false", limit=0).status_code, 400)
+
+    def test_index_limit(self):
+        # The web page treats a limit that isn't a number as no limit
+        response = self.client.get("/", query_string={"address": ":53.5461 -113.4938", "radius": 1, "limit": "abc"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_index_radius(self):
+        # The web page uses the default radius when it isn't a finite number
+        for radius in ("inf", "nan", "abc"):
+            response = self.client.get("/", query_string={"address": ":53.5461 -113.4938", "radius": radius})
+            self.assertEqual(response.status_code, 200)
+
+    def test_not_ready(self):
+        with mock.patch.object(app, "registry", DeviceRegistry()):
+            response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_cached(self):
+        first = self.get(radius=5, limit=10)
+        second = self.get(radius=5, limit=10)
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(app.response_cache.hits, 1)
+        self.assertIn("max-age", first.headers["Cache-Control"])
+
+        # A few metres away is the same cell, so the same response
+        nearby = self.client.get("/api/devices", query_string={"lat": "53.54612", "lon": "-113.49382", "radius": 5, "limit": 10})
+        self.assertEqual(nearby.get_data(), first.get_data())
+        self.assertEqual(app.response_cache.hits, 2)
+
+    def test_etag(self):
+        etag = self.get(radius=5, limit=10).headers["ETag"].strip('"')
+        response = self.client.get("/api/devices", query_string=dict(ORIGIN, radius=5, limit=10),
+                                   headers={"If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+
+        # A refresh publishes a new generation, which changes the ETag and empties the cache
+        self.registry.set_devices(make_cameras(10), [])
+        response = self.client.get("/api/devices", query_string=dict(ORIGIN, radius=5, limit=10),
+                                   headers={"If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(response.get_json()["count"], 10)
+        self.assertEqual(app.response_cache.hits, 0)
+
+
+class TestMetricsAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(200), make_traps(300))
+        for name, value in (("registry", self.registry), ("response_cache", ResponseCache())):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def test_metrics(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get("/", query_string={"address": ":53.5461 -113.4938", "limit": 5}).status_code, 200)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        text = response.get_data(as_text=True)
+        for stage in ("geocode", "search", "render"):
+            self.assertIn(f'driftkit_stage_seconds_count{{stage="{stage}"}}', text)
+        self.assertIn('driftkit_devices{kind="camera"} 200', text)
+        self.assertIn('driftkit_cache_requests_total{cache="responses",result="hit"} 1', text)
+        self.assertIn('driftkit_requests_total{endpoint="/",status="200"}', text)
+
+
+class TestProfileAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name, value in (("PROFILE_TOKEN", "secret"), ("PROFILE_DIR", self.directory)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app.profiler, "directory", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def post(self, token="secret", **params):
+        return self.client.post("/debug/profile", query_string=params, headers={"Authorization": f"Bearer {token}"})
+
+    def test_profile(self):
+        response = self.post(seconds=5, fraction=0.5)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()["fraction"], 0.5)
+        self.assertEqual(app.profiler.control()["id"], response.get_json()["id"])
+        self.assertEqual(self.post(seconds=5).status_code, 409)
+
+    def test_access(self):
+        self.assertEqual(self.post(token="guess").status_code, 403)
+        self.assertEqual(self.client.post("/debug/profile").status_code, 403)
+        with mock.patch.object(app, "PROFILE_TOKEN", ""):
+            self.assertEqual(self.post(token="").status_code, 404)
+        self.assertIsNone(app.profiler.control())
+
+    def test_bad_request(self):
+        self.assertEqual(self.post(seconds=0).status_code, 400)
+        self.assertEqual(self.post(fraction=2).status_code, 400)
+
+
+class TestRouteAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(500), make_traps(500))
+        patcher = mock.patch.object(app, "registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def test_route(self):
+        path = "53.45,-113.65;53.5,-113.5;53.6,-113.4"
+        body = self.client.get("/api/route", query_string={"path": path, "buffer": 300}).get_json()
+        self.assertEqual(body["count"], len(body["devices"]))
+        self.assertGreater(body["count"], 0)
+        alongs = [device["along"] for device in body["devices"]]
+        self.assertEqual(alongs, sorted(alongs))
+        self.assertTrue(all(device["distance"] <= 0.3 for device in body["devices"]))
+
+        # The same route as JSON
+        route = [[53.45, -113.65], [53.5, -113.5], [53.6, -113.4]]
+        posted = self.client.post("/api/route", json={"route": route, "buffer": 300}).get_json()
+        self.assertEqual(posted, body)
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.get("/api/route").status_code, 400)
+        self.assertEqual(self.client.get("/api/route", query_string={"path": "53.5;-113"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/route", query_string={"path": "53.5,-113.5", "buffer": 0}).status_code, 400)
+        self.assertEqual(self.client.post("/api/route", json={"route": [[53.5]]}).status_code, 400)
+        self.assertEqual(self.client.post("/api/route", json={"route": [[float("nan"), 1], [53.5, -113.5]]}).status_code, 400)
+        self.assertEqual(self.client.post("/api/route", json={"route": [[1000, 1], [53.5, -113.5]]}).status_code, 400)
+        self.assertEqual(self.client.get("/api/route", query_string={"path": "inf,1;53.5,-113.5"}).status_code, 400)
+        # Too long to search
+        self.assertEqual(self.client.post("/api/route", json={"route": [[53.5, -113.5], [-53.5, 66.5]] * 5}).status_code, 400)
+
+
+class TestTrackAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(500), make_traps(500))
+        patcher = mock.patch.object(app, "registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def test_track(self):
+        # Drive north through the synthetic city, one fix every ~110 m
+        fixes = "".join(f"{53.45 + i * 0.001},-113.5\n" for i in range(150)) + "oops\n"
+        response = self.client.post("/api/track", query_string={"distance": 300, "cone": 45}, data=fixes)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+
+        events = [event.split("\n", 1) for event in response.get_data(as_text=True).split("\n\n") if event]
+        names = [name for name, _ in events]
+        self.assertEqual(names[-1], "event: error")
+        self.assertGreater(names.count("event: alert"), 0)
+
+        alerts = [json.loads(data[len("data: "):]) for name, data in events if name == "event: alert"]
+        self.assertEqual(len({(a["kind"], a["site_id"], a["lat"], a["lon"]) for a in alerts}), len(alerts))
+        self.assertTrue(all(a["distance"] <= 0.3 for a in alerts))
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.post("/api/track", query_string={"distance": 0}).status_code, 400)
+        self.assertEqual(self.client.post("/api/track", query_string={"cone": "wide"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/track", query_string={"kinds": "bus"}).status_code, 400)
+
+
+class TestBatchAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(200), make_traps(300))
+        places = {"downtown": (53.5461, -113.4938), "whyte ave": (53.5189, -113.4969)}
+        for name, value in (("registry", self.registry),
+                            ("address_to_coords", lambda location, logger: places.get(location.lower()))):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def test_batch(self):
+        response = self.client.post("/api/batch", json={"addresses": ["Downtown", "downtown", "Whyte Ave", "Nowhere"],
+                                                        "radius": 2, "limit": 5, "kinds": ["camera"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+
+        results = {r["address"]: r for r in map(json.loads, response.get_data().splitlines())}
+        self.assertEqual(set(results), {"Downtown", "Whyte Ave", "Nowhere"})
+        self.assertIn("error", results["Nowhere"])
+        self.assertLessEqual(results["Downtown"]["count"], 5)
+        self.assertTrue(all(device["kind"] == "camera" for device in results["Whyte Ave"]["devices"]))
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.post("/api/batch", json=["downtown"]).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": [1, 2]}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "kinds": ["bus"]}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "kinds": 5}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "kinds": "camera"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "kinds": [["camera"]]}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "radius": "inf"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"], "radius": "nan"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/batch", json={"addresses": ["a"] * 1001}).status_code, 413)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Batch geocoding unit tests
+-------------------------------------------------------------------------------
+"""
+
+import time
+import logging
+import threading
+import unittest
+
+from api.batch import unique, geocode_all, locate_all
+from api.registry import DeviceRegistry
+from benchmarks.synthetic import make_cameras, make_traps
+
+
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+PLACES = {"a": (53.5461, -113.4938), "b": (53.6, -113.5), "c": None}
+
+
+def geocode(address):
+    if address == "boom":
+        raise OSError("offline")
+    return PLACES.get(address)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_unique(self):
+        self.assertEqual(list(unique(["10220 104 Ave", "", "10220  104 ave,", "  ", "Whyte Ave"])),
+                         ["10220 104 Ave", "Whyte Ave"])
+
+    def test_geocode_all(self):
+        found = dict(geocode_all(["a", "b", "c", "boom"], geocode))
+        self.assertEqual(found, {"a": PLACES["a"], "b": PLACES["b"], "c": None, "boom": None})
+
+    def test_completion_order(self):
+        # A slow lookup doesn't hold back the ones after it
+        def slow(address):
+            if address == "slow":
+                time.sleep(0.2)
+            return (53.5, -113.5)
+
+        order = [address for address, _ in geocode_all(["slow", "a", "b"], slow, workers=3)]
+        self.assertEqual(order[-1], "slow")
+
+    def test_stop_early(self):
+        # Lookups that haven't started are cancelled when the caller stops reading
+        started = []
+        lock = threading.Lock()
+
+        def counted(address):
+            with lock:
+                started.append(address)
+            time.sleep(0.05)
+            return (53.5, -113.5)
+
+        results = geocode_all([str(i) for i in range(20)], counted, workers=1)
+        next(results)
+        results.close()
+        time.sleep(0.2)
+        self.assertLess(len(started), 20)
+
+    def test_locate_all(self):
+        registry = DeviceRegistry()
+        registry.set_devices(make_cameras(100), make_traps(100))
+
+        results = {r["address"]: r for r in locate_all(["a", "A", "b", "c"], geocode, registry, radius=5000, k=3)}
+        self.assertEqual(set(results), {"a", "b", "c"})
+        self.assertEqual(results["a"]["count"], len(results["a"]["devices"]))
+        self.assertLessEqual(results["a"]["count"], 3)
+        self.assertIn("error", results["c"])
+
+        distances = [device["distance"] for device in results["b"]["devices"]]
+        self.assertEqual(distances, sorted(distances))
+
+
+if __name__ == '__main__':
+    unittest.main()
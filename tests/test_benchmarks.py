@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Benchmark suite smoke tests
+-------------------------------------------------------------------------------
+"""
+
+import io
+import os
+import json
+import unittest
+from unittest import mock
+
+# The suite points the webserver's settings away from the network when it's imported, and
+# its cases import the webserver later on, so that has to happen before they're restored
+with mock.patch.dict(os.environ):
+    from benchmarks import suite
+    import app
+
+
+class TestSuite(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = suite.run(["300"], list(suite.CASES), repeat=1, latency=0, output=io.StringIO())
+
+    def test_results(self):
+        # Every case ran, and the results survive a trip through JSON
+        results = json.loads(json.dumps(self.results))
+        self.assertEqual([result["case"] for result in results["results"]], list(suite.CASES))
+        for result in results["results"]:
+            self.assertGreater(result["median"], 0)
+            self.assertEqual(len(result["runs"]), 1)
+        self.assertIn("commit", results["environment"])
+
+    def test_skipped(self):
+        with mock.patch.object(suite, "CASES", dict(suite.CASES, parse=(suite.parse, "", 100))):
+            results = suite.run(["300"], ["parse"], repeat=1, output=io.StringIO())
+        self.assertIn("skipped", results["results"][0])
+
+    def test_compare(self):
+        baseline = json.loads(json.dumps(self.results))
+        for result in baseline["results"]:
+            result["median"] /= 2 if result["case"] == "query" else 0.5
+        regressions = suite.compare(self.results, baseline, threshold=0.25, output=io.StringIO())
+        self.assertEqual([(name, size) for name, size, _ in regressions], [("query", "300")])
+
+    def test_sizes(self):
+        self.assertEqual(suite.parse_size("1M"), ("1m", 1000000))
+        self.assertEqual(suite.parse_size("2500"), ("2500", 2500))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Response cache unit tests
+-------------------------------------------------------------------------------
+"""
+
+import unittest
+
+from api import geohash
+from api.cache import ResponseCache, quantize
+
+
+class TestQuantize(unittest.TestCase):
+
+    def test_same_cell(self):
+        cell, origin = quantize((53.5461, -113.4938))
+        self.assertEqual(quantize((53.54612, -113.49382)), (cell, origin))
+        self.assertEqual(geohash.encode(origin[0], origin[1], 7), cell)
+
+    def test_error(self):
+        # The snapped origin is within half a cell of where the search started
+        dlat, dlon = geohash.cell_size(7)
+        _, origin = quantize((53.5461, -113.4938))
+        self.assertLessEqual(abs(origin[0] - 53.5461), dlat / 2)
+        self.assertLessEqual(abs(origin[1] + 113.4938), dlon / 2)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = ResponseCache()
+        self.assertIsNone(cache.get("a", 1))
+        cache.put("a", 1, b"body")
+        self.assertEqual(cache.get("a", 1), b"body")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru(self):
+        cache = ResponseCache(size=2)
+        cache.put("a", 1, b"a")
+        cache.put("b", 1, b"b")
+        cache.get("a", 1)
+        cache.put("c", 1, b"c")
+        self.assertIsNone(cache.get("b", 1))
+        self.assertEqual(cache.get("a", 1), b"a")
+        self.assertEqual(cache.evictions, 1)
+
+    def test_generation(self):
+        cache = ResponseCache()
+        cache.put("a", 1, b"old")
+        self.assertIsNone(cache.get("a", 2))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+        # A response rendered from an older snapshot isn't stored
+        cache.put("a", 1, b"old")
+        self.assertIsNone(cache.get("a", 2))
+
+    def test_etag(self):
+        self.assertEqual(ResponseCache.etag(("api", "c3x2"), 1), ResponseCache.etag(("api", "c3x2"), 1))
+        self.assertNotEqual(ResponseCache.etag(("api", "c3x2"), 1), ResponseCache.etag(("api", "c3x2"), 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
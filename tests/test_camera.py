@@ -22,9 +22,10 @@ Camera unit tests
 -------------------------------------------------------------------------------
 """
 
+import copy
 import unittest
 
-from api.device import Camera, Device
+from api.device import Camera, Device, direction_code, heading_direction
 
 class TestCamera(unittest.TestCase):
     def test_init(self):
@@ -132,4 +133,45 @@ class TestCamera(unittest.TestCase):
         
         camera_1.refresh((50, -100))
         camera_2.refresh((50, -100))
-        self.assertEqual(camera_1, camera_2)
\ No newline at end of file
+        self.assertEqual(camera_1, camera_2)
+
+    def test_compact(self):
+        camera = Camera(
+            site_id="TEST_COMPACT",
+            speed=50,
+            direction="".join(["South", "bound"]),
+            location="109 Street at 104 Avenue",
+            coords=(53.54646216, -113.5085364)
+        )
+        self.assertFalse(hasattr(camera, "__dict__"))
+        self.assertIs(camera.get_direction(), "Southbound")
+
+        camera.coords = (50, -100)
+        self.assertEqual(camera.get_coords(), (50, -100))
+
+    def test_direction_code(self):
+        self.assertEqual(direction_code("Northbound"), 1)
+        self.assertEqual(direction_code("WB"), 4)
+        self.assertEqual(direction_code(" southbound "), 3)
+        self.assertEqual(direction_code("Both Directions"), 0)
+        self.assertEqual(direction_code(""), 0)
+
+        # Quarter circles around each compass point
+        self.assertEqual([heading_direction(h) for h in (0, 44, 46, 134, 180, 224, 226, 314, 316, 359, -90)],
+                         [1, 1, 2, 2, 3, 3, 4, 4, 1, 1, 4])
+
+    def test_copy(self):
+        camera = Camera(
+            site_id="TEST_COPY",
+            speed=50,
+            direction="Southbound",
+            location="109 Street at 104 Avenue",
+            coords=(53.54646216, -113.5085364)
+        )
+        copied = copy.copy(camera)
+        copied.refresh((50, -100))
+
+        self.assertIsInstance(copied, Camera)
+        self.assertEqual(copied.get_site_id(), "TEST_COPY")
+        self.assertEqual(copied.get_icon(), "📷")
+        self.assertEqual(camera.get_distance(), 0.0)
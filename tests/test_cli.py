@@ -22,13 +22,22 @@ CLI unit tests
 -------------------------------------------------------------------------------
 """
 
+import io
+import os
 import sys
+import json
 import logging
+import tempfile
 import unittest
+from unittest import mock
 
+# Keep the tests away from the developer's geocode cache
+os.environ['DRIFTKIT_GEOCODE_CACHE'] = ''
 
 from api import cli
+from api.geocache import GeocodeCache
 from api.device import Camera, Trap
+from api.registry import DeviceRegistry
 
 
 logger = logging.getLogger(__name__)
@@ -54,6 +63,13 @@ TRAPS = [   # Only used for printing tests
 
 class TestDriftkit(unittest.TestCase):
 
+    def setUp(self):
+        # api.cli may have been imported (with its on-disk cache) by another test module first;
+        # an empty in-memory cache for each test means every lookup really goes to Nominatim
+        patcher = mock.patch.object(cli, "geocode_cache", GeocodeCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_load_cameras(self):
         # Returns a populated list on 200 response code, empty list otherwise
         cameras = cli.load_all_cameras(logger=logger)
@@ -105,3 +121,53 @@ class TestDriftkit(unittest.TestCase):
         self.assertIsNone(cli.address_to_coords(location="", logger=logger))
         self.assertIsNone(cli.address_to_coords(location="INVALID-ADDRESS", logger=logger))
         self.assertIsNone(cli.address_to_coords(location=":INVALID_LATITUDE INVALID_LONGITUDE", logger=logger))
+
+    def test_print_count(self):
+        # Only the closest few are printed, without sorting the caller's list
+        cli.refresh_devices(devices=CAMERAS, coords=(50, -113))
+        cameras = list(reversed(CAMERAS))
+        self.assertIsNone(cli.print_cameras(cameras=cameras, lite=True, count=2))
+        self.assertIsNone(cli.print_traps(traps=TRAPS, count=2))
+        self.assertEqual(cameras, list(reversed(CAMERAS)))
+
+    def test_closest_devices(self):
+        index = DeviceRegistry()
+        index.set_devices(CAMERAS, TRAPS)
+
+        nearest = cli.closest_devices(CAMERAS, index, coords=(50, -113), kind="camera", count=2)
+        self.assertEqual([c.get_site_id() for c in nearest], ["TEST_CAM_1", "TEST_CAM_2"])
+        self.assertEqual(len(cli.closest_devices(TRAPS, index, coords=(50, -113), kind="trap")), 5)
+
+    def test_batch(self):
+        # One JSON line per distinct address, read from stdin
+        index = DeviceRegistry()
+        index.set_devices(CAMERAS, TRAPS)
+        output = io.StringIO()
+        places = {"first": (50.5, -113.5), "second": (50.45, -113.7)}
+
+        with mock.patch.object(cli, "load_registry", return_value=index), \
+                mock.patch.object(cli, "address_to_coords", lambda location, logger: places.get(location)), \
+                mock.patch.object(sys, "stdin", io.StringIO("first\nsecond\nfirst\n\nthird\n")):
+            cli.batch(["--radius", "0", "--count", "2", "--kinds", "trap"], output=output)
+
+        results = {r["address"]: r for r in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(set(results), {"first", "second", "third"})
+        self.assertEqual([d["site_id"] for d in results["first"]["devices"]], ["TEST_TRAP_1", "TEST_TRAP_2"])
+        self.assertIn("error", results["third"])
+
+    def test_track(self):
+        # Alerts for the cameras coming up, with a bad line skipped
+        index = DeviceRegistry()
+        index.set_devices(CAMERAS, TRAPS)
+        output = io.StringIO()
+        fixes = "50.5400,-113.5085,0\nnot a fix\n50.5420,-113.5085\n50.5440,-113.5085\n"
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write(fixes)
+        self.addCleanup(os.remove, f.name)
+        with mock.patch.object(cli, "load_registry", return_value=index):
+            cli.track([f.name, "--distance", "0.3", "--kinds", "camera"], output=output)
+
+        alerts = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([a["site_id"] for a in alerts], ["TEST_CAM_1"])
+        self.assertLessEqual(alerts[0]["distance"], 0.3)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Shared HTTP client unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from api import client
+
+
+class TestClient(unittest.TestCase):
+
+    def test_session(self):
+        # Every thread gets the same pooled session
+        with ThreadPoolExecutor(8) as pool:
+            sessions = set(pool.map(lambda _: id(client.session()), range(32)))
+        self.assertEqual(len(sessions), 1)
+
+        adapter = client.session().get_adapter("https://data.edmonton.ca")
+        self.assertEqual(adapter._pool_maxsize, client.POOL_SIZE)
+        self.assertEqual(adapter.max_retries.total, client.RETRIES["total"])
+
+    def test_timeout(self):
+        with mock.patch.object(client.session(), "get") as get:
+            client.get("https://data.edmonton.ca/resource/test.json", params={"$limit": 1})
+            get.assert_called_once_with("https://data.edmonton.ca/resource/test.json",
+                                        params={"$limit": 1}, timeout=client.TIMEOUT)
+
+    def test_geolocator(self):
+        self.assertIs(client.geolocator(), client.geolocator())
+
+    def test_rate_limiter(self):
+        # 5 calls at 20 per second, from several threads, take at least 4 intervals
+        limiter = client.RateLimiter(20)
+        start = time.monotonic()
+        with ThreadPoolExecutor(5) as pool:
+            list(pool.map(lambda _: limiter.wait(), range(5)))
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20 - 0.01)
+
+    def test_shared_rate_limiter(self):
+        # Limiters sharing a file (as gunicorn's workers do) keep to one rate between them
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "nominatim.next")
+            limiters = [client.RateLimiter(20, path=path) for _ in range(5)]
+            start = time.monotonic()
+            with ThreadPoolExecutor(5) as pool:
+                list(pool.map(lambda limiter: limiter.wait(), limiters))
+            self.assertGreaterEqual(time.monotonic() - start, 4 / 20 - 0.01)
+
+    def test_geocode_rate_limited(self):
+        with mock.patch.object(client, "geolocator") as geolocator, \
+                mock.patch.object(client.nominatim_limit, "wait") as wait:
+            client.geocode("10220 104 Ave")
+        wait.assert_called_once_with()
+        geolocator().geocode.assert_called_once_with("10220 104 Ave")
+
+    def test_lazy_imports(self):
+        # The HTTP and geocoding stacks (and NumPy) wait until they're needed, and no token is needed to import
+        env = {k: v for k, v in os.environ.items() if not k.startswith("DRIFTKIT_")}
+        env.update(DRIFTKIT_REFRESH_INTERVAL="0", DRIFTKIT_SNAPSHOT_DIR="")
+        code = "import sys, api.cli, app; print(' '.join(m for m in ('requests', 'urllib3', 'geopy', 'numpy') if m in sys.modules))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.split(), [])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Batch distance engine unit tests
+-------------------------------------------------------------------------------
+"""
+
+import unittest
+from unittest import mock
+
+from haversine import haversine
+
+from api import distance
+from api.device import Camera
+
+
+POINTS = [(53.54646216, -113.5085364), (50, -100), (53.452, -113.51), (55.38572953, -112.0371643)]
+
+
+class TestDistance(unittest.TestCase):
+
+    def check(self):
+        # Same distances as Device.refresh(), whichever path is taken
+        origin = (53.385, -113.35)
+        lats, lons = distance.columns(POINTS)
+        for point, d in zip(POINTS, distance.distances(origin, lats, lons)):
+            camera = Camera(site_id="", speed=0, direction="", location="", coords=point)
+            camera.refresh(origin)
+            self.assertAlmostEqual(float(d), camera.get_distance(), places=9)
+
+    def test_distances(self):
+        self.check()
+
+    def test_distances_pure_python(self):
+        with mock.patch.object(distance, "numpy", None):
+            self.check()
+
+            # Without NumPy the result is bit-for-bit what haversine() gives
+            lats, lons = distance.columns(POINTS[:1])
+            self.assertEqual(distance.distances((53.385, -113.35), lats, lons), [20.79587510590846])
+
+    def test_between(self):
+        for point in POINTS:
+            self.assertEqual(distance.between((50, -100), point), haversine((50, -100), point))
+
+    def test_take(self):
+        for numpy in (distance.load_numpy(), None):
+            with mock.patch.object(distance, "numpy", numpy):
+                lats, _ = distance.columns(POINTS)
+                self.assertEqual([float(x) for x in distance.take(lats, [3, 0])], [55.38572953, 53.54646216])
+
+    def test_refresh(self):
+        cameras = [Camera(site_id="", speed=0, direction="", location="", coords=point) for point in POINTS]
+        distance.refresh(cameras, (50, -100))
+        self.assertEqual(cameras[1].get_distance(), 0.0)
+        self.assertIsInstance(cameras[0].get_distance(), float)
+        self.assertAlmostEqual(cameras[2].get_distance(), haversine((50, -100), POINTS[2]), places=9)
+
+    def test_empty(self):
+        lats, lons = distance.columns([])
+        self.assertEqual(len(distance.distances((50, -100), lats, lons)), 0)
+        self.assertIsNone(distance.refresh([], (50, -100)))
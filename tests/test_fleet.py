@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Fleet unit tests
+-------------------------------------------------------------------------------
+"""
+
+import random
+import logging
+import unittest
+from unittest import mock
+
+from api import distance
+from api.fleet import Fleet
+from api.registry import DeviceRegistry
+from api.track import Tracker
+from benchmarks.synthetic import make_cameras, make_traps
+
+
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+def drive(vehicles:int, ticks:int, seed:int=0):
+    '''
+    Batches of fixes for vehicles wandering around the city, some without a heading
+    '''
+    rng = random.Random(seed)
+    positions = [(rng.uniform(53.45, 53.65), rng.uniform(-113.65, -113.35)) for _ in range(vehicles)]
+    headings = [rng.uniform(0, 360) for _ in range(vehicles)]
+    for _ in range(ticks):
+        batch = []
+        for v, (lat, lon) in enumerate(positions):
+            headings[v] = (headings[v] + rng.uniform(-20, 20)) % 360
+            step = rng.uniform(0, 0.0004)
+            lat += step * distance.cos(distance.radians(headings[v]))
+            lon += step * distance.sin(distance.radians(headings[v])) * 1.7
+            positions[v] = (lat, lon)
+            batch.append({"vehicle": v, "lat": lat, "lon": lon, "heading": headings[v] if v % 3 else None, "time": None})
+        yield batch
+
+
+class TestFleet(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(make_cameras(1000), make_traps(1000))
+
+    def alerts_one_by_one(self, batches):
+        trackers = {}
+        alerts = []
+        for batch in batches:
+            for fix in batch:
+                tracker = trackers.setdefault(fix["vehicle"], Tracker(self.registry))
+                for alert in tracker.update(fix["lat"], fix["lon"], heading=fix["heading"]):
+                    alerts.append((fix["vehicle"], alert["site_id"], alert["distance"]))
+        return alerts
+
+    def test_same_as_tracker(self):
+        batches = list(drive(50, 40))
+        fleet = Fleet(self.registry)
+        alerts = [(a["vehicle"], a["site_id"], a["distance"]) for batch in batches for a in fleet.update(batch)]
+        self.assertGreater(len(alerts), 20)
+        self.assertEqual(sorted(alerts), sorted(self.alerts_one_by_one(batches)))
+        self.assertEqual(len(fleet), 50)
+
+    def test_without_numpy(self):
+        batches = list(drive(20, 20, seed=1))
+        fleet = Fleet(self.registry)
+        with_numpy = [(a["vehicle"], a["site_id"]) for batch in batches for a in fleet.update(batch)]
+        with mock.patch.object(distance, "numpy", None):
+            registry = DeviceRegistry()
+            registry.set_devices(make_cameras(1000), make_traps(1000))
+            fleet = Fleet(registry)
+            without = [(a["vehicle"], a["site_id"]) for batch in batches for a in fleet.update(batch)]
+        self.assertEqual(sorted(without), sorted(with_numpy))
+
+    def test_repeated_vehicle(self):
+        # Both fixes of a vehicle in one batch count, in order
+        fleet = Fleet(self.registry, alert_distance=0.5)
+        batches = list(drive(5, 30, seed=2))
+        flat = [fix for batch in batches for fix in batch]
+        together = [(a["vehicle"], a["site_id"]) for a in fleet.update(flat)]
+        self.assertEqual(sorted(together), sorted((v, s) for v, s, _ in self.alerts_one_by_one(batches)))
+
+    def test_no_snapshot(self):
+        self.assertEqual(Fleet(DeviceRegistry()).update([{"lat": 53.5, "lon": -113.5}]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Geocode cache unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from api import cli
+from api.geocache import GeocodeCache, normalize
+
+
+logger = logging.getLogger(__name__)
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+class TestGeocodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "geocode.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_normalize(self):
+        self.assertEqual(normalize("  109 Street,  107 AVE "), "109 street 107 ave")
+
+    def test_memory(self):
+        cache = GeocodeCache()
+        self.assertIsNone(cache.get("109 Street 107 Ave"))
+        cache.put("109 Street 107 Ave", (53.5513149, -113.5077588))
+        self.assertEqual(cache.get("109 street, 107 ave"), (53.5513149, -113.5077588))
+        self.assertEqual((cache.hits, cache.disk_hits, cache.misses), (1, 0, 1))
+        self.assertEqual(cache.stats()["hit_ratio"], 0.5)
+
+    def test_lru(self):
+        cache = GeocodeCache(size=2)
+        for i in range(3):
+            cache.put(f"address {i}", (i, i))
+        self.assertIsNone(cache.get("address 0"))
+        self.assertEqual(cache.get("address 2"), (2, 2))
+
+    def test_ttl(self):
+        cache = GeocodeCache(path=self.path, ttl=60)
+        cache.put("109 Street 107 Ave", (53.5513149, -113.5077588))
+        with mock.patch("api.geocache.time.time", return_value=cache._entries["109 street 107 ave"][1] + 61):
+            self.assertIsNone(cache.get("109 Street 107 Ave"))
+
+    def test_disk(self):
+        # A new process (new cache object) finds lookups made by another one
+        GeocodeCache(path=self.path).put("109 Street 107 Ave", (53.5513149, -113.5077588))
+        cache = GeocodeCache(path=self.path)
+        self.assertEqual(cache.get("109 Street 107 Ave"), (53.5513149, -113.5077588))
+        self.assertEqual(cache.get("109 Street 107 Ave"), (53.5513149, -113.5077588))
+        self.assertEqual((cache.hits, cache.disk_hits, cache.misses), (1, 1, 0))
+
+    def test_unwritable(self):
+        # Falls back to memory only
+        path = os.path.join(self.path, "not-a-directory", "geocode.sqlite3")
+        with open(self.path, "w"):
+            pass
+        cache = GeocodeCache(path=path, logger=logger)
+        cache.put("109 Street 107 Ave", (53.5513149, -113.5077588))
+        self.assertEqual(cache.get("109 Street 107 Ave"), (53.5513149, -113.5077588))
+        self.assertIsNone(cache.path)
+
+    def test_address_to_coords(self):
+        # Cached addresses never reach Nominatim
+        cache = GeocodeCache()
+        cache.put("109 Street 107 Ave", (53.5513149, -113.5077588))
+        with mock.patch.object(cli, "geocode_cache", cache), \
+             mock.patch.object(cli.client, "geolocator") as geolocator:
+            self.assertEqual(cli.address_to_coords("109 street 107 ave", logger=logger), (53.5513149, -113.5077588))
+            geolocator.assert_not_called()
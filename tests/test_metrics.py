@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Metrics unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import subprocess
+
+from api.metrics import Metrics, STAGE_SECONDS, clear
+
+
+def lines(text:str):
+    return [line for line in text.splitlines() if not line.startswith("#")]
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        metrics = Metrics()
+        metrics.inc("driftkit_requests_total", endpoint="/", status=200)
+        metrics.inc("driftkit_requests_total", endpoint="/", status=200)
+        metrics.inc("driftkit_requests_total", endpoint='/"x"', status=404)
+        text = metrics.render()
+        self.assertIn("# TYPE driftkit_requests_total counter", text)
+        self.assertIn('driftkit_requests_total{endpoint="/",status="200"} 2', text)
+        self.assertIn('driftkit_requests_total{endpoint="/\\"x\\"",status="404"} 1', text)
+
+    def test_histogram(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 2):
+            metrics.observe(STAGE_SECONDS, value, stage="render")
+        self.assertEqual(lines(metrics.render()), [
+            'driftkit_stage_seconds_bucket{stage="render",le="0.1"} 1',
+            'driftkit_stage_seconds_bucket{stage="render",le="1.0"} 3',
+            'driftkit_stage_seconds_bucket{stage="render",le="+Inf"} 4',
+            'driftkit_stage_seconds_sum{stage="render"} 3.05',
+            'driftkit_stage_seconds_count{stage="render"} 4',
+        ])
+
+    def test_timer(self):
+        metrics = Metrics()
+        with self.assertRaises(ZeroDivisionError), metrics.timer("sort"):
+            1 / 0
+        # Stages that fail are still timed
+        self.assertIn('driftkit_stage_seconds_count{stage="sort"} 1', metrics.render())
+
+    def test_collect(self):
+        metrics = Metrics()
+        metrics.describe("driftkit_devices", "gauge", "Devices")
+        metrics.collect(lambda: [("driftkit_devices", {"kind": "camera"}, 12)])
+        self.assertIn('driftkit_devices{kind="camera"} 12', metrics.render())
+
+
+class TestWorkers(unittest.TestCase):
+    '''
+    Several processes writing to one directory, the way gunicorn workers do
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.metrics = Metrics(self.directory)
+        self.metrics.describe("driftkit_devices", "gauge", "Devices")
+
+    def tearDown(self):
+        clear(self.directory)
+        os.rmdir(self.directory)
+
+    def worker(self, requests:int, devices:int):
+        # A separate process that counts some requests, writes its file and exits
+        script = (
+            "import sys\n"
+            "from api.metrics import Metrics, STAGE_SECONDS\n"
+            "m = Metrics(sys.argv[1])\n"
+            "m.describe('driftkit_devices', 'gauge', 'Devices')\n"
+            "m.collect(lambda: [('driftkit_devices', {}, int(sys.argv[3]))])\n"
+            "for _ in range(int(sys.argv[2])):\n"
+            "    m.inc('driftkit_requests_total', endpoint='/')\n"
+            "    m.observe(STAGE_SECONDS, 0.02, stage='render')\n"
+            "m.flush()\n"
+        )
+        subprocess.run([sys.executable, "-c", script, self.directory, str(requests), str(devices)], check=True)
+
+    def test_sum(self):
+        self.worker(3, 100)
+        self.worker(4, 100)
+        self.metrics.inc("driftkit_requests_total", endpoint="/")
+        self.metrics.observe(STAGE_SECONDS, 0.02, stage="render")
+
+        text = self.metrics.render()
+        self.assertIn('driftkit_requests_total{endpoint="/"} 8', text)
+        self.assertIn('driftkit_stage_seconds_count{stage="render"} 8', text)
+        self.assertIn('driftkit_stage_seconds_bucket{stage="render",le="0.025"} 8', text)
+        self.assertIn('driftkit_stage_seconds_bucket{stage="render",le="0.01"} 0', text)
+
+        # Both workers have exited, so their gauges are gone
+        self.assertNotIn("driftkit_devices ", text)
+
+    def test_live_gauges(self):
+        # A file written by a process that's still running (our parent) counts for gauges
+        self.metrics.collect(lambda: [("driftkit_devices", {}, 100)])
+        snapshot = dict(self.metrics.snapshot(), pid=os.getppid(), gauges=[["driftkit_devices", [], 250]])
+        with open(os.path.join(self.directory, f"metrics-{os.getppid()}.json"), "w") as f:
+            json.dump(snapshot, f)
+        self.assertIn("driftkit_devices 250", self.metrics.render())
+
+    def test_own_file(self):
+        # This process's own numbers come from memory, not from its last flush
+        self.metrics.inc("driftkit_requests_total", endpoint="/")
+        self.metrics.flush()
+        self.metrics.inc("driftkit_requests_total", endpoint="/")
+        self.assertIn('driftkit_requests_total{endpoint="/"} 2', self.metrics.render())
+
+    def test_clear(self):
+        self.worker(1, 1)
+        clear(self.directory)
+        self.assertNotIn("driftkit_requests_total", self.metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Sampling profiler unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from api.profiler import Profiler, Sampler, CONTROL_FILE
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class Busy:
+    '''
+    A thread burning CPU in spin() until the with block ends
+    '''
+
+    def __enter__(self):
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=spin, args=(self.stop,), name="busy")
+        self.thread.start()
+        return self.thread
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+class TestSampler(unittest.TestCase):
+
+    def test_sample(self):
+        sampler = Sampler(interval=0.005)
+        with Busy():
+            sampler.run(0.2)
+        self.assertGreater(sampler.samples, 5)
+        busy = [stack for stack in sampler.stacks if stack.startswith("busy;")]
+        self.assertTrue(busy)
+        self.assertTrue(any(stack.split(";")[-1].startswith("spin (") for stack in busy))
+
+        # The sampling thread never shows up
+        self.assertFalse(any("Sampler.run" in stack for stack in sampler.stacks))
+
+    def test_threads(self):
+        sampler = Sampler(interval=0.005, threads=set())
+        with Busy() as thread:
+            sampler.run(0.05)
+            self.assertEqual(sum(sampler.stacks.values()), 0)
+            sampler.threads.add(thread.ident)
+            sampler._stop.clear()
+            sampler.run(0.05)
+        self.assertTrue(all(stack.startswith("busy;") for stack in sampler.stacks))
+        self.assertGreater(sum(sampler.stacks.values()), 0)
+
+    def test_write(self):
+        sampler = Sampler()
+        sampler.stacks.update({"main;a (x.py:1);b (x.py:2)": 3, "main;a (x.py:1)": 1})
+        path = os.path.join(tempfile.mkdtemp(), "out.collapsed")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sampler.write(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "main;a (x.py:1);b (x.py:2) 3\nmain;a (x.py:1) 1\n")
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.profiler = Profiler(self.directory, interval=0.005)
+
+    def test_start(self):
+        control = self.profiler.start(0.2)
+        self.assertEqual(self.profiler.control(), control)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, CONTROL_FILE)))
+
+        # One profile at a time
+        with self.assertRaises(RuntimeError):
+            self.profiler.start(1)
+
+        with Busy():
+            path = self.profiler.run(control)
+        self.assertEqual(os.path.basename(path), f"{control['id']}-{os.getpid()}.collapsed")
+        with open(path) as f:
+            self.assertIn("spin (", f.read())
+
+    def test_invalid(self):
+        for seconds, fraction in ((0, None), (10 ** 6, None), (1, 0), (1, 1.5)):
+            with self.assertRaises(ValueError):
+                self.profiler.start(seconds, fraction)
+
+    def test_requests(self):
+        # With a fraction, only threads inside a sampled request are recorded
+        control = dict(self.profiler.start(0.3, fraction=1.0))
+        stacks = []
+
+        def request():
+            while self.profiler.sampler is None:
+                time.sleep(0.001)
+            self.assertTrue(self.profiler.enter())
+            end = time.monotonic() + 0.1
+            while time.monotonic() < end:
+                sum(range(1000))
+            self.profiler.leave()
+            stacks.append(set(self.profiler.sampler.threads))
+
+        thread = threading.Thread(target=request, name="request")
+        thread.start()
+        with Busy():
+            path = self.profiler.run(control)
+        thread.join()
+
+        self.assertEqual(stacks, [set()])
+        with open(path) as f:
+            roots = {line.split(";")[0] for line in f}
+        self.assertEqual(roots, {"request"})
+
+    def test_idle(self):
+        # Outside a profile, requests aren't sampled
+        self.assertFalse(self.profiler.enter())
+        self.profiler.leave()
+
+
+if __name__ == '__main__':
+    unittest.main()
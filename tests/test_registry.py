@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Device registry unit tests
+-------------------------------------------------------------------------------
+"""
+
+import time
+import logging
+import unittest
+from unittest import mock
+
+from api.device import Camera, Trap
+from api.registry import DeviceRegistry
+
+
+logger = logging.getLogger(__name__)
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+CAMERAS = [
+        Camera(site_id="TEST_CAM_1", speed=50, direction="Southbound", location="109 Street at 104 Avenue", coords=(53.54646216, -113.5085364)),
+        Camera(site_id="TEST_CAM_2", speed=60, direction="Northbound", location="", coords=(53.5513149, -113.5077588)),
+        Camera(site_id="TEST_CAM_3", speed=70, direction="Eastbound", location="", coords=(53.45, -113.35)),
+]
+
+TRAPS = [
+        Trap(site_id="TEST_TRAP_1", speed=50, direction="SB", location="156 St between 99 - 98 Ave", coords=(53.54, -113.6)),
+        Trap(site_id="TEST_TRAP_2", speed=50, direction="NB", location="", coords=(53.3, -113.2)),
+]
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(CAMERAS, TRAPS)
+
+    def test_ready(self):
+        self.assertFalse(DeviceRegistry().ready())
+        self.assertTrue(self.registry.ready())
+
+    def test_load_cameras(self):
+        cameras = self.registry.load_cameras(coords=(53.5461, -113.4938), radius=2000)
+        self.assertEqual(sorted(c.get_site_id() for c in cameras), ["TEST_CAM_1", "TEST_CAM_2"])
+        for camera in cameras:
+            self.assertIsInstance(camera, Camera)
+            self.assertGreater(camera.get_distance(), 0)
+
+    def test_load_traps(self):
+        traps = self.registry.load_traps(coords=(53.5461, -113.4938), radius=10000)
+        self.assertEqual([t.get_site_id() for t in traps], ["TEST_TRAP_1"])
+        self.assertIsInstance(traps[0], Trap)
+        self.assertEqual(traps[0].get_direction(), "Southbound")
+
+    def test_copies(self):
+        # Queries must not touch the shared devices
+        camera = self.registry.load_cameras(coords=(53.5461, -113.4938), radius=2000)[0]
+        self.assertIsNot(camera, CAMERAS[0])
+        self.assertEqual(CAMERAS[0].get_distance(), 0.0)
+
+    def test_snapshot_swap(self):
+        # A query holding the old snapshot keeps its devices after a swap
+        old = self.registry.snapshot
+        self.registry.set_devices(CAMERAS[:1], [])
+        self.assertEqual(len(old.cameras), 3)
+        self.assertEqual(len(self.registry.snapshot.cameras), 1)
+        self.assertEqual(self.registry.snapshot.generation, old.generation + 1)
+
+    def test_failed_load_keeps_snapshot(self):
+        # No network (or a bad response) must not throw away the last good snapshot
+        snapshot = self.registry.snapshot
+        with mock.patch.object(self.registry.camera_feed, "sync", side_effect=OSError("offline")):
+            self.assertFalse(self.registry.load(logger=logger))
+
+        self.assertIs(self.registry.snapshot, snapshot)
+        status = self.registry.status()
+        self.assertTrue(status["ready"])
+        self.assertEqual(status["failures"], 1)
+        self.assertIn("offline", status["last_result"])
+
+    def test_background_refresh(self):
+        registry = DeviceRegistry()
+        with mock.patch.object(registry.camera_feed, "sync", return_value=True), \
+             mock.patch.object(registry.camera_feed, "devices", return_value=CAMERAS), \
+             mock.patch.object(registry.trap_feed, "sync", return_value=True), \
+             mock.patch.object(registry.trap_feed, "devices", return_value=TRAPS):
+            registry.start(interval=0.01, logger=logger)
+            deadline = time.time() + 5
+            while (not registry.ready() or registry.snapshot.generation < 2) and time.time() < deadline:
+                time.sleep(0.01)
+            registry.stop()
+
+        self.assertTrue(registry.ready())
+        self.assertGreaterEqual(registry.snapshot.generation, 2)
+        self.assertEqual(registry.status()["last_result"], "ok")
+
+    def test_not_modified(self):
+        # Nothing changed upstream, so the snapshot is not rebuilt
+        snapshot = self.registry.snapshot
+        with mock.patch.object(self.registry.camera_feed, "sync", return_value=False), \
+             mock.patch.object(self.registry.trap_feed, "sync", return_value=False):
+            self.assertTrue(self.registry.load(logger=logger))
+
+        self.assertIs(self.registry.snapshot, snapshot)
+        self.assertEqual(self.registry.status()["last_result"], "not modified")
+
+    def test_nearest(self):
+        nearest = self.registry.nearest(coords=(53.5461, -113.4938), k=3)
+        self.assertEqual([d.get_site_id() for d in nearest], ["TEST_CAM_1", "TEST_CAM_2", "TEST_TRAP_1"])
+        self.assertEqual(nearest, sorted(nearest))
+
+        traps = self.registry.nearest(coords=(53.5461, -113.4938), k=3, kinds=("trap",))
+        self.assertEqual([d.get_site_id() for d in traps], ["TEST_TRAP_1", "TEST_TRAP_2"])
+
+        near = self.registry.nearest(coords=(53.5461, -113.4938), k=5, radius=2000)
+        self.assertEqual(len(near), 2)
+
+    def test_heading(self):
+        # Heading north passes the northbound camera and trap but not the southbound ones
+        north = self.registry.nearest(coords=(53.5461, -113.4938), k=5, heading=10)
+        self.assertEqual([d.get_site_id() for d in north], ["TEST_CAM_2", "TEST_TRAP_2"])
+
+        matches = self.registry.search((53.5461, -113.4938), radius=200000, heading=190)
+        self.assertEqual([devices[i].get_site_id() for _, _, devices, i in matches], ["TEST_CAM_1", "TEST_TRAP_1"])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Server unit tests
+-------------------------------------------------------------------------------
+"""
+
+import time
+import logging
+import unittest
+from unittest import mock
+
+from api import server
+from api.device import Camera, Trap
+
+
+logger = logging.getLogger(__name__)
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+CAMERA = Camera(site_id="TEST_CAM", speed=50, direction="Southbound", location="", coords=(53.54646216, -113.5085364))
+TRAP = Trap(site_id="TEST_TRAP", speed=50, direction="SB", location="", coords=(53.54, -113.6))
+
+
+def slow(result, seconds):
+    def load(coords, radius, logger):
+        time.sleep(seconds)
+        return [result]
+    return load
+
+
+class TestLoadDevices(unittest.TestCase):
+
+    def test_concurrent(self):
+        # Costs the slower fetch, not the sum of both
+        with mock.patch.object(server, "load_cameras", slow(CAMERA, 0.3)), \
+             mock.patch.object(server, "load_traps", slow(TRAP, 0.3)):
+            start = time.perf_counter()
+            devices = server.load_devices((53.5461, -113.4938), 10000, logger=logger)
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual({d.get_site_id() for d in devices}, {"TEST_CAM", "TEST_TRAP"})
+        self.assertLess(elapsed, 0.55)
+
+    def test_deadline(self):
+        # A slow source is left out instead of holding up the page
+        with mock.patch.object(server, "load_cameras", slow(CAMERA, 0)), \
+             mock.patch.object(server, "load_traps", slow(TRAP, 1)):
+            start = time.perf_counter()
+            devices = server.load_devices((53.5461, -113.4938), 10000, deadline=0.2, logger=logger)
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([d.get_site_id() for d in devices], ["TEST_CAM"])
+        self.assertLess(elapsed, 0.8)
+
+    def test_error(self):
+        with mock.patch.object(server, "load_cameras", side_effect=OSError("offline")), \
+             mock.patch.object(server, "load_traps", slow(TRAP, 0)):
+            devices = server.load_devices((53.5461, -113.4938), 10000, logger=logger)
+        self.assertEqual([d.get_site_id() for d in devices], ["TEST_TRAP"])
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Socrata dataset unit tests
+-------------------------------------------------------------------------------
+"""
+
+import json
+import time
+import logging
+import tracemalloc
+import unittest
+from unittest import mock
+
+from api import client, distance
+from api.device import Camera, Trap
+from api.socrata import CAMERA_COLUMNS, TRAP_COLUMNS, DatasetFeed, RowDecoder, camera_from_row, trap_from_row, \
+    fetch_all, fetch_devices, iter_rows
+from benchmarks.standin import SocrataStandIn
+from benchmarks.synthetic import camera_rows, trap_rows
+
+
+logger = logging.getLogger(__name__)
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+def camera_row(row_id, site_id, updated_at, speed="50 km/h"):
+    return {":id": row_id, ":updated_at": updated_at, "site_id": site_id, "posted_speed": speed,
+            "travel_direction": "Southbound", "approach": "109 Street", "cross_street": "at 104 Avenue",
+            "latitude": "53.54646216", "longitude": "-113.5085364"}
+
+
+def response(status_code, rows=None, etag=None):
+    fake = mock.Mock(status_code=status_code, headers={"ETag": etag} if etag else {})
+    fake.json.return_value = rows
+    body = json.dumps(rows).encode()
+    fake.iter_content.side_effect = lambda chunk_size: (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+    return fake
+
+
+class TestRows(unittest.TestCase):
+
+    def test_camera_from_row(self):
+        camera = camera_from_row(camera_row("row-1", "TEST_ROW", "2024-01-01T00:00:00.000Z"))
+        self.assertIsInstance(camera, Camera)
+        self.assertEqual(camera.get_speed(), 50)
+        self.assertEqual(camera.get_location(), "109 Street at 104 Avenue")
+        self.assertEqual(camera.get_coords(), (53.54646216, -113.5085364))
+
+    def test_trap_from_row(self):
+        trap = trap_from_row({"site_id": "TEST_ROW", "speed_limit": "50", "latitude": "53.5", "longitude": "-113.5",
+                              "location_description": "SB 156 St between 99 - 98 Ave"})
+        self.assertIsInstance(trap, Trap)
+        self.assertEqual(trap.get_direction(), "Southbound")
+        self.assertEqual(trap.get_location(), "156 St between 99 - 98 Ave")
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_iter_rows(self):
+        rows = [camera_row(f"row-{i}", f"S{i}", "2024-01-01T00:00:00.000Z") for i in range(20)]
+        rows += [{"nested": {"list": [1, "]", {"}": "\\\""}]}}, 12345, 1.5e10, -0.25, 3e-07, "text, with [brackets]", None, [], {}]
+        body = json.dumps(rows, indent=1).encode()
+
+        # Wherever the chunks are cut, including inside integers, floats, exponents, strings and multi-byte characters
+        self.assertEqual(list(iter_rows([body])), rows)
+        for size in (1, 2, 3, 7, 64, 1000):
+            self.assertEqual(list(iter_rows(body[i:i + size] for i in range(0, len(body), size))), rows)
+        self.assertEqual(list(iter_rows(["[ 1, \"é\" ]".encode()[i:i + 1] for i in range(11)])), [1, "é"])
+        self.assertEqual(list(iter_rows([b" [ ] "])), [])
+        self.assertEqual(list(iter_rows([b"[1.", b"5e10]"])), [1.5e10])
+        self.assertEqual(list(iter_rows([b"[12", b"3e", b"-2, 4]"])), [1.23, 4])
+
+    def test_invalid(self):
+        for body in (b"", b"{}", b"[1, 2", b"[1 2]", b"[1,]", b"[{]", b'{"error": "rate limited"}'):
+            with self.assertRaises(ValueError):
+                list(iter_rows([body]))
+
+    def test_decoder(self):
+        # Bad rows are counted and left out, the rest still load
+        rows = [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z"),
+                dict(camera_row("row-2", "B", "2024-01-01T00:00:00.000Z"), posted_speed="fast"),
+                {"site_id": "C"},
+                None,
+                "row",
+                dict(camera_row("row-3", "D", "2024-01-01T00:00:00.000Z"), latitude=None),
+                camera_row("row-4", "E", "2024-01-01T00:00:00.000Z")]
+        decode = RowDecoder(camera_from_row, logger)
+        self.assertEqual([camera.get_site_id() for camera in decode(rows)], ["A", "E"])
+        self.assertEqual(decode.skipped, 5)
+
+    def test_memory(self):
+        # Peak memory while decoding a city's worth of rows is the devices, not the body
+        rows = camera_rows(20000)
+        body = json.dumps(rows).encode()
+        del rows
+        chunks = [body[i:i + 16384] for i in range(0, len(body), 16384)]
+
+        tracemalloc.start()
+        try:
+            count = sum(1 for _ in iter_rows(chunks))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(count, 20000)
+        self.assertLess(peak, 200 * 1024)
+        self.assertGreater(len(body), 40 * 200 * 1024)
+
+
+class TestDatasetFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = DatasetFeed("http://localhost/resource/test.json", camera_from_row)
+
+    @mock.patch("api.client.get")
+    def test_delta(self, get):
+        get.return_value = response(200, [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z"),
+                                          camera_row("row-2", "B", "2024-01-02T00:00:00.000Z")], etag='"v1"')
+        self.assertTrue(self.feed.sync(logger=logger))
+        self.assertNotIn("$where", get.call_args.kwargs["params"])
+
+        # Only rows changed since the newest one we have are requested, and merged by :id
+        get.return_value = response(200, [camera_row("row-2", "B", "2024-01-03T00:00:00.000Z", speed="60 km/h")], etag='"v2"')
+        self.assertTrue(self.feed.sync(logger=logger))
+        self.assertEqual(get.call_args.kwargs["params"]["$where"], ":updated_at >= '2024-01-02T00:00:00.000Z'")
+
+        devices = {d.get_site_id(): d for d in self.feed.devices()}
+        self.assertEqual(len(devices), 2)
+        self.assertEqual(devices["B"].get_speed(), 60)
+        self.assertEqual(self.feed.watermark, "2024-01-03T00:00:00.000Z")
+
+    @mock.patch("api.client.get")
+    def test_not_modified(self, get):
+        get.return_value = response(200, [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z")], etag='"v1"')
+        self.feed.sync(logger=logger)
+        get.return_value = response(200, [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z")], etag='"v2"')
+        self.feed.sync(logger=logger)
+
+        # Same query as last time, so its ETag is sent and a 304 is not parsed
+        get.return_value = response(304)
+        self.assertFalse(self.feed.sync(logger=logger))
+        self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"v2"'})
+        get.return_value.iter_content.assert_not_called()
+        self.assertEqual(len(self.feed.devices()), 1)
+
+    @mock.patch("api.client.get")
+    def test_unchanged(self, get):
+        rows = [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z"), camera_row("row-2", "B", "2024-01-02T00:00:00.000Z")]
+        feed = DatasetFeed("http://localhost/resource/test.json", camera_from_row, full_sync_every=2)
+        get.return_value = response(200, rows)
+        self.assertTrue(feed.sync(logger=logger))
+
+        # The delta returns the row at the watermark, and the full download the same rows again
+        get.return_value = response(200, rows[1:])
+        self.assertFalse(feed.sync(logger=logger))
+        get.return_value = response(200, rows)
+        self.assertFalse(feed.sync(logger=logger))
+        self.assertNotIn("$where", get.call_args.kwargs["params"])
+
+        # A row deleted upstream is a change, once a full download notices
+        get.return_value = response(200, rows[1:])
+        feed.sync(logger=logger)
+        self.assertEqual(len(feed.devices()), 2)
+        get.return_value = response(200, rows[1:])
+        self.assertTrue(feed.sync(logger=logger))
+        self.assertEqual(len(feed.devices()), 1)
+
+    @mock.patch("api.client.get")
+    def test_full_sync(self, get):
+        # Periodic full downloads drop rows deleted upstream
+        feed = DatasetFeed("http://localhost/resource/test.json", camera_from_row, full_sync_every=2)
+        get.return_value = response(200, [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z"),
+                                          camera_row("row-2", "B", "2024-01-01T00:00:00.000Z")])
+        feed.sync(logger=logger)
+        get.return_value = response(200, [])
+        feed.sync(logger=logger)
+        self.assertEqual(len(feed.devices()), 2)
+
+        get.return_value = response(200, [camera_row("row-1", "A", "2024-01-01T00:00:00.000Z")])
+        feed.sync(logger=logger)
+        self.assertNotIn("$where", get.call_args.kwargs["params"])
+        self.assertEqual([d.get_site_id() for d in feed.devices()], ["A"])
+
+    @mock.patch("api.client.get")
+    def test_error(self, get):
+        get.return_value = response(500)
+        get.return_value.raise_for_status.side_effect = Exception("500 Server Error")
+        with self.assertRaises(Exception):
+            self.feed.sync(logger=logger)
+
+
+class TestPagedDownload(unittest.TestCase):
+    '''
+    Against a local stand-in for data.edmonton.ca that takes 50 ms to answer each request
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cameras, cls.traps = camera_rows(4500), trap_rows(1200)
+        cls.server = SocrataStandIn({"/cameras.json": cls.cameras, "/traps.json": cls.traps}, latency=0.05)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.reset()
+
+    def test_every_row(self):
+        rows = fetch_all(self.server.url("/cameras.json"), CAMERA_COLUMNS, page_size=500)
+        self.assertEqual([row["site_id"] for row in rows], [row["site_id"] for row in self.cameras])
+        self.assertEqual(set(rows[0]), set(CAMERA_COLUMNS))
+        self.assertEqual(camera_from_row(rows[10]).get_coords(), camera_from_row(self.cameras[10]).get_coords())
+
+        # 9 full pages, then the short one that ends it (plus whatever was already in flight)
+        self.assertLessEqual(self.server.requests, 10 + 3)
+
+        traps = fetch_all(self.server.url("/traps.json"), TRAP_COLUMNS, page_size=400)
+        self.assertEqual(len(traps), 1200)
+
+    def test_one_page(self):
+        # A query that fits in one page costs one request, nothing speculative
+        self.assertEqual(len(fetch_all(self.server.url("/traps.json"), TRAP_COLUMNS, page_size=2000)), 1200)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_bytes(self):
+        # Only the columns we parse, gzipped, against one plain request for everything
+        fetch_all(self.server.url("/cameras.json"), CAMERA_COLUMNS, page_size=1000)
+        paged = self.server.bytes_sent
+
+        self.server.reset()
+        response = client.get(self.server.url("/cameras.json"), params={"$limit": 5000},
+                              headers={"Accept-Encoding": "identity"})
+        self.assertEqual(len(response.json()), 4500)
+        self.assertLess(paged, self.server.bytes_sent / 5)
+
+    def test_wall_time(self):
+        url = self.server.url("/cameras.json")
+        # The first page goes out alone, then the other 18 four at a time
+        start = time.perf_counter()
+        fetch_all(url, CAMERA_COLUMNS, page_size=250, workers=1)
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fetch_all(url, CAMERA_COLUMNS, page_size=250, workers=4)
+        parallel = time.perf_counter() - start
+        self.assertLess(parallel, sequential / 2)
+
+    def test_malformed(self):
+        rows = camera_rows(300)
+        rows[5]["posted_speed"] = None
+        del rows[17]["latitude"]
+        with SocrataStandIn({"/bad.json": rows}) as server:
+            cameras = fetch_devices(server.url("/bad.json"), camera_from_row, CAMERA_COLUMNS, logger=logger)
+            self.assertEqual(len(cameras), 298)
+
+            feed = DatasetFeed(server.url("/bad.json"), camera_from_row, columns=CAMERA_COLUMNS, page_size=100)
+            self.assertTrue(feed.sync(logger=logger))
+            self.assertEqual((len(feed.devices()), feed.skipped), (298, 2))
+
+            # A failed download is logged, and gives no devices rather than an exception
+            self.assertEqual(fetch_devices(server.url("/missing.json"), camera_from_row, CAMERA_COLUMNS, logger=logger), [])
+
+    def test_within_circle(self):
+        # The same query server.load_cameras() makes
+        where = {"$where": "within_circle(geo_location, 53.5461, -113.4938, 3000)"}
+        rows = fetch_all(self.server.url("/cameras.json"), CAMERA_COLUMNS, params=where)
+        expected = [row["site_id"] for row in self.cameras
+                    if distance.between((53.5461, -113.4938), (float(row["latitude"]), float(row["longitude"]))) <= 3]
+        self.assertEqual([row["site_id"] for row in rows], expected)
+        self.assertGreater(len(rows), 0)
+
+    def test_geocode(self):
+        self.server.places["10220 104 Ave, Edmonton, Alberta, Canada"] = (53.5444, -113.4909)
+        with mock.patch.object(client, "NOMINATIM_URL", self.server.url("")), \
+                mock.patch.object(client, "_geolocator", None), \
+                mock.patch.object(client.nominatim_limit, "wait"):
+            location = client.geocode("10220 104 Ave, Edmonton, Alberta, Canada")
+            self.assertEqual((location.latitude, location.longitude), (53.5444, -113.4909))
+
+            # Anything else lands somewhere in Edmonton, the same place every time
+            first, second = client.geocode("Anywhere"), client.geocode("Anywhere")
+            self.assertEqual(first.point, second.point)
+            self.assertTrue(53.39 <= first.latitude <= 53.72 and -113.71 <= first.longitude <= -113.27)
+
+    def test_feed(self):
+        feed = DatasetFeed(self.server.url("/traps.json"), trap_from_row, columns=TRAP_COLUMNS, page_size=500)
+        self.assertTrue(feed.sync(logger=logger))
+        self.assertEqual(len(feed.devices()), 1200)
+        self.assertEqual(feed.watermark, max(row[":updated_at"] for row in self.traps))
+
+        # The first delta only brings back the rows at the watermark, which haven't changed;
+        # asking again is one conditional request and a 304
+        self.assertFalse(feed.sync(logger=logger))
+        self.server.reset()
+        self.assertFalse(feed.sync(logger=logger))
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(feed.devices()), 1200)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Geohash and spatial index unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+from haversine import haversine
+
+from api import geohash, distance
+from api.spatial import GeohashIndex
+
+
+class TestGeohash(unittest.TestCase):
+
+    def test_encode(self):
+        # Reference value from geohash.org
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+
+    def test_decode(self):
+        cell = geohash.encode(53.5461, -113.4938, 7)
+        lat, lon = geohash.decode(cell)
+        self.assertEqual(geohash.encode(lat, lon, 7), cell)
+        self.assertEqual(geohash.decode_cell(cell), geohash.cell_of(53.5461, -113.4938, 7))
+
+    def test_covering(self):
+        # Every point inside the circle must fall in one of the covering cells
+        cells = set(geohash.covering(53.5461, -113.4938, 3, 6))
+        rng = random.Random(0)
+        for _ in range(500):
+            point = (53.5461 + rng.uniform(-0.03, 0.03), -113.4938 + rng.uniform(-0.05, 0.05))
+            if haversine((53.5461, -113.4938), point) <= 3:
+                self.assertIn(geohash.encode(*point, 6), cells)
+
+
+class TestGeohashIndex(unittest.TestCase):
+
+    def test_within(self):
+        # Same answer as checking every point
+        rng = random.Random(1)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(2000)]
+        index = GeohashIndex(points)
+        origin = (53.5461, -113.4938)
+
+        expected = {i for i, point in enumerate(points) if haversine(origin, point) <= 4}
+        found = index.within(origin, 4)
+        self.assertEqual({i for i, _ in found}, expected)
+        for i, distance in found:
+            self.assertAlmostEqual(distance, haversine(origin, points[i]), places=9)
+
+    def test_empty(self):
+        index = GeohashIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.within((53.5461, -113.4938), 10), [])
+
+    def test_nearest(self):
+        # Same answer as sorting every point
+        rng = random.Random(2)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(2000)]
+        index = GeohashIndex(points, precision=6)
+
+        for origin in [(53.5461, -113.4938), (53.2, -113.0), (53.41, -113.69)]:
+            expected = sorted(haversine(origin, point) for point in points)
+            for k in (1, 5, 50):
+                found = index.nearest(origin, k)
+                self.assertEqual(len(found), k)
+                for (i, distance), want in zip(found, expected):
+                    self.assertAlmostEqual(distance, want, places=9)
+
+            # Nothing past the radius, even if that leaves fewer than k
+            within = [d for d in expected if d <= 1.5]
+            self.assertEqual(len(index.nearest(origin, 1000, radius=1.5)), min(len(within), 1000))
+
+    def test_nearest_all(self):
+        index = GeohashIndex([(53.5, -113.5), (53.6, -113.4)])
+        self.assertEqual([i for i, _ in index.nearest((53.5, -113.5), 10)], [0, 1])
+        self.assertEqual(GeohashIndex([]).nearest((53.5, -113.5), 3), [])
+
+    def test_levels(self):
+        # Every level partitions the same points, and each cell holds exactly the points that hash to it
+        rng = random.Random(3)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(500)]
+        index = GeohashIndex(points)
+        self.assertEqual(sorted(index.levels), [4, 5, 6, 7])
+        for level, cells in index.levels.items():
+            self.assertEqual(sum(stop - start for start, stop in cells.values()), len(points))
+            for cell in list(cells)[:20]:
+                self.assertEqual({i for i in index.cell(cell)},
+                                 {i for i, p in enumerate(points) if geohash.encode(*p, level) == cell})
+
+    def test_level_for(self):
+        index = GeohashIndex([(53.5, -113.5)])
+        self.assertEqual(index.level_for((53.5, -113.5), 0.05), 7)
+        self.assertLess(index.level_for((53.5, -113.5), 5), 7)
+        self.assertEqual(index.level_for((53.5, -113.5), 500), 4)
+        for radius in (float("inf"), float("nan")):
+            self.assertRaises(ValueError, index.level_for, (53.5, -113.5), radius)
+
+    def test_huge_radius(self):
+        # Far too many cells to cover, so every point is checked instead
+        rng = random.Random(5)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(500)]
+        index = GeohashIndex(points)
+        for radius in (1e4, 1e5, 1e300):
+            self.assertEqual(sorted(i for i, _ in index.within((53.5, -113.5), radius)), list(range(len(points))))
+        self.assertRaises(ValueError, index.within, (53.5, -113.5), float("inf"))
+
+    def test_save_load(self):
+        rng = random.Random(4)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(1000)]
+        index = GeohashIndex(points)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.index")
+            index.save(path, generation=9)
+            loaded = GeohashIndex.load(path, generation=9)
+            with self.assertRaises(ValueError):
+                GeohashIndex.load(path, generation=10)
+
+            GeohashIndex([]).save(path)
+            self.assertEqual(GeohashIndex.load(path).within((53.5, -113.5), 5), [])
+
+        self.assertEqual(loaded.levels, index.levels)
+        origin = (53.5461, -113.4938)
+        self.assertEqual(sorted(loaded.within(origin, 3)), sorted(index.within(origin, 3)))
+        self.assertEqual(loaded.nearest(origin, 10), index.nearest(origin, 10))
+
+    def test_direction(self):
+        # Only points facing the direction asked for, or facing nowhere in particular
+        rng = random.Random(6)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(2000)]
+        directions = [rng.randrange(5) for _ in points]
+        index = GeohashIndex(points, directions=directions)
+        origin = (53.5461, -113.4938)
+
+        everything = index.within(origin, 5)
+        facing = index.within(origin, 5, direction=2)
+        self.assertEqual(sorted(facing), sorted((i, d) for i, d in everything if directions[i] in (0, 2)))
+        self.assertEqual(index.within(origin, 5, direction=0), everything)
+
+        expected = [i for i, _ in index.nearest(origin, len(points)) if directions[i] in (0, 2)][:10]
+        self.assertEqual([i for i, _ in index.nearest(origin, 10, direction=2)], expected)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.index")
+            index.save(path)
+            self.assertEqual(sorted(GeohashIndex.load(path).within(origin, 5, direction=2)), sorted(facing))
+
+    def test_corridor(self):
+        # Same answer as measuring every point against every segment
+        rng = random.Random(5)
+        points = [(53.4 + rng.random() * 0.3, -113.7 + rng.random() * 0.4) for _ in range(3000)]
+        index = GeohashIndex(points)
+        route = [(53.45, -113.65), (53.5, -113.5), (53.55, -113.52), (53.62, -113.35)]
+
+        found = index.corridor(route, 0.3)
+        lats, lons = [lat for lat, _ in points], [lon for _, lon in points]
+        expected = set()
+        for a, b in zip(route, route[1:]):
+            offsets, _ = distance.to_segment(a, b, lats, lons)
+            expected.update(i for i, offset in enumerate(offsets) if offset <= 0.3)
+        self.assertEqual({i for i, _, _ in found}, expected)
+
+        # Ordered along the route, and every distance is within the buffer
+        alongs = [along for _, along, _ in found]
+        self.assertEqual(alongs, sorted(alongs))
+        self.assertTrue(all(offset <= 0.3 for _, _, offset in found))
+        self.assertLessEqual(alongs[-1], sum(haversine(a, b) for a, b in zip(route, route[1:])))
+
+    def test_corridor_on_route(self):
+        # A point on the route is 0 km from it, as far along as the route's length up to it
+        route = [(53.5, -113.5), (53.5, -113.4), (53.6, -113.4)]
+        index = GeohashIndex([(53.55, -113.4), (53.5, -113.45), (53.7, -113.0)])
+        found = index.corridor(route, 0.05)
+        self.assertEqual([i for i, _, _ in found], [1, 0])
+        self.assertAlmostEqual(found[0][1], haversine(route[0], route[1]) / 2, places=2)
+        self.assertAlmostEqual(found[1][1], haversine(route[0], route[1]) + haversine(route[1], route[2]) / 2, places=2)
+        self.assertAlmostEqual(found[0][2], 0.0, places=6)
+
+        self.assertEqual([i for i, _, _ in index.corridor(route[:1], 1)], [])
+        self.assertEqual(index.corridor([], 1), [])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Device table unit tests
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from api.device import Camera, Trap
+from api.registry import DeviceRegistry
+from api.spatial import GeohashIndex
+from api.table import DeviceTable, write_table
+
+
+logger = logging.getLogger(__name__)
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+
+CAMERAS = [
+        Camera(site_id="TEST_CAM_1", speed=50, direction="Southbound", location="109 Street at 104 Avenue", coords=(53.54646216, -113.5085364)),
+        Camera(site_id="TEST_CAM_2", speed=60, direction="Southbound", location="", coords=(53.5513149, -113.5077588)),
+]
+
+TRAPS = [
+        Trap(site_id="TEST_TRAP_1", speed=50, direction="SB", location="156 St between 99 - 98 Ave", coords=(53.54, -113.6)),
+        Trap(site_id="TEST_TRAP_2", speed=40, direction="", location="", coords=(53.3, -113.2)),
+]
+
+
+class TestDeviceTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "devices.table")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        write_table(self.path, CAMERAS, TRAPS, generation=7)
+        table = DeviceTable(self.path)
+
+        self.assertEqual(table.generation, 7)
+        self.assertEqual((len(table), len(table.cameras), len(table.traps)), (4, 2, 2))
+        for original, view in zip(CAMERAS + TRAPS, list(table.cameras) + list(table.traps)):
+            self.assertIs(type(view), type(original))
+            self.assertEqual(view.get_site_id(), original.get_site_id())
+            self.assertEqual(view.get_speed(), original.get_speed())
+            self.assertEqual(view.get_direction(), original.get_direction())
+            self.assertEqual(view.get_location(), original.get_location())
+            self.assertEqual(view.get_coords(), original.get_coords())
+            self.assertEqual(view.get_icon(), original.get_icon())
+
+    def test_points(self):
+        write_table(self.path, CAMERAS, TRAPS)
+        table = DeviceTable(self.path)
+        self.assertEqual(table.traps.points(), [t.coords for t in TRAPS])
+        self.assertEqual(table.cameras.directions(), [3, 3])
+        self.assertEqual(table.traps.directions(), [3, 0])
+
+    def test_empty(self):
+        write_table(self.path, [], [])
+        self.assertEqual(len(DeviceTable(self.path)), 0)
+
+    def test_invalid(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a table" * 10)
+        with self.assertRaises(ValueError):
+            DeviceTable(self.path)
+
+    def test_follow(self):
+        # A follower serves whatever the leader last wrote
+        registry = DeviceRegistry()
+        self.assertFalse(registry.follow(self.path, logger=logger))
+
+        write_table(self.path, CAMERAS, TRAPS, generation=3)
+        self.assertTrue(registry.follow(self.path, logger=logger))
+        self.assertFalse(registry.follow(self.path, logger=logger))
+        self.assertEqual(registry.snapshot.generation, 3)
+
+        cameras = registry.load_cameras(coords=(53.5461, -113.4938), radius=2000)
+        self.assertEqual(sorted(c.get_site_id() for c in cameras), ["TEST_CAM_1", "TEST_CAM_2"])
+        traps = registry.load_traps(coords=(53.5461, -113.4938), radius=10000)
+        self.assertEqual(traps[0].get_direction(), "Southbound")
+
+    def test_follow_indexes(self):
+        # Indexes saved for the table's generation are loaded instead of rebuilt
+        registry = DeviceRegistry()
+        registry.set_devices(CAMERAS, TRAPS)
+        registry.snapshot.save_indexes(self.directory.name)
+        write_table(self.path, CAMERAS, TRAPS, generation=registry.snapshot.generation)
+
+        follower = DeviceRegistry()
+        with mock.patch("api.registry.GeohashIndex", wraps=GeohashIndex) as index:
+            self.assertTrue(follower.follow(self.path, logger=logger))
+        index.assert_not_called()
+        self.assertEqual(len(follower.load_cameras(coords=(53.5461, -113.4938), radius=2000)), 2)
+
+        # A table from another generation gets fresh indexes
+        write_table(self.path, CAMERAS, TRAPS, generation=5)
+        with mock.patch("api.registry.GeohashIndex", wraps=GeohashIndex) as index:
+            self.assertTrue(follower.follow(self.path, logger=logger))
+        self.assertEqual(index.call_count, 2)
+
+    def test_persist(self):
+        # A new process serves the last snapshot saved by load(), even with no network
+        registry = DeviceRegistry()
+        self.assertFalse(registry.persist(self.directory.name, logger=logger))
+        registry.camera_feed.sync = lambda logger: True
+        registry.camera_feed.devices = lambda: CAMERAS
+        registry.trap_feed.sync = lambda logger: True
+        registry.trap_feed.devices = lambda: TRAPS
+        self.assertTrue(registry.load(logger=logger))
+
+        restarted = DeviceRegistry()
+        restarted.trap_feed.sync = mock.Mock(side_effect=OSError("offline"))
+        self.assertTrue(restarted.persist(self.directory.name, logger=logger))
+        self.assertFalse(restarted.load(logger=logger))
+        self.assertTrue(restarted.ready())
+        self.assertEqual(restarted.snapshot.generation, registry.snapshot.generation)
+        self.assertAlmostEqual(restarted.snapshot.loaded_at, registry.snapshot.loaded_at)
+        self.assertEqual([c.get_site_id() for c in restarted.snapshot.cameras], ["TEST_CAM_1", "TEST_CAM_2"])
+
+    def test_follow_older(self):
+        # A table older than the snapshot we already serve is skipped
+        registry = DeviceRegistry()
+        write_table(self.path, CAMERAS, TRAPS, generation=4)
+        registry.follow(self.path, logger=logger)
+        write_table(self.path, CAMERAS[:1], TRAPS, generation=2)
+        self.assertFalse(registry.follow(self.path, logger=logger))
+        self.assertEqual(registry.snapshot.generation, 4)
+
+    def test_leader(self):
+        # Two processes sharing a directory: one fetches, the other reads its table
+        registries = [DeviceRegistry(), DeviceRegistry()]
+        for registry in registries:
+            registry.camera_feed.sync = lambda logger: True
+            registry.camera_feed.devices = lambda: CAMERAS
+            registry.trap_feed.sync = lambda logger: True
+            registry.trap_feed.devices = lambda: TRAPS
+            registry.start(interval=0.05, logger=logger, directory=self.directory.name)
+
+        deadline = time.time() + 5
+        while not all(r.ready() for r in registries) and time.time() < deadline:
+            time.sleep(0.01)
+        for registry in registries:
+            registry.stop()
+
+        self.assertEqual(sorted(r.leader for r in registries), [False, True])
+        follower = next(r for r in registries if not r.leader)
+        self.assertTrue(follower.ready())
+        self.assertEqual(len(follower.snapshot.cameras), 2)
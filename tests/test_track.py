@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+-------------------------------------------------------------------------------
+Driftkit - yeg speed camera and speed zone locator
+Copyright (C) 2024 Tem Tamre
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+Live GPS track unit tests
+-------------------------------------------------------------------------------
+"""
+
+import logging
+import unittest
+
+from api import distance
+from api.device import Camera, Trap
+from api.registry import DeviceRegistry
+from api.track import Tracker, parse_fix, track
+
+
+logging.disable(logging.CRITICAL)  # Disable logging for tests
+
+# Along 107 Avenue, heading east from 124 Street
+CAMERAS = [
+    Camera(site_id="AHEAD", speed=50, direction="Eastbound", location="", coords=(53.5500, -113.5300)),
+    Camera(site_id="BEHIND", speed=50, direction="Westbound", location="", coords=(53.5500, -113.5450)),
+    Camera(site_id="FAR", speed=60, direction="Eastbound", location="", coords=(53.5500, -113.4000)),
+]
+TRAPS = [
+    Trap(site_id="SIDE", speed=40, direction="NB", location="", coords=(53.5529, -113.5380)),
+]
+
+
+def drive(start_lon, stop_lon, step=0.0005, lat=53.55):
+    '''
+    Fixes every ~33 m along a line of latitude
+    '''
+    lon = start_lon
+    while lon <= stop_lon:
+        yield lat, lon
+        lon += step
+
+
+class TestTrack(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.set_devices(CAMERAS, TRAPS)
+
+    def test_parse_fix(self):
+        self.assertEqual(parse_fix("53.55,-113.54"),
+                         {"lat": 53.55, "lon": -113.54, "heading": None, "time": None, "vehicle": None})
+        self.assertEqual(parse_fix("53.55,-113.54,450,12.5")["heading"], 90)
+        fix = parse_fix('{"lat": 53.55, "lon": -113.54, "time": 3, "vehicle": "bus 9"}')
+        self.assertEqual((fix["time"], fix["vehicle"]), (3, "bus 9"))
+        self.assertIsNone(parse_fix("  "))
+        self.assertIsNone(parse_fix("# recorded on 124 St"))
+        for line in ("53.55", "north,west", "{oops", "[1, 2]", "95,-113"):
+            with self.assertRaises(ValueError):
+                parse_fix(line)
+
+    def test_bearing(self):
+        self.assertAlmostEqual(distance.bearing((53.55, -113.55), (53.56, -113.55)), 0, places=6)
+        self.assertAlmostEqual(distance.bearing((53.55, -113.55), (53.55, -113.54)), 90, places=1)
+        self.assertAlmostEqual(distance.bearing((53.55, -113.55), (53.54, -113.55)), 180, places=6)
+
+    def test_alerts_ahead_once(self):
+        # Headed east at the first fix, then worked out from the track
+        tracker = Tracker(self.registry, alert_distance=0.5, cone=30)
+        self.assertEqual(tracker.update(53.55, -113.5425, heading=90), [])
+        alerts = [(alert["site_id"], lon) for lat, lon in drive(-113.5420, -113.5250) for alert in tracker.update(lat, lon)]
+
+        # Only the camera ahead, once, and only once it was within 500 m
+        self.assertEqual([site_id for site_id, _ in alerts], ["AHEAD"])
+        self.assertLessEqual(distance.between((53.55, alerts[0][1]), (53.55, -113.53)), 0.5)
+        self.assertAlmostEqual(tracker.heading, 90, delta=1)
+
+    def test_side_cone(self):
+        # The trap 450 m away at 45 degrees from the road alerts in a wide cone only
+        wide = Tracker(self.registry, alert_distance=0.5, cone=60, kinds=("trap",))
+        narrow = Tracker(self.registry, alert_distance=0.5, cone=30, kinds=("trap",))
+        self.assertEqual([a["site_id"] for a in wide.update(53.55, -113.5428, heading=90)], ["SIDE"])
+        self.assertEqual(narrow.update(53.55, -113.5428, heading=90), [])
+
+    def test_no_heading(self):
+        # Without a heading yet, everything in range alerts
+        alerts = Tracker(self.registry, alert_distance=0.6).update(53.55, -113.5375)
+        self.assertEqual(sorted(a["site_id"] for a in alerts), ["AHEAD", "BEHIND", "SIDE"])
+
+    def test_rearm(self):
+        tracker = Tracker(self.registry, alert_distance=0.3, kinds=("camera",))
+        self.assertEqual(len(tracker.update(53.55, -113.5320, heading=90)), 1)
+        self.assertEqual(tracker.update(53.55, -113.5310, heading=90), [])
+
+        # Driving away and coming back alerts again
+        tracker.update(53.55, -113.5400, heading=270)
+        self.assertEqual([a["site_id"] for a in tracker.update(53.55, -113.5340, heading=90)], ["AHEAD"])
+
+    def test_new_snapshot(self):
+        # A refresh doesn't repeat alerts for devices that are still there
+        tracker = Tracker(self.registry, alert_distance=0.5, kinds=("camera",))
+        self.assertEqual(len(tracker.update(53.55, -113.5350, heading=90)), 1)
+        self.registry.set_devices(CAMERAS + [Camera(site_id="NEW", speed=50, direction="", location="",
+                                                    coords=(53.5500, -113.5320))], TRAPS)
+        self.assertEqual([a["site_id"] for a in tracker.update(53.55, -113.5345, heading=90)], ["NEW"])
+
+    def test_vehicles(self):
+        fixes = [{"lat": 53.55, "lon": -113.5350, "heading": 90, "vehicle": vehicle} for vehicle in ("a", "b", "a")]
+        alerts = list(track(fixes, self.registry, kinds=("camera",)))
+        self.assertEqual([(a["vehicle"], a["site_id"]) for a in alerts], [("a", "AHEAD"), ("b", "AHEAD")])
+
+
+if __name__ == "__main__":
+    unittest.main()